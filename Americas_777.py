@@ -1,8 +1,14 @@
 from KSN770ScriptEngine import *
 import datetime
 import time
+import ksnfpbuffer
+import ksnpipeline
+import ksnsuite
+import ksnwait
 
 test = script( __doc__ )
+waiter = ksnwait.event_waiter( test.wait )
+requests = ksnpipeline.request_pipeline( test )
 
 #################
 ## DEFINITIONS ##
@@ -11,39 +17,36 @@ test = script( __doc__ )
 defaultOrigin      = [ 0, "KPHX", 33.4342, -112.0117 ]#Verify coordinates
 defaultDestination = [ 0, "KDVT", 33.6883, -112.0825 ]#Verify coordinates
 
+# Preferences the script needs, read by ksnsuite: PREF2_SBAS_PROVIDERS (1083),
+# which ACTION-20 leaves at 0x3FFE (without a cold start) unless the unit's own value is 0x3FFF.
+REQUIRES = { "prefs": { 1083: 0x3FFF }, "leaves": { 1083: 0x3FFE } }
+
 
 
 def getDestWpt(destWpt = defaultDestination):
   fpBuffer = test.getFlightPlanBuffer( ACTIVE_FP, WAYPOINT_LIST )
   
-  if fpBuffer:
-    for record in fpBuffer:
-      if record[ 0 ] == WAYPOINT_LIST:
-        lastWptArr = record[ -8 : -4 ]
-        
-        
-        return lastWptArr[ 3 ] | ( lastWptArr[ 2 ] << 8 ) | ( lastWptArr[ 1 ] << 16 ) | ( lastWptArr[ 0 ] << 24 )
-        
-  return False
+  # Return the dest wpt.
+  return ksnfpbuffer.dest_waypoint_id( fpBuffer, WAYPOINT_LIST )
   
-def setNewOrigin( originWpt = defaultOrigin ):
+def setNewOrigin( originWpt = defaultOrigin, fpln = ACTIVE_FP ):
   
   test.log( "Setting a new origin." )
   
   
   test.log( "Inserting origin waypoint." )
-  test.insertWptRequest( ACTIVE_FP, originWpt, ORIGIN_WPT )
+  test.insertWptRequest( fpln, originWpt, ORIGIN_WPT )
   results = test.expectInsertWptResponse()
 
   test.verifyBool( int( results ) == RESP_STATUS_SUCCESS, "Verify that the origin waypoint insertion was successful" )
   test.waitFpEditComplete()
 
   
-def setNewFlightPlan( originWpt = defaultOrigin, destWpt = defaultDestination ):
-  setNewOrigin( originWpt )
+def setNewFlightPlan( originWpt = defaultOrigin, destWpt = defaultDestination, fpln = ACTIVE_FP ):
+  setNewOrigin( originWpt, fpln )
   
   test.log( "Inserting destination waypoint." )
-  test.insertWptRequest( ACTIVE_FP, destWpt, DEST_WPT )
+  test.insertWptRequest( fpln, destWpt, DEST_WPT )
   results = test.expectInsertWptResponse()
 
   test.verifyBool( int( results ) == RESP_STATUS_SUCCESS, "Verify that the destination waypoint insertion was successful" )
@@ -56,6 +59,26 @@ def deleteFp( fpln ):
   test.log( "Deleting the current flight plan." )
   # Clear out existing flight plan.
   test.deleteFpRequest( fpln )
+  
+def buildArrivalFlightPlan( fpln ):
+  # Create a new flight plan with the origin being set to KPHX, and the destination being set to KDVT.
+  setNewFlightPlan( fpln = fpln )
+  
+  # Enter an arrival procedure with a procedure turn.
+  arrival = requests.request( "arrival", fpln, "KDVT" )
+  
+  # Set the approach procedure to RNAV-07R.
+  requests.request( "setArrivalAppr", fpln, 'RNAV 07R' )
+  
+  # Set the approach for BANYO.
+  requests.request( "setArrivalApprTrans", fpln, 'BANYO' )
+  
+  # Send the activate Arrival request.
+  requests.request( "activateArrival", fpln )
+  test.verifyBool( arrival.result()[0] is RESP_STATUS_SUCCESS, "Verify that the response status is RESP_STATUS_SUCCESS." )
+  
+  # Wait for the flight plan edit to complete.
+  requests.wait_fp_edit_complete()
 
 ########################
 ## INITIAL CONDITIONS ##
@@ -76,115 +99,64 @@ test.verifyBool( ( test.ACSim.FASSelect.fas_select == 0 ), "Verify that fasFromD
 test.ACSim.PxpressPacket31.enable()
 test.ACSim.PxpressPacket31.mode = 2
 
-# 5. Set FMS APM Parameter PREF2_SBAS_PROVIDERS to 1 (Use WAAS discrete)
-test.startFmsTransaction( 'getPref', [ 1083 ] )
-sbas_providers = test.expectFmsProxyMessage( 'getPrefResponse', 80 ) 
-test.log( "sbas_providers {}".format(sbas_providers) )
-
-if (sbas_providers != 0x3FFF):
-    test.startFmsTransaction( 'setPref', [ 1083, [ 0x3FFF ] ] )
-    response = test.expectFmsProxyMessage( 'setPrefResponse', 80 ) 
-    test.log( "Response {}".format(response) )
-    assert response == ( "OK", 2 )
-    test.wait(5)
-
-    # Perform a cold start.
-    test.coldStart()
-
-
-#############
-##ACTION-10##
-#############
-# 1. Verify that the FAS data block has not been sent to the GPS.
-test.verifyBool( test.ACSim.FASSelect.fas_select == 0, "Verify that the FAS data block has not been sent to the GPS." )
+# 5. Set FMS APM Parameter PREF2_SBAS_PROVIDERS to 1 (Use WAAS discrete), cold starting only if it changed.
+unit = ksnsuite.unit_state.load()
+try:
+  unit.ensure( test, REQUIRES )
+  sbas_providers = unit.original[ 1083 ]
+  test.log( "sbas_providers {}".format(sbas_providers) )
 
-# 2. Create a new flight plan with the origin being set to LSZP, and the destination being set to LSZB.
-setNewFlightPlan()
 
-# 3. Enter an arrival procedure with a procedure turn.
-test.arrivalRequest( ACTIVE_FP, "KDVT" )
-test.verifyBool( test.expectArrivalResponse()[0] is RESP_STATUS_SUCCESS, "Verify that the response status is RESP_STATUS_SUCCESS." )
+  #############
+  ##ACTION-10##
+  #############
+  # 1. Verify that the FAS data block has not been sent to the GPS.
+  test.verifyBool( test.ACSim.FASSelect.fas_select == 0, "Verify that the FAS data block has not been sent to the GPS." )
 
-# 4. Set the approach procedure to RNAV-07R.
-test.setArrivalApprRequest( ACTIVE_FP, 'RNAV 07R' )
-resp = test.expectSetArrivalApprResponse()
+  # 2. Create the KPHX to KDVT flight plan with the RNAV-07R approach for BANYO.
+  buildArrivalFlightPlan( ACTIVE_FP )
 
-# 5. Set the approach for BIRKI.
-test.setArrivalApprTransRequest( ACTIVE_FP, 'BANYO' )
-resp = test.expectSetArrivalApprTransResponse()
+  #############
+  ##VERIFY-10##
+  #############
 
-# 6. Send the activate Arrival request.
-test.activateArrivalRequest( ACTIVE_FP )
-resp = test.expectActivateArrivalResponse()
+  # 1. Verify that the FAS data block was sent to the GPS.
+  test.verifyBool( test.ACSim.FASSelect.fas_select == 1, "Verify that the FAS data block was sent to the GPS" )
 
-# 7. Wait for the flight plan edit to complete.
-test.waitFpEditComplete()
+  #############
+  ##ACTION-20##
+  #############
 
-#############
-##VERIFY-10##
-#############
-
-# 1. Verify that the FAS data block was sent to the GPS.
-test.verifyBool( test.ACSim.FASSelect.fas_select == 1, "Verify that the FAS data block was sent to the GPS" )
-
-#############
-##ACTION-20##
-#############
-
-#Clear the flight plans.
-deleteFp(ACTIVE_FP)
-#deleteFp(SECONDARY_FP)
-test.waitFpEditComplete()
-
-
-if (sbas_providers != 0x3FFF):
-    test.startFmsTransaction( 'setPref', [ 1083, [ 0x3FFE ] ] )
-    response = test.expectFmsProxyMessage( 'setPrefResponse', 80 ) 
-    test.log( "Response {}".format(response) )
-    assert response == ( "OK", 2 )
-    test.wait(5)
-
-# 1. Verify that the FAS data block has not been sent to the GPS.
-test.verifyBool( test.ACSim.FASSelect.fas_select == 0, "Verify that the FAS data block has not been sent to the GPS." )
-
-# 2. Create a new flight plan with the origin being set to LSZP, and the destination being set to LSZB.
-setNewFlightPlan()
-
-# 3. Enter an arrival procedure with a procedure turn.
-test.arrivalRequest( ACTIVE_FP, "KDVT" )
-test.verifyBool( test.expectArrivalResponse()[0] is RESP_STATUS_SUCCESS, "Verify that the response status is RESP_STATUS_SUCCESS." )
-
-# 4. Set the approach procedure to RNAV-07R.
-test.setArrivalApprRequest( ACTIVE_FP, 'RNAV 07R' )
-resp = test.expectSetArrivalApprResponse()
+  #Clear the flight plans.
+  deleteFp(ACTIVE_FP)
+  #deleteFp(SECONDARY_FP)
+  test.waitFpEditComplete()
 
-# 5. Set the approach for BIRKI.
-test.setArrivalApprTransRequest( ACTIVE_FP, 'BANYO' )
-resp = test.expectSetArrivalApprTransResponse()
 
-# 6. Send the activate Arrival request.
-test.activateArrivalRequest( ACTIVE_FP )
-resp = test.expectActivateArrivalResponse()
+  if (sbas_providers != 0x3FFF):
+    unit.set_pref( test, 1083, 0x3FFE )
 
-# 7. Wait for the flight plan edit to complete.
-test.waitFpEditComplete()
+  # 1. Verify that the FAS data block has not been sent to the GPS.
+  test.verifyBool( test.ACSim.FASSelect.fas_select == 0, "Verify that the FAS data block has not been sent to the GPS." )
 
-#############
-##VERIFY-20##
-#############
-test.log('VERIFY-20')
+  # 2. Create the KPHX to KDVT flight plan with the RNAV-07R approach for BANYO.
+  buildArrivalFlightPlan( ACTIVE_FP )
 
-# 1. Verify that the FAS data block was sent to the GPS.
-test.verifyBool( test.ACSim.FASSelect.fas_select == 1, "Verify that the FAS data block was sent to the GPS" )
+  #############
+  ##VERIFY-20##
+  #############
+  test.log('VERIFY-20')
 
-#Resetting the default value for SBAS providers
-if (sbas_providers != 0x3FFF):
-    test.startFmsTransaction( 'setPref', [ 1083, [sbas_providers]] )
-    response1 = test.expectFmsProxyMessage( 'setPrefResponse', 80 )
-    test.log("Response {}".format(response1) )
-    test.wait( 5 )
+  # 1. Verify that the FAS data block was sent to the GPS.
+  test.verifyBool( test.ACSim.FASSelect.fas_select == 1, "Verify that the FAS data block was sent to the GPS" )
+finally:
+  #Resetting the default value for SBAS providers, left to the suite when run by one,
+  #also when the script fails
+  unit.release( test )
 
-    # perform a cold start
-    test.coldStart( )
+for line in waiter.report():
+  test.log( line )
+test.log( requests.summary() )
+test.log( unit.summary() )
 
 test.endScript()
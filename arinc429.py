@@ -0,0 +1,419 @@
+#! /usr/bin/env python
+'''
+ARINC 429 words.
+
+A word is 32 bits, bit 1 being the least significant:
+
+    bits 1-8    label
+    bits 9-10   SDI
+    bits 11-29  data
+    bits 30-31  SSM
+    bit 32      parity (odd)
+
+A word_layout is one label and its fields, BNR (binary with a resolution,
+two's complement when signed), BCD (decimal digits with a resolution) and
+discrete (bits taken as they are), each at its own bits:
+
+    RANGE = word_layout(0o130, [bnr("range", 17, 13, 1 / 128.0)], ssm=3)
+    RANGE.encode(5.0)                   -> 0x62808058
+    RANGE.decode(0x62808058).range      -> 5.0
+
+The label is given in octal as it is written.  The IOF takes it that way
+(0o274 is 0xbc in the word) and sets the parity itself, the layouts for the
+bus put the label bits in transmission order (reverse=True) and set the odd
+parity bit (parity=True).  Both are lookups in 256 entry tables, REVERSED
+and ODD_PARITY.
+
+encode() and decode() are generated for every layout on first use, with
+the shifts, masks and resolutions as constants, for about a million words
+per second.  encode_many() and decode_many() take and return columns, NumPy
+arrays when it is installed and lists otherwise, with the same words.
+'''
+
+import math
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LABEL_MASK = 0xFF
+SDI_SHIFT = 8
+SSM_SHIFT = 29
+PARITY_BIT = 1 << 31
+#what a field does with a value it cannot hold
+OVERFLOW_ERROR = "error"
+OVERFLOW_CLAMP = "clamp"
+OVERFLOW_WRAP = "wrap"
+OVERFLOWS = [OVERFLOW_ERROR, OVERFLOW_CLAMP, OVERFLOW_WRAP]
+
+
+def _reverse_byte(value):
+    result = 0
+    for bit in range(8):
+        if value & (1 << bit):
+            result |= 0x80 >> bit
+    return result
+
+
+#the label bits of a byte in the other order
+REVERSED = [_reverse_byte(value) for value in range(256)]
+#the parity bit that makes the ones of a byte odd
+ODD_PARITY = [1 - bin(value).count("1") % 2 for value in range(256)]
+
+
+def reverse_label(word):
+    '''The word with its label bits in the other order'''
+    return (word & ~LABEL_MASK) | REVERSED[word & LABEL_MASK]
+
+
+def set_parity(word):
+    '''The word with its parity bit making the number of ones odd'''
+    word &= ~PARITY_BIT
+    folded = word ^ (word >> 16)
+    folded ^= folded >> 8
+    return word | (ODD_PARITY[folded & 0xFF] << 31)
+
+
+def check_parity(word):
+    '''True when the number of ones of the word is odd'''
+    folded = word ^ (word >> 16)
+    folded ^= folded >> 8
+    return ODD_PARITY[folded & 0xFF] == 0
+
+
+class field(object):
+    '''bits bits of the word from bit lsb (1 for the least significant)'''
+    signed = False
+
+    def __init__(self, name, lsb, bits, overflow=OVERFLOW_ERROR):
+        if not 1 <= lsb or lsb + bits - 1 > 32 or bits < 1:
+            raise ValueError("field %s: bits %d-%d are not in a word" %
+                             (name, lsb, lsb + bits - 1))
+        if overflow not in OVERFLOWS:
+            raise ValueError("field %s: unknown overflow %r" %
+                             (name, overflow))
+        self.name = name
+        self.lsb = lsb
+        self.bits = bits
+        self.shift = lsb - 1
+        self.mask = (1 << bits) - 1
+        self.overflow = overflow
+        if self.signed:
+            self.low = -(1 << (bits - 1))
+            self.high = (1 << (bits - 1)) - 1
+        else:
+            self.low = 0
+            self.high = self.mask
+
+
+    def encode_source(self, name):
+        '''Lines of the generated encode() putting name in "word"'''
+        lines = ["code = %s" % self._code_source(name)]
+        if self.overflow == OVERFLOW_CLAMP:
+            lines.append("code = %d if code < %d else %d if code > %d "
+                         "else code" % (self.low, self.low, self.high,
+                                        self.high))
+        elif self.overflow == OVERFLOW_ERROR:
+            lines.append("if not %d <= code <= %d: _overflow(%r, %s)" %
+                         (self.low, self.high, self.name, name))
+        lines.append("word |= (code & %d) << %d" % (self.mask, self.shift))
+        return lines
+
+
+    def decode_source(self, word):
+        '''Expression of the generated decode() for the value in word'''
+        code = "((%s >> %d) & %d)" % (word, self.shift, self.mask)
+        if self.signed:
+            code = "_signed(%s, %d)" % (code, self.bits)
+        return self._value_source(code)
+
+
+    def _code_source(self, name):
+        return "int(%s)" % name
+
+
+    def _value_source(self, code):
+        return code
+
+
+    def encode_array(self, values):
+        '''The field bits of a column of values (NumPy)'''
+        code = self._code_array(numpy.asarray(values))
+        if self.overflow == OVERFLOW_CLAMP:
+            code = numpy.clip(code, self.low, self.high)
+        elif self.overflow == OVERFLOW_ERROR:
+            bad = (code < self.low) | (code > self.high)
+            if bad.any():
+                raise ValueError("%s: %r is out of range" %
+                                 (self.name, numpy.asarray(values)[bad][0]))
+        return (code & self.mask) << self.shift
+
+
+    def decode_array(self, words):
+        code = (words >> self.shift) & self.mask
+        if self.signed:
+            code = numpy.where(code > self.high, code - (1 << self.bits),
+                               code)
+        return self._value_array(code)
+
+
+    def _code_array(self, values):
+        return values.astype(numpy.int64)
+
+
+    def _value_array(self, code):
+        return code
+
+
+class discrete(field):
+    '''Bits taken as an unsigned integer, 1 bit by default'''
+    def __init__(self, name, lsb, bits=1, overflow=OVERFLOW_ERROR):
+        field.__init__(self, name, lsb, bits, overflow)
+
+
+class bnr(field):
+    '''
+    Binary: value / resolution in bits bits from lsb, two's complement when
+    signed.  Angles are signed with wrap overflow, 180 degrees being -180.
+    '''
+    def __init__(self, name, lsb, bits, resolution, signed=False,
+                 overflow=OVERFLOW_ERROR):
+        self.signed = signed
+        field.__init__(self, name, lsb, bits, overflow)
+        self.resolution = float(resolution)
+
+
+    def _code_source(self, name):
+        return "_floor(%s * %r + 0.5)" % (name, 1.0 / self.resolution)
+
+
+    def _value_source(self, code):
+        return "%s * %r" % (code, self.resolution)
+
+
+    def _code_array(self, values):
+        return numpy.floor(values * (1.0 / self.resolution) +
+                           0.5).astype(numpy.int64)
+
+
+    def _value_array(self, code):
+        return code * self.resolution
+
+
+class bcd(field):
+    '''Binary coded decimal: value / resolution in digits 4 bit digits from
+    lsb, the least significant first'''
+    def __init__(self, name, lsb, digits, resolution=1,
+                 overflow=OVERFLOW_ERROR):
+        field.__init__(self, name, lsb, 4 * digits, overflow)
+        self.digits = digits
+        self.resolution = float(resolution)
+        self.high = 10 ** digits - 1
+
+
+    def encode_source(self, name):
+        lines = field.encode_source(self, name)
+        #the decimal digits into nibbles, the last line puts them in place
+        lines.insert(-1, "code = _to_bcd(code, %d)" % self.digits)
+        return lines
+
+
+    def decode_source(self, word):
+        return "_from_bcd((%s >> %d) & %d, %d) * %r" % (
+            word, self.shift, self.mask, self.digits, self.resolution)
+
+
+    def _code_source(self, name):
+        return "_floor(%s * %r + 0.5)" % (name, 1.0 / self.resolution)
+
+
+    def encode_array(self, values):
+        code = numpy.floor(numpy.asarray(values) * (1.0 / self.resolution) +
+                           0.5).astype(numpy.int64)
+        if self.overflow == OVERFLOW_CLAMP:
+            code = numpy.clip(code, 0, self.high)
+        elif self.overflow == OVERFLOW_ERROR:
+            bad = (code < 0) | (code > self.high)
+            if bad.any():
+                raise ValueError("%s: %r is out of range" %
+                                 (self.name, numpy.asarray(values)[bad][0]))
+        code %= 10 ** self.digits
+        nibbles = numpy.zeros_like(code)
+        for digit in range(self.digits):
+            nibbles |= ((code // 10 ** digit) % 10) << (4 * digit)
+        return nibbles << self.shift
+
+
+    def decode_array(self, words):
+        nibbles = (words >> self.shift) & self.mask
+        code = numpy.zeros_like(nibbles)
+        for digit in range(self.digits):
+            code += ((nibbles >> (4 * digit)) & 0xF) * 10 ** digit
+        return code * self.resolution
+
+
+def _to_bcd(code, digits):
+    code %= 10 ** digits
+    nibbles = 0
+    for digit in range(digits):
+        code, rest = divmod(code, 10)
+        nibbles |= rest << (4 * digit)
+    return nibbles
+
+
+def _from_bcd(nibbles, digits):
+    code = 0
+    scale = 1
+    for digit in range(digits):
+        code += (nibbles & 0xF) * scale
+        nibbles >>= 4
+        scale *= 10
+    return code
+
+
+def _signed(code, bits):
+    if code >> (bits - 1):
+        return code - (1 << bits)
+    return code
+
+
+def _overflow(name, value):
+    raise ValueError("%s: %r is out of range" % (name, value))
+
+
+def _floor(value):
+    #rounding is floor(x + 0.5) in both encodings, halves go up
+    return int(math.floor(value))
+
+
+class word_layout(object):
+    '''
+    One label (octal, as written) and its fields, with a fixed SDI, SSM and
+    any other fixed bits.  encode() takes the field values in order or by
+    name, missing ones being 0, decode() returns a record of them.
+    '''
+    def __init__(self, label, fields, sdi=0, ssm=0, fixed=0, reverse=False,
+                 parity=False, name=None):
+        self.label = label
+        self.fields = list(fields)
+        self.sdi = sdi
+        self.ssm = ssm
+        self.fixed = fixed
+        self.reverse = reverse
+        self.parity = parity
+        self.name = name or "label_%03o" % label
+        used = LABEL_MASK | (PARITY_BIT if parity else 0)
+        for item in self.fields:
+            bits = item.mask << item.shift
+            if bits & used:
+                raise ValueError("%s: field %s overlaps another one" %
+                                 (self.name, item.name))
+            used |= bits
+        self.base = ((REVERSED[label] if reverse else label) |
+                     (sdi << SDI_SHIFT) | (ssm << SSM_SHIFT) | fixed)
+        self.record = collections.namedtuple(
+            self.name, [item.name for item in self.fields])
+        self._encode = None
+        self._decode = None
+
+
+    def _generate(self, source, name):
+        namespace = {"_floor": _floor, "_overflow": _overflow,
+                     "_signed": _signed, "_to_bcd": _to_bcd,
+                     "_from_bcd": _from_bcd, "_record": self.record,
+                     "_parity": set_parity}
+        exec(compile(source, "<arinc429 %s>" % self.name, "exec"), namespace)
+        return namespace[name]
+
+
+    @property
+    def encode(self):
+        '''encode(*values) -> word'''
+        if self._encode is None:
+            names = [item.name for item in self.fields]
+            lines = ["def encode(%s):" % "".join(name + "=0, "
+                                                 for name in names),
+                     "    word = %d" % self.base]
+            for item in self.fields:
+                lines += ["    " + line
+                          for line in item.encode_source(item.name)]
+            if self.parity:
+                lines.append("    word = _parity(word)")
+            lines.append("    return word")
+            self._encode = self._generate("\n".join(lines) + "\n", "encode")
+        return self._encode
+
+
+    @property
+    def decode(self):
+        '''decode(word) -> record of the field values'''
+        if self._decode is None:
+            values = "".join(item.decode_source("word") + ", "
+                             for item in self.fields)
+            source = ("def decode(word):\n"
+                      "    return _record(%s)\n" % values)
+            self._decode = self._generate(source, "decode")
+        return self._decode
+
+
+    def encode_many(self, *columns, **named):
+        '''
+        The words of columns of values (one per field in order, or by name),
+        a NumPy uint32 array when it is installed, a list otherwise
+        '''
+        columns, count = self._columns(columns, named)
+        if numpy is None:
+            encode = self.encode
+            return [encode(*row) for row in zip(*columns)]
+        words = numpy.full(count, self.base, dtype=numpy.int64)
+        for item, column in zip(self.fields, columns):
+            words |= item.encode_array(column)
+        words = words.astype(numpy.uint32)
+        if self.parity:
+            words = set_parity_many(words)
+        return words
+
+
+    def _columns(self, columns, named):
+        columns = list(columns) + [None] * (len(self.fields) - len(columns))
+        for index, item in enumerate(self.fields):
+            if item.name in named:
+                columns[index] = named.pop(item.name)
+        if named:
+            raise TypeError("%s: unknown fields %s" %
+                            (self.name, ", ".join(sorted(named))))
+        #the count comes from the columns given, the others are zeros
+        given = [column for column in columns if column is not None]
+        count = len(given[0]) if given else 0
+        if numpy is None:
+            zeros = [0] * count
+        else:
+            zeros = numpy.zeros(count, dtype=numpy.int64)
+        return [column if column is not None else zeros
+                for column in columns], count
+
+
+    def decode_many(self, words):
+        '''A record of columns, one per field'''
+        if numpy is None:
+            decode = self.decode
+            rows = [decode(word) for word in words]
+            return self.record(*[list(column) for column in zip(*rows)]
+                               or [[] for item in self.fields])
+        words = numpy.asarray(words, dtype=numpy.int64)
+        return self.record(*[item.decode_array(words)
+                             for item in self.fields])
+
+
+def set_parity_many(words):
+    '''set_parity() of a column of words'''
+    if numpy is None:
+        return [set_parity(word) for word in words]
+    words = numpy.asarray(words, dtype=numpy.uint32) & ~numpy.uint32(
+        PARITY_BIT)
+    folded = words ^ (words >> 16)
+    folded ^= folded >> 8
+    table = numpy.array(ODD_PARITY, dtype=numpy.uint32)
+    return words | (table[folded & 0xFF] << 31)
@@ -1,8 +1,15 @@
 from KSN770ScriptEngine import *
 import datetime
 import time
+import ksnfpbuffer
+import ksnfpedit
+import ksnpipeline
+import ksnsuite
+import ksnwait
 
 test = script( __doc__ )
+waiter = ksnwait.event_waiter( test.wait )
+requests = ksnpipeline.request_pipeline( test )
 
 #################
 ## DEFINITIONS ##
@@ -13,39 +20,35 @@ defaultDestination = [ 0, "LSZB", 46.9122, 7.4992 ]
 
 defaultOrigin2      = [ 0, "LSZB", 46.9122, 7.4992 ]
 defaultDestination2 = [ 0, "LSZP", 47.0903, 7.2908 ]
+
+# Preferences the script needs, read by ksnsuite: none changed from the unit's own.
+REQUIRES = {}
     
 
 def getDestWpt(destWpt = defaultDestination):
   fpBuffer = test.getFlightPlanBuffer( SECONDARY_FP, WAYPOINT_LIST )
   
-  if fpBuffer:
-    for record in fpBuffer:
-      if record[ 0 ] == WAYPOINT_LIST:
-        lastWptArr = record[ -8 : -4 ]
-        
-        # Return the dest wpt.
-        return lastWptArr[ 3 ] | ( lastWptArr[ 2 ] << 8 ) | ( lastWptArr[ 1 ] << 16 ) | ( lastWptArr[ 0 ] << 24 )
-        
-  return False
+  # Return the dest wpt.
+  return ksnfpbuffer.dest_waypoint_id( fpBuffer, WAYPOINT_LIST )
   
-def setNewOrigin( originWpt = defaultOrigin ):
+def setNewOrigin( originWpt = defaultOrigin, fpln = SECONDARY_FP ):
   # Clear the GF Command Modification list.
   test.log( "Setting a new origin." )
   #deleteFp()
   
   test.log( "Inserting origin waypoint." )
-  test.insertWptRequest( SECONDARY_FP, originWpt, ORIGIN_WPT )
+  test.insertWptRequest( fpln, originWpt, ORIGIN_WPT )
   results = test.expectInsertWptResponse()
 
   test.verifyBool( int( results ) == RESP_STATUS_SUCCESS, "Verify that the origin waypoint insertion was successful" )
   test.waitFpEditComplete()
 
   
-def setNewFlightPlan( originWpt = defaultOrigin, destWpt = defaultDestination ):
-  setNewOrigin( originWpt )
+def setNewFlightPlan( originWpt = defaultOrigin, destWpt = defaultDestination, fpln = SECONDARY_FP ):
+  setNewOrigin( originWpt, fpln )
   
   test.log( "Inserting destination waypoint." )
-  test.insertWptRequest( SECONDARY_FP, destWpt, DEST_WPT )
+  test.insertWptRequest( fpln, destWpt, DEST_WPT )
   results = test.expectInsertWptResponse()
 
   test.verifyBool( int( results ) == RESP_STATUS_SUCCESS, "Verify that the destination waypoint insertion was successful" )
@@ -63,15 +66,8 @@ def deleteFp( fpln ):
 def getActiveDestWpt(destWpt = defaultDestination2):
   fpBuffer = test.getFlightPlanBuffer( ACTIVE_FP, WAYPOINT_LIST )
   
-  if fpBuffer:
-    for record in fpBuffer:
-      if record[ 0 ] == WAYPOINT_LIST:
-        lastWptArr = record[ -8 : -4 ]
-        
-        # Return the dest wpt.
-        return lastWptArr[ 3 ] | ( lastWptArr[ 2 ] << 8 ) | ( lastWptArr[ 1 ] << 16 ) | ( lastWptArr[ 0 ] << 24 )
-        
-  return False
+  # Return the dest wpt.
+  return ksnfpbuffer.dest_waypoint_id( fpBuffer, WAYPOINT_LIST )
   
 def setNewActiveOrigin( originWpt = defaultOrigin2 ):
   # Clear the GF Command Modification list.
@@ -97,6 +93,34 @@ def setNewActiveFlightPlan( originWpt = defaultOrigin2, destWpt = defaultDestina
   test.waitFpEditComplete()
   
   return getDestWpt()
+  
+def buildArrivalFlightPlan( fpln ):
+  # Create a new flight plan with the origin being set to LSZP, and the destination being set to LSZB.
+  setNewFlightPlan( fpln = fpln )
+  
+  # Enter an arrival procedure with a procedure turn.
+  arrival = requests.request( "arrival", fpln, "LSZB" )
+  
+  # Set the approach procedure to RNAV-14.
+  requests.request( "setArrivalAppr", fpln, 'RNAV 14' )
+  
+  # Set the approach for BIRKI.
+  requests.request( "setArrivalApprTrans", fpln, 'BIRKI' )
+  
+  # Send the activate Arrival request.
+  requests.request( "activateArrival", fpln )
+  test.verifyBool( arrival.result()[0] is RESP_STATUS_SUCCESS, "Verify that the response status is RESP_STATUS_SUCCESS." )
+  
+  # Wait for the flight plan edit to complete.
+  requests.wait_fp_edit_complete()
+  
+  # Remove any discontinuities.
+  test.log( "Removing discontinuities" )
+  deleted = ksnfpedit.delete_discontinuities( test, fpln, WAYPOINT, requests = requests )
+  
+  for uniqueWaypointId, results in deleted.items():
+    test.verifyBool( results is RESP_STATUS_SUCCESS, "Verify that the response status is RESP_STAT_SUCCESS" )
+  
   ########################################################################
 fasFromDBStatus = 0
 
@@ -113,166 +137,86 @@ test.ACSim.FASSelect.enable()
 test.ACSim.enableNavigation( 47.0903, 7.2908, 5000, 140, 0 )
 #test.verifyBool( ( test.ACSim.FASSelect.fas_select == 0 ), "Verify that fasFromDBStatus == 0" )
 
-################
-## ACTION-010 ##
-################
-test.log( "ACTION-010" )
-
-
-#Deletes any old flight plan still in the KSN
-deleteFp(ACTIVE_FP)
-deleteFp(SECONDARY_FP)
-test.waitFpEditComplete()
-
-# 3. Create a new flight plan with the origin being set to LSZP, and the destination being set to LSZB.
-setNewFlightPlan()
-
-
-
-# 4. Enter an arrival procedure with a procedure turn.
-test.arrivalRequest( SECONDARY_FP, "LSZB" )
-test.verifyBool( test.expectArrivalResponse()[0] is RESP_STATUS_SUCCESS, "Verify that the response status is RESP_STATUS_SUCCESS." )
-
-# 5. Set the approach procedure to RNAV-14.
-test.setArrivalApprRequest( SECONDARY_FP, 'RNAV 14' )
-resp = test.expectSetArrivalApprResponse()
+# 3. Restore any preference an earlier script of the suite changed, cold starting only if one did.
+unit = ksnsuite.unit_state.load()
+try:
+  unit.ensure( test, REQUIRES )
 
-# 6. Set the approach for BIRKI.
-test.setArrivalApprTransRequest( SECONDARY_FP, 'BIRKI' )
-resp = test.expectSetArrivalApprTransResponse()
+  ################
+  ## ACTION-010 ##
+  ################
+  test.log( "ACTION-010" )
 
-# 7. Send the activate Arrival request.
-test.activateArrivalRequest( SECONDARY_FP )
-resp = test.expectActivateArrivalResponse()
 
-# 8. Wait for the flight plan edit to complete.
-test.waitFpEditComplete()
-
-# 9. Remove any discontinuities.
-test.log( "Removing discontinuities" )
-fpBuffer = test.getFlightPlanBuffer( SECONDARY_FP, WAYPOINT )
-
-if fpBuffer:
-    for record in fpBuffer:
-      if record[ 0 ] == WAYPOINT:
-        IdentDisplayCode = record[ 128 ]
-        ID = record[ 119 : 123 ]
-        uniqueWaypointId = ID[ 3 ] | ( ID[ 2 ] << 8 ) | ( ID[ 1 ] << 16 ) | ( ID[ 0 ]  << 24 )
-        NameBytes = record[5:14]
-        Name = ""
-        for val in NameBytes:
-            if val == 0:
-              break
-            Name += chr(val)        
-        if IdentDisplayCode == 4:
-            test.deleteWptRequest( SECONDARY_FP, uniqueWaypointId )
-            results = test.expectDeleteWptResponse()
-            test.verifyBool( results is RESP_STATUS_SUCCESS, "Verify that the response status is RESP_STAT_SUCCESS" )
-            
-            
-################
-## VERIFY-010 ##
-################
-test.log( "VERIFY-010" )
-
-test.verifyBool( ( fasFromDBStatus == 0 ), "Verify that fasFromDBStatus == False" )
-
-test.copyFplnRequest( SECONDARY_FP, ACTIVE_FP )
-
-test.waitFpEditComplete()
-
-test.wait(5)
-
-
-
-
-fasFromDBStatus = 0
+  #Deletes any old flight plan still in the KSN
+  deleteFp(ACTIVE_FP)
+  deleteFp(SECONDARY_FP)
+  test.waitFpEditComplete()
 
+  # 3. Create the LSZP to LSZB flight plan with the RNAV-14 approach for BIRKI, without discontinuities.
+  buildArrivalFlightPlan( SECONDARY_FP )
 
-while fasFromDBStatus == 0:
-    fasFromDBStatus = test.ACSim.FASSelect.fas_select
-    test.wait(0.5)
 
+  ################
+  ## VERIFY-010 ##
+  ################
+  test.log( "VERIFY-010" )
 
-test.verifyBool( ( fasFromDBStatus == True ), "Verify that fasFromDBStatus == True" )
+  test.verifyBool( ( fasFromDBStatus == 0 ), "Verify that fasFromDBStatus == False" )
 
+  test.copyFplnRequest( SECONDARY_FP, ACTIVE_FP )
 
-deleteFp(ACTIVE_FP)
-deleteFp(SECONDARY_FP)
-test.wait(35)
-test.waitFpEditComplete()
+  test.waitFpEditComplete()
 
-test.wait(5)
+  waiter.wait_until( lambda: test.ACSim.FASSelect.fas_select != 0, 60, "FAS data block sent", replaces = 5.5 )
+  fasFromDBStatus = test.ACSim.FASSelect.fas_select
 
-################
-## ACTION-020 ##
-################
-test.log( "ACTION-020" )
 
-#1. Creates an active flight plan.
-setNewActiveFlightPlan()
-test.wait(10)
+  test.verifyBool( ( fasFromDBStatus == True ), "Verify that fasFromDBStatus == True" )
 
-# 2. Create a new flight plan with the origin being set to LSZP, and the destination being set to LSZB.
-setNewFlightPlan()
 
-# 3. Enter an arrival procedure with a procedure turn.
-test.arrivalRequest( SECONDARY_FP, "LSZB" )
-test.verifyBool( test.expectArrivalResponse()[0] is RESP_STATUS_SUCCESS, "Verify that the response status is RESP_STATUS_SUCCESS." )
+  deleteFp(ACTIVE_FP)
+  deleteFp(SECONDARY_FP)
+  test.waitFpEditComplete()
 
-# 4. Set the approach procedure to RNAV-14.
-test.setArrivalApprRequest( SECONDARY_FP, 'RNAV 14' )
-resp = test.expectSetArrivalApprResponse()
+  waiter.wait_until( lambda: test.ACSim.FASSelect.fas_select == 0, 40, "FAS data block cleared" )
 
-# 5. Set the approach for BIRKI.
-test.setArrivalApprTransRequest( SECONDARY_FP, 'BIRKI' )
-resp = test.expectSetArrivalApprTransResponse()
+  ################
+  ## ACTION-020 ##
+  ################
+  test.log( "ACTION-020" )
 
-# 6. Send the activate Arrival request.
-test.activateArrivalRequest( SECONDARY_FP )
-resp = test.expectActivateArrivalResponse()
+  #1. Creates an active flight plan.
+  # setNewActiveFlightPlan() waits for the flight plan edits to complete.
+  setNewActiveFlightPlan()
 
-# 7. Wait for the flight plan edit to complete.
-test.waitFpEditComplete()
+  # 2. Create the LSZP to LSZB flight plan with the RNAV-14 approach for BIRKI, without discontinuities.
+  buildArrivalFlightPlan( SECONDARY_FP )
 
-# 8. Remove any discontinuities.
-test.log( "Removing discontinuities" )
-fpBuffer = test.getFlightPlanBuffer( SECONDARY_FP, WAYPOINT )
 
-if fpBuffer:
-    for record in fpBuffer:
-      if record[ 0 ] == WAYPOINT:
-        IdentDisplayCode = record[ 128 ]
-        ID = record[ 119 : 123 ]
-        uniqueWaypointId = ID[ 3 ] | ( ID[ 2 ] << 8 ) | ( ID[ 1 ] << 16 ) | ( ID[ 0 ]  << 24 )
-        NameBytes = record[5:14]
-        Name = ""
-        for val in NameBytes:
-            if val == 0:
-              break
-            Name += chr(val)        
-        if IdentDisplayCode == 4:
-            test.deleteWptRequest( SECONDARY_FP, uniqueWaypointId )
-            results = test.expectDeleteWptResponse()
-            test.verifyBool( results is RESP_STATUS_SUCCESS, "Verify that the response status is RESP_STAT_SUCCESS" )
-            
-            
-################
-## VERIFY-020 ##
-################
-test.log( "VERIFY-020" )
-test.verifyBool( ( test.ACSim.FASSelect.fas_select == 0 ), "Verify that fasFromDBStatus == False" )
+  ################
+  ## VERIFY-020 ##
+  ################
+  test.log( "VERIFY-020" )
+  test.verifyBool( ( test.ACSim.FASSelect.fas_select == 0 ), "Verify that fasFromDBStatus == False" )
 
-test.copyFplnRequest( SECONDARY_FP, ACTIVE_FP )
+  test.copyFplnRequest( SECONDARY_FP, ACTIVE_FP )
 
-test.waitFpEditComplete()
-test.wait(6)
+  test.waitFpEditComplete()
+  waiter.wait_until( lambda: test.ACSim.FASSelect.fas_select == 1, 6, "FAS data block sent" )
 
 
 
-test.verifyBool( ( test.ACSim.FASSelect.fas_select == 1 ), "Verify that fasFromDBStatus == True" )
+  test.verifyBool( ( test.ACSim.FASSelect.fas_select == 1 ), "Verify that fasFromDBStatus == True" )
+finally:
+  unit.release( test )
 
 ###################
 ## END OF SCRIPT ##
 ###################
+for line in waiter.report():
+  test.log( line )
+test.log( requests.summary() )
+test.log( unit.summary() )
+
 test.endScript()
@@ -0,0 +1,222 @@
+#! /usr/bin/env python3
+'''
+asyncio flavour of ksnsend (Python 3 only).
+
+The label groups of a ksn_scenario run as periodic coroutines on loop-time
+deadlines and the packets go out through a datagram endpoint, so a scenario
+can share an event loop with whatever monitors or orchestrates the test.
+Takes the same command line as ksnsend.py.
+
+    engine = ksn_async_engine(options)
+    task = asyncio.create_task(engine.run(duration=30))
+    ...
+    task.cancel()    #stops the groups and sends the unblock cleanup
+'''
+
+import asyncio
+import errno
+import sys
+
+import ksnsend
+import ksnsched
+
+#errors reported by the endpoint when the unit is not there (yet)
+IGNORED_ERRORS = (errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.ECONNREFUSED)
+CLEANUP_COUNT = 10
+
+
+class _ksn_protocol(asyncio.DatagramProtocol):
+    '''Keeps the last send error until the next send reports it'''
+    def __init__(self):
+        self.transport = None
+        self.error = None
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+
+    def error_received(self, exc):
+        if exc.errno not in IGNORED_ERRORS:
+            self.error = exc
+
+
+class _endpoint_socket(object):
+    '''The sendto() and close() ksn_send needs, on a connected endpoint'''
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+
+    def sendto(self, package, address):
+        error = self.protocol.error
+        if error is not None:
+            self.protocol.error = None
+            raise error
+        #the transport copies the packet if it has to queue it
+        self.transport.sendto(package)
+
+
+    def close(self):
+        self.transport.close()
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def sleep_until(deadline):
+    '''Sleeps until the absolute loop time deadline'''
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    handle = loop.call_at(deadline, _wake, future)
+    try:
+        await future
+    finally:
+        handle.cancel()
+
+
+class ksn_async_engine(object):
+    '''Sends the label groups of ksnsend.main() for one set of options'''
+    def __init__(self, options):
+        self.options = options
+        self.sender = None
+        self.recorder = None
+        self.stats = None
+        self.scenario = None
+        self.epoch = None
+        self._groups = []
+
+
+    async def start(self):
+        '''Opens the endpoint and starts one coroutine per label group'''
+        options = self.options
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            _ksn_protocol, remote_addr=(options.host, options.port))
+        if options.record != None:
+            import ksnrecord
+            self.recorder = ksnrecord.packet_recorder(
+                options.record, max_segment_bytes=options.record_size << 20)
+        if (options.stats or options.stats_file != None or
+                options.stats_port != None):
+            import ksnstats
+            #the loop clock, so deadlines and send times compare
+            self.stats = ksnstats.send_stats(clock=loop.time)
+            if options.stats_port != None:
+                self.stats.serve(options.stats_port)
+        self.sender = ksnsend.ksn_send(options.host, options.port,
+                                       sock=_endpoint_socket(transport,
+                                                             protocol),
+                                       recorder=self.recorder,
+                                       stats=self.stats)
+        #the trajectory or dead-reckoning ownship runs on the loop time too
+        self.scenario = ksnsend.ksn_scenario(
+            self.sender, options, ksnsend.ownship_state(options, loop.time))
+        tasks = self.scenario.tasks(options.overrun)
+        if self.stats is not None:
+            self.stats.watch(tasks)
+            if options.stats:
+                stats = self.stats
+                tasks.append(ksnsched.periodic_task(
+                    "stats", options.stats_interval, options.stats_interval,
+                    lambda: print(stats.summary())))
+        self.epoch = loop.time()
+        self._groups = [loop.create_task(self._periodic(task))
+                        for task in tasks]
+
+
+    async def _periodic(self, task):
+        loop = asyncio.get_running_loop()
+        deadline = task.deadline(self.epoch)
+        while True:
+            await sleep_until(deadline)
+            if self.stats is not None:
+                self.stats.deadline = deadline
+            task.callback()
+            task.runs += 1
+            if self.stats is not None:
+                self.stats.deadline = None
+            deadline = task.advance(self.epoch, loop.time())
+
+
+    async def wait(self, timeout=None):
+        '''Waits for timeout seconds (forever if None), raising the error of
+        any label group that failed'''
+        if not self._groups:
+            return
+        done, pending = await asyncio.wait(self._groups, timeout=timeout,
+                                           return_when=asyncio.FIRST_EXCEPTION)
+        for group in done:
+            if not group.cancelled() and group.exception() is not None:
+                raise group.exception()
+
+
+    async def shutdown(self):
+        '''Stops the label groups, sends the unblock cleanup (unless
+        nocleanup is set) and closes the endpoint'''
+        for group in self._groups:
+            group.cancel()
+        await asyncio.gather(*self._groups, return_exceptions=True)
+        self._groups = []
+        if self.sender is None:
+            return
+        try:
+            if not self.options.nocleanup:
+                #sending a few to try and make sure it gets unblocked
+                for i in range(CLEANUP_COUNT):
+                    self.scenario.send_cleanup()
+                    await asyncio.sleep(ksnsend.TASK_INTERVAL)
+        finally:
+            self.sender.close()
+            self.sender = None
+            if self.recorder is not None:
+                self.recorder.close()
+            if self.stats is not None:
+                self.stats.close()
+                if self.options.stats_file != None:
+                    self.stats.dump(self.options.stats_file)
+
+
+    async def run(self, duration=None):
+        '''Sends for duration seconds (until cancelled if None) and shuts
+        down'''
+        await self.start()
+        try:
+            await self.wait(duration)
+        finally:
+            await self.shutdown()
+
+
+def main():
+    options = ksnsend.parse_command_line()
+    try:
+        #report a bad trajectory or manoeuvre before the loop starts
+        ksnsend.check_ownship_state(options)
+    except ksnsend.state_error as error:
+        sys.exit("error: %s" % error)
+    if options.batch:
+        print("--batch is ignored, the endpoint sends each packet itself")
+    if options.clock != "real":
+        print("--clock options are ignored, the groups run on the loop time")
+    if options.transport != "udp":
+        print("--transport is ignored, the groups send through a UDP endpoint")
+    if options.control != None:
+        print("--control is ignored, call ksn_scenario.update() from the loop")
+    if options.timeout != None:
+        print("Sending data for %d seconds" % options.timeout)
+    print("Terminate with Ctrl-C")
+    try:
+        asyncio.run(ksn_async_engine(options).run(options.timeout))
+    except KeyboardInterrupt:
+        print("")
+        print("Shutting down...")
+    except:
+        print("Unexpected error:", sys.exc_info()[0])
+        raise
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+#! /usr/bin/env python
+'''
+Batched datagram transmission for ksnsend.
+
+Packets queued during a scheduler tick are copied into fixed slots of one
+preallocated arena and sent with a single sendmmsg() call on Linux.
+Elsewhere the batch falls back to a tight send() loop, which is why the
+socket must be connected.
+
+recv_batch is the receiving counterpart (recvmmsg() on Linux) for sinks
+that stand in for a KSN unit.
+'''
+
+import os
+import sys
+import time
+import errno
+import select
+import socket
+import ctypes
+import ctypes.util
+
+MAX_BATCH_PACKETS = 64
+MAX_PACKET_SIZE = 512
+MAX_DATAGRAM_SIZE = 2048
+MSG_DONTWAIT = 0x40          #Linux value, only passed to recvmmsg()
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc_function(name, argtypes):
+    '''A libc function, or None where the platform does not have it'''
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    function.argtypes = argtypes
+    function.restype = ctypes.c_int
+    return function
+
+
+_sendmmsg = _load_libc_function("sendmmsg", [ctypes.c_int, ctypes.c_void_p,
+                                             ctypes.c_uint, ctypes.c_int])
+#the timeout is not used, select() waits for the first packet
+_recvmmsg = _load_libc_function("recvmmsg", [ctypes.c_int, ctypes.c_void_p,
+                                             ctypes.c_uint, ctypes.c_int,
+                                             ctypes.c_void_p])
+
+
+def _arena_messages(arena, count, slot):
+    '''mmsghdr array with one iovec per fixed slot of arena'''
+    iovecs = (_iovec * count)()
+    msgs = (_mmsghdr * count)()
+    base = (ctypes.c_char * len(arena)).from_buffer(arena)
+    for i in range(count):
+        iovecs[i].iov_base = ctypes.addressof(base) + i * slot
+        iovecs[i].iov_len = slot
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    return base, iovecs, msgs
+
+
+class send_batch(object):
+    '''
+    Send queue for a connected datagram socket.  append() copies the packet
+    into the arena, so the caller may reuse its buffer straight away.
+    '''
+    def __init__(self, sock, max_packets=MAX_BATCH_PACKETS,
+                 max_packet_size=MAX_PACKET_SIZE, use_sendmmsg=True):
+        self.sock = sock
+        self.max_packets = max_packets
+        self.max_packet_size = max_packet_size
+        self.arena = bytearray(max_packets * max_packet_size)
+        self.view = memoryview(self.arena)
+        self.sizes = [0] * max_packets
+        self.count = 0
+        #counters for the whole life of the batch
+        self.batches = 0
+        self.packets = 0
+        self.syscalls = 0
+        self.errors = 0
+        self.dropped = 0
+
+        self.sendmmsg = None
+        if use_sendmmsg and _sendmmsg is not None:
+            self.sendmmsg = _sendmmsg
+            #every slot keeps its iovec, only the lengths change per batch
+            self._arena_ref, self._iovecs, self._msgs = _arena_messages(
+                self.arena, max_packets, max_packet_size)
+
+
+    def __len__(self):
+        return self.count
+
+
+    def append(self, package):
+        '''Queues a packet.  Returns the error of the implicit flush when the
+        queue was full, otherwise None.'''
+        error = None
+        size = len(package)
+        if size > self.max_packet_size:
+            raise ValueError("packet of %d bytes does not fit a %d byte slot" %
+                             (size, self.max_packet_size))
+        if self.count == self.max_packets:
+            error = self.flush()
+        count = self.count
+        start = count * self.max_packet_size
+        self.arena[start:start+size] = package
+        self.sizes[count] = size
+        self.count = count + 1
+        return error
+
+
+    def flush(self):
+        '''
+        Sends every queued packet.  Returns None, or the socket.error that
+        stopped the batch.  Packets after the failing one are dropped.
+        '''
+        count = self.count
+        if count == 0:
+            return None
+        self.count = 0
+        self.batches += 1
+        if self.sendmmsg is not None:
+            sent, error = self._flush_sendmmsg(count)
+        else:
+            sent, error = self._flush_loop(count)
+        self.packets += sent
+        if error is not None:
+            self.errors += 1
+            self.dropped += count - sent
+        return error
+
+
+    def _flush_sendmmsg(self, count):
+        sizes = self.sizes
+        iovecs = self._iovecs
+        for i in range(count):
+            iovecs[i].iov_len = sizes[i]
+
+        fd = self.sock.fileno()
+        msgs = ctypes.addressof(self._msgs)
+        size = ctypes.sizeof(_mmsghdr)
+        sent = 0
+        while sent < count:
+            self.syscalls += 1
+            result = self.sendmmsg(fd, msgs + sent * size, count - sent, 0)
+            if result < 0:
+                value = ctypes.get_errno()
+                if value == errno.EINTR:
+                    continue
+                return sent, socket.error(value, os.strerror(value))
+            sent += result
+        return sent, None
+
+
+    def _flush_loop(self, count):
+        sizes = self.sizes
+        slot = self.max_packet_size
+        view = self.view
+        send = self.sock.send
+        for i in range(count):
+            self.syscalls += 1
+            try:
+                send(view[i*slot:i*slot+sizes[i]])
+            except socket.error as error:
+                return i, error
+        return count, None
+
+
+class recv_batch(object):
+    '''
+    Receives up to max_packets datagrams per call into fixed slots of one
+    preallocated arena, with a single recvmmsg() on Linux and a non-blocking
+    recv_into() loop elsewhere.
+    '''
+    def __init__(self, sock, max_packets=MAX_BATCH_PACKETS,
+                 max_packet_size=MAX_DATAGRAM_SIZE, use_recvmmsg=True):
+        self.sock = sock
+        self.max_packets = max_packets
+        self.max_packet_size = max_packet_size
+        self.arena = bytearray(max_packets * max_packet_size)
+        self.view = memoryview(self.arena)
+        self.slots = [self.view[i*max_packet_size:(i+1)*max_packet_size]
+                      for i in range(max_packets)]
+        self.batches = 0
+        self.packets = 0
+        self.syscalls = 0
+
+        self.recvmmsg = None
+        if use_recvmmsg and _recvmmsg is not None:
+            self.recvmmsg = _recvmmsg
+            self._arena_ref, self._iovecs, self._msgs = _arena_messages(
+                self.arena, max_packets, max_packet_size)
+
+
+    def recv(self, timeout=None):
+        '''
+        Waits up to timeout seconds (forever if None) for a datagram and
+        returns every one already queued, up to max_packets, as memoryviews
+        into the arena.  They are only valid until the next recv().  Returns
+        an empty list on timeout.
+        '''
+        readable = select.select([self.sock], [], [], timeout)[0]
+        if not readable:
+            return []
+        if self.recvmmsg is not None:
+            packets = self._recv_recvmmsg()
+        else:
+            packets = self._recv_loop()
+        if packets:
+            self.batches += 1
+            self.packets += len(packets)
+        return packets
+
+
+    def _recv_recvmmsg(self):
+        while True:
+            self.syscalls += 1
+            result = self.recvmmsg(self.sock.fileno(),
+                                   ctypes.addressof(self._msgs),
+                                   self.max_packets, MSG_DONTWAIT, None)
+            if result >= 0:
+                break
+            value = ctypes.get_errno()
+            if value == errno.EINTR:
+                continue
+            if value in WOULD_BLOCK:
+                return []
+            raise socket.error(value, os.strerror(value))
+        msgs = self._msgs
+        slots = self.slots
+        return [slots[i][:msgs[i].msg_len] for i in range(result)]
+
+
+    def _recv_loop(self):
+        #MSG_DONTWAIT is not portable, select() says what will not block
+        packets = []
+        sock = self.sock
+        for slot in self.slots:
+            if packets and not select.select([sock], [], [], 0)[0]:
+                break
+            self.syscalls += 1
+            packets.append(slot[:sock.recv_into(slot)])
+        return packets
+
+
+def benchmark(packets=100000, per_batch=5, size=24, use_sendmmsg=True):
+    '''
+    Packets per second through a batch of per_batch packets, and through one
+    send() per packet, to a local UDP sink.  Returns (batched, unbatched).
+    '''
+    sink = socket.socket(type=socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sink.setblocking(False)
+    sock = socket.socket(type=socket.SOCK_DGRAM)
+    sock.connect(sink.getsockname())
+    package = bytearray(size)
+
+    def drain():
+        try:
+            while True:
+                sink.recv(2048)
+        except socket.error:
+            pass
+
+    batch = send_batch(sock, use_sendmmsg=use_sendmmsg)
+    start = time.time()
+    for i in range(packets // per_batch):
+        for j in range(per_batch):
+            batch.append(package)
+        batch.flush()
+        drain()
+    batched = packets / (time.time() - start)
+
+    start = time.time()
+    for i in range(packets // per_batch):
+        for j in range(per_batch):
+            sock.send(package)
+        drain()
+    unbatched = packets / (time.time() - start)
+
+    sock.close()
+    sink.close()
+    return batched, unbatched
+
+
+if __name__ == "__main__":
+    batched, unbatched = benchmark()
+    mode = "sendmmsg" if _sendmmsg is not None else "send loop"
+    print("batched (%s): %.0f packets/s" % (mode, batched))
+    print("one send per packet: %.0f packets/s" % unbatched)
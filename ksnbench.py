@@ -0,0 +1,459 @@
+#! /usr/bin/env python
+'''
+Benchmarks for ksnsend, offline on loopback only.
+
+    encode      time per call of every ksn_send.send_* method, packets
+                handed to a socket that drops them
+    send        packets per second through ksn_send to a local UDP sink,
+                one sendto per packet and batched
+    scheduler   lateness of a deadline_scheduler task at several rates
+    units       CPU per simulated unit for ksnfanout workers driving 1, 10
+                and 50 units, each with its own encoding
+
+The results are written as JSON, one entry per metric:
+
+    {"format": 1, "python": "3.11.7", "platform": "...",
+     "results": {"encode.send_gps_time_mark": {"value": 1.9, "unit": "us",
+                                               "better": "lower"}, ...}}
+
+Every suite runs --repeat times and each value is the median of the runs
+(all of them are kept in "runs"), so one disturbed run does not move it.
+
+--compare checks the results against a stored baseline, flagging every
+metric more than its threshold percent worse; the exit status is 1 when
+one is.  The threshold is --threshold unless a --metricthreshold pattern
+or METRIC_THRESHOLDS matches the metric first.  Tail metrics (max, p99,
+overruns) hinge on single scheduling hiccups, so by default they are only
+reported ("off").  A metric whose runs overlap the runs of the baseline
+is within the noise of the machine and is not flagged either.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import timeit
+import fnmatch
+import platform
+import optparse
+import threading
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import ksnsend
+import ksnsched
+import ksnstats
+import ksnfanout
+import ksntraffic
+
+FORMAT_VERSION = 1
+SUITES = ["encode", "send", "scheduler", "units"]
+LOWER = "lower"
+HIGHER = "higher"
+SINK_HOST = "127.0.0.1"
+DEFAULT_REPEAT = 3
+#metric name pattern: percent worse that is a regression, None to report
+#the change only; the first match wins, --metricthreshold ones go first
+METRIC_THRESHOLDS = [
+    #sub-microsecond calls, swayed by the cache and frequency state
+    ("encode.*", 25.0),
+    ("scheduler.*.max", None),
+    ("scheduler.*.overruns", None),
+    ("scheduler.*.p99", None),
+]
+
+#send_* method: arguments, None for the frames of TRAFFIC_INTRUDERS
+#intruders moved and encoded at every call
+ENCODER_CASES = [
+    ("send_block_iof", (1, 1, 1, 1, 1)),
+    ("send_unblock_iof", (1, 1, 1, 1, 1)),
+    ("send_pxpress_3a", ()),
+    ("send_gps_time_mark", (38.9, -94.7, 5355.0, 0.5, 140.0, 500.0)),
+    ("send_gps_time_mark_si", (0.68, -1.65, 1632.0, 0.5, 72.0, 2.5)),
+    ("send_pxpress_31", ()),
+    ("send_shadin_barro_uncorr_alt", (5355.0,)),
+    ("send_a429_barro_uncorr_alt", (5355.0,)),
+    ("send_a429_barro_corr_alt", (5355.0,)),
+    ("send_a429_true_airspeed", (140.0,)),
+    ("send_ahrs_mag_heading_angle", (90.0,)),
+    ("send_ahrs_true_heading_angle", (92.0,)),
+    ("send_magvar", (2.0,)),
+    ("send_ias", (120.0,)),
+    ("send_trfc_duplicates", ()),
+    ("send_trfc_comp_unit", ()),
+    ("send_trfc_unavailable", (0,)),
+    ("send_trfc_standby", (0,)),
+    ("send_trfc_operating", (0,)),
+    ("send_trfc_coast", (13, 0)),
+    ("send_trfc_test", (0,)),
+    ("send_trfc_frames", None),
+    ("send_TAWS_warning_popup", ()),
+    ("send_TAWS_caution_popup", ()),
+    ("send_TAWS_clear_inhibit_popup", ()),
+    ("send_fms_rtc", (2024, 1, 2, 3, 4, 5)),
+    ("send_vor_id", ("MKC",)),
+]
+SCHEDULER_RATES = [5, 20, 100, 500, 1000]
+UNIT_COUNTS = [1, 10, 50]
+TRAFFIC_INTRUDERS = 100
+
+
+class null_socket(object):
+    '''Takes the packets of a ksn_send and drops them'''
+    def sendto(self, package, address):
+        pass
+
+
+    def close(self):
+        pass
+
+
+def cpu_time():
+    '''User and system CPU seconds of this process, os.times() only counts
+    whole clock ticks'''
+    process_time = getattr(time, "process_time", None)
+    if process_time is not None:
+        return process_time()
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    times = os.times()
+    return times[0] + times[1]
+
+
+def result(value, unit, better=LOWER):
+    return {"value": value, "unit": unit, "better": better}
+
+
+def bench_encode(quick=False):
+    '''Microseconds per call of every send_* method, best of 3 runs'''
+    number = 2000 if quick else 20000
+    sender = ksnsend.ksn_send(SINK_HOST, 0, sock=null_socket())
+    results = {}
+    for name, args in ENCODER_CASES:
+        method = getattr(sender, name)
+        if args is None:
+            engine = ksntraffic.traffic_engine(
+                ksntraffic.random_intruders(TRAFFIC_INTRUDERS, 0))
+            call = lambda: method(engine.update())
+        else:
+            call = lambda: method(*args)
+        best = min(timeit.repeat(call, number=number, repeat=3))
+        results["encode." + name] = result(best / number * 1e6, "us")
+    missing = [name for name in dir(ksnsend.ksn_send)
+               if name.startswith("send_") and
+               name not in dict(ENCODER_CASES)]
+    if missing:
+        print("no encode case for %s" % ", ".join(missing))
+    return results
+
+
+def _sink():
+    sink = socket.socket(type=socket.SOCK_DGRAM)
+    sink.bind((SINK_HOST, 0))
+    sink.setblocking(False)
+    return sink
+
+
+def _drain(sink):
+    try:
+        while True:
+            sink.recv(2048)
+    except socket.error:
+        pass
+
+
+def bench_send(quick=False):
+    '''
+    Packets per second through ksn_send to a loopback sink that is drained
+    every tick of 5 packets, so the receive buffer never drops any
+    '''
+    ticks = 2000 if quick else 20000
+    results = {}
+    for batch in (False, True):
+        sink = _sink()
+        host, port = sink.getsockname()
+        sender = ksnsend.ksn_send(host, port, batch=batch)
+        start = time.time()
+        for i in range(ticks):
+            sender.send_a429_true_airspeed(140.0)
+            sender.send_a429_barro_corr_alt(5355.0)
+            sender.send_ahrs_mag_heading_angle(90.0)
+            sender.send_ahrs_true_heading_angle(92.0)
+            sender.send_gps_time_mark_si(0.68, -1.65, 1632.0, 0.5, 72.0, 2.5)
+            sender.flush()
+            _drain(sink)
+        elapsed = time.time() - start
+        sender.close()
+        sink.close()
+        name = "send.batched" if batch else "send.sendto"
+        results[name] = result(5 * ticks / elapsed, "packets/s", HIGHER)
+    return results
+
+
+def bench_scheduler(quick=False):
+    '''Lateness of one task per rate (Hz), p50, p99 and max in us'''
+    duration = 0.5 if quick else 2.0
+    results = {}
+    for rate in SCHEDULER_RATES:
+        histogram = ksnstats.latency_histogram()
+        scheduler = ksnsched.deadline_scheduler()
+        task = ksnsched.periodic_task("bench", 0, 1.0 / rate, None)
+        clock = scheduler.clock
+
+        def run(task=task, histogram=histogram):
+            deadline = task.deadline(scheduler.epoch)
+            histogram.record(int((clock() - deadline) * 1e6))
+        task.callback = run
+        scheduler.add(task)
+        scheduler.run(max(duration, 5.0 / rate))
+        name = "scheduler.%dhz." % rate
+        results[name + "p50"] = result(histogram.percentile(50.0), "us")
+        results[name + "p99"] = result(histogram.percentile(99.0), "us")
+        results[name + "max"] = result(histogram.max, "us")
+        results[name + "overruns"] = result(task.overruns, "count")
+    return results
+
+
+def bench_units(quick=False):
+    '''
+    Percent of a core per unit for one thread worker sending the ksnsend
+    defaults to every unit, each with its own encoding
+    '''
+    duration = 1.0 if quick else 5.0
+    results = {}
+    for units in UNIT_COUNTS:
+        sinks = [_sink() for i in range(units)]
+        plan = []
+        for sink in sinks:
+            host, port = sink.getsockname()
+            options = ksnsend.parse_command_line(
+                ["--host", host, "--port", str(port), "--nocleanup"])
+            plan.append((options, [(host, port)]))
+        stop = threading.Event()
+        start = cpu_time()
+        wall = time.time()
+        counters, error = ksnfanout.run_worker(plan, duration, stop)
+        cpu = cpu_time() - start
+        wall = time.time() - wall
+        for sink in sinks:
+            sink.close()
+        if error is not None:
+            raise RuntimeError("units.%d: %s" % (units, error))
+        packets = sum(counter[0] for counter in counters.values())
+        name = "units.%d." % units
+        results[name + "cpu_percent_per_unit"] = \
+            result(100.0 * cpu / wall / units, "%")
+        results[name + "packets_per_unit_per_second"] = \
+            result(packets / wall / units, "packets/s", HIGHER)
+    return results
+
+
+BENCHMARKS = {
+    "encode": bench_encode,
+    "send": bench_send,
+    "scheduler": bench_scheduler,
+    "units": bench_units,
+}
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run(suites, quick=False, repeat=DEFAULT_REPEAT):
+    '''Runs every suite repeat times, each value the median of the runs'''
+    results = {}
+    for suite in suites:
+        runs = []
+        for i in range(repeat):
+            print("running %s (%d of %d)..." % (suite, i + 1, repeat))
+            runs.append(BENCHMARKS[suite](quick))
+        for name in runs[0]:
+            values = [suite_run[name]["value"] for suite_run in runs]
+            results[name] = dict(runs[0][name], value=median(values),
+                                 runs=values)
+    return {
+        "format": FORMAT_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": quick,
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def parse_threshold(text):
+    '''"PATTERN=PERCENT" or "PATTERN=off" -> (pattern, percent or None)'''
+    pattern, sep, percent = text.partition("=")
+    if not sep or not pattern:
+        raise ValueError("%r is not PATTERN=PERCENT" % text)
+    if percent == "off":
+        return pattern, None
+    return pattern, float(percent)
+
+
+def metric_threshold(name, threshold, thresholds=()):
+    '''The percent worse name may be, None if it is not checked'''
+    for pattern, percent in list(thresholds) + METRIC_THRESHOLDS:
+        if fnmatch.fnmatchcase(name, pattern):
+            return percent
+    return threshold
+
+
+def _separated(old, new, better):
+    '''Whether every run of new is worse than every run of old, True when
+    either has no runs recorded'''
+    old_runs = old.get("runs") or [old["value"]]
+    new_runs = new.get("runs") or [new["value"]]
+    if len(old_runs) < 2 or len(new_runs) < 2:
+        return True
+    if better == HIGHER:
+        return max(new_runs) < min(old_runs)
+    return min(new_runs) > max(old_runs)
+
+
+def compare(baseline, current, threshold, thresholds=()):
+    '''
+    [(name, baseline value, current value, percent worse, threshold,
+    regressed)] for every metric in both, worse being positive whichever
+    way is better and threshold None for the metrics only reported.  A
+    metric only regresses past its threshold with runs that do not overlap
+    the baseline runs.
+    '''
+    rows = []
+    for name in sorted(current["results"]):
+        if name not in baseline["results"]:
+            continue
+        old = baseline["results"][name]["value"]
+        new = current["results"][name]["value"]
+        better = current["results"][name]["better"]
+        if old == new:
+            change = 0.0
+        elif old == 0:
+            change = float("inf")
+        else:
+            change = 100.0 * (new - old) / abs(old)
+        if better == HIGHER:
+            change = -change
+        limit = metric_threshold(name, threshold, thresholds)
+        regressed = (limit is not None and change > limit and
+                     _separated(baseline["results"][name],
+                                current["results"][name], better))
+        rows.append((name, old, new, change, limit, regressed))
+    return rows
+
+
+def print_results(report):
+    for name in sorted(report["results"]):
+        entry = report["results"][name]
+        print("%-52s %14.3f %s" % (name, entry["value"], entry["unit"]))
+
+
+def print_comparison(rows):
+    print("%-44s %12s %12s %9s %7s" % ("metric", "baseline", "current",
+                                       "worse", "limit"))
+    for name, old, new, change, limit, regressed in rows:
+        print("%-44s %12.3f %12.3f %8.1f%% %7s %s" %
+              (name, old, new, change,
+               "off" if limit is None else "%g%%" % limit,
+               "REGRESSION" if regressed else ""))
+    regressions = sum(1 for row in rows if row[5])
+    checked = sum(1 for row in rows if row[4] is not None)
+    print("%d of %d checked metrics worse than their limit, %d reported "
+          "only" % (regressions, checked, len(rows) - checked))
+    return regressions
+
+
+def setup_command_line():
+    usage = """usage: %prog [options]
+
+    Runs the ksnsend benchmarks on loopback and prints or stores the
+    results, optionally comparing them with a baseline."""
+    parser = optparse.OptionParser(usage=usage)
+    help = "Comma separated suites to run, of %s. [default:%%default]" % \
+        ",".join(SUITES)
+    parser.add_option(  "--suites", action="store", dest="suites",
+                        help=help, default=",".join(SUITES));
+    help = "If true, shorter runs for a quick check. [default:%default]"
+    parser.add_option(  "--quick", action="store_true", dest="quick",
+                        help=help, default=False);
+    help = "Writes the results as JSON to this file."
+    parser.add_option(  "--output", action="store", dest="output",
+                        help=help);
+    help = "Compares the results with this JSON baseline."
+    parser.add_option(  "--compare", action="store", dest="baseline",
+                        help=help);
+    help = "Compares this JSON file instead of running the benchmarks."
+    parser.add_option(  "--input", action="store", dest="input",
+                        help=help);
+    help = "Percent a metric may be worse than the baseline. "
+    help += "[default:%default]"
+    parser.add_option(  "--threshold", action="store", dest="threshold",
+                        help=help, type="float", default=10.0);
+    help = "PATTERN=PERCENT (or PATTERN=off) threshold for the metrics "
+    help += "matching the fnmatch PATTERN, e.g. 'encode.*=25'.  Repeat for "
+    help += "more, the first match wins."
+    parser.add_option(  "--metricthreshold", action="append",
+                        dest="metric_thresholds", help=help, default=[]);
+    help = "Times every suite is run, the median is reported. "
+    help += "[default:%default]"
+    parser.add_option(  "--repeat", action="store", dest="repeat",
+                        help=help, type="int", default=DEFAULT_REPEAT);
+    return parser
+
+
+def main():
+    parser = setup_command_line()
+    (options, args) = parser.parse_args()
+    suites = [suite for suite in options.suites.split(",") if suite]
+    for suite in suites:
+        if suite not in SUITES:
+            parser.error("unknown suite %r" % suite)
+    if options.input != None and options.baseline == None:
+        parser.error("--input needs --compare")
+    if options.repeat < 1:
+        parser.error("repeat must be greater than 0")
+    try:
+        thresholds = [parse_threshold(text)
+                      for text in options.metric_thresholds]
+    except ValueError as error:
+        parser.error(str(error))
+
+    if options.input != None:
+        with open(options.input) as input_file:
+            report = json.load(input_file)
+    else:
+        report = run(suites, options.quick, options.repeat)
+        print_results(report)
+    if options.output != None:
+        with open(options.output, "w") as output_file:
+            json.dump(report, output_file, indent=1, sort_keys=True)
+
+    if options.baseline != None:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("format") != FORMAT_VERSION:
+            sys.exit("error: %s is not a format %d baseline" %
+                     (options.baseline, FORMAT_VERSION))
+        if bool(baseline.get("quick")) != bool(report.get("quick")):
+            print("warning: comparing a --quick run with a full one")
+        if baseline.get("python") != report.get("python"):
+            print("warning: baseline from python %s, results from python %s" %
+                  (baseline.get("python"), report.get("python")))
+        if print_comparison(compare(baseline, report, options.threshold,
+                                    thresholds)):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
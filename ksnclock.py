@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+'''
+Clocks for ksnsend runs.
+
+Every clock has now() (monotonic seconds, for the scheduler deadlines and
+the models), sleep(seconds) and localtime(), the calendar time the GPS time
+mark and the FMS RTC are sent with:
+
+    real_clock      the monotonic clock and time.localtime()
+    virtual_clock   sleep() jumps straight to the end of the sleep, so a run
+                    takes only the time to send its packets and is the same
+                    packets at the same clock times every run
+    scaled_clock    speed times faster (or slower) than real time
+
+The calendar time of the virtual and scaled clocks starts at start (seconds
+since the epoch, the current time by default) and moves with the clock.
+
+    clock = ksnclock.virtual_clock(start=ksnclock.parse_start(
+        "2024-01-02T03:04:05"))
+    scheduler = ksnsched.deadline_scheduler(clock=clock.now,
+                                            sleep=clock.sleep)
+'''
+
+import time
+
+import ksnsched
+
+CLOCKS = ["real", "virtual", "scaled"]
+START_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class real_clock(object):
+    '''Wall clock time'''
+    def now(self):
+        return ksnsched.monotonic()
+
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+    def localtime(self):
+        return time.localtime()
+
+
+class virtual_clock(object):
+    '''Time that only moves when something sleeps'''
+    def __init__(self, start=None):
+        self.start = time.time() if start is None else start
+        self.time = 0.0
+
+
+    def now(self):
+        return self.time
+
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.time += seconds
+
+
+    def localtime(self):
+        return time.localtime(self.start + self.time)
+
+
+class scaled_clock(object):
+    '''Real time times speed, sleeps are speed times shorter'''
+    def __init__(self, speed, start=None):
+        if speed <= 0:
+            raise ValueError("speed must be > 0 (got %r)" % speed)
+        self.speed = float(speed)
+        self.start = time.time() if start is None else start
+        self._epoch = ksnsched.monotonic()
+
+
+    def now(self):
+        return (ksnsched.monotonic() - self._epoch) * self.speed
+
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds / self.speed)
+
+
+    def localtime(self):
+        return time.localtime(self.start + self.now())
+
+
+def parse_start(text):
+    '''Seconds since the epoch of a local "YYYY-MM-DDTHH:MM:SS"'''
+    try:
+        return time.mktime(time.strptime(text, START_FORMAT))
+    except ValueError:
+        raise ValueError("%r is not YYYY-MM-DDTHH:MM:SS" % text)
+
+
+def from_options(options):
+    '''The clock of the ksnsend --clock options'''
+    start = None
+    if options.clock_start != None:
+        start = parse_start(options.clock_start)
+    if options.clock == "virtual":
+        return virtual_clock(start)
+    if options.clock == "scaled":
+        return scaled_clock(options.clock_speed, start)
+    return real_clock()
@@ -0,0 +1,403 @@
+#! /usr/bin/env python
+'''
+Live option updates for a running ksnsend.
+
+ksnsend --control PORT (a UDP port on localhost) or --control PATH (an
+AF_UNIX datagram socket) takes updates written as ksnsend options:
+
+    ksncontrol.py 3490 --altitude 8000 --traffictype n --intrudertype ta
+    ksncontrol.py 3490 --clear tawspopup
+
+An update is checked like the command line and applied whole or not at all,
+between two ticks of the scheduler, so the labels never stop going out.
+Only the options the label groups read while running may change
+(LIVE_OPTIONS), and not the ones a trajectory or the dead reckoning model
+already sets.  The labels keep their cached packets, only the ones whose
+values changed are encoded again.  --clear NAME drops an option that has no
+default, e.g. the TAWS popup or the traffic type.
+
+An update is one datagram, its id and the options separated by NULs.  The
+reply is "ok ID MICROSECONDS" once applied, the time from its receipt to the
+tick that applied it (at most the gap between two label groups, 100 ms with
+the default intervals), or "error ID MESSAGE".  The ticks never wait for a
+reply, the ones a client does not read in time are dropped.  A "stats"
+datagram is answered with the JSON snapshot of the update rate and apply
+latency.
+
+    client = ksncontrol.control_client(3490)
+    client.update("--altitude", "8000")     #waits until applied
+'''
+
+from __future__ import print_function
+import os
+import sys
+import errno
+import json
+import stat
+import socket
+import select
+import optparse
+import threading
+import collections
+
+import ksnsched
+import ksnstats
+
+CONTROL_HOST = "127.0.0.1"
+MAX_UPDATE_SIZE = 4096
+SEPARATOR = "\0"
+STATS_REQUEST = "stats"
+POLL_INTERVAL = 0.1
+REPLY_TIMEOUT = 5.0
+#room for a burst of updates, and of their replies
+RECEIVE_BUFFER = 1 << 20
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+#the options the label groups read at every send
+LIVE_OPTIONS = frozenset([
+    "lat", "lon", "alt", "ground_speed", "ground_track", "vertical_speed",
+    "barro_corr_alt", "barro_uncorr_alt", "true_airspeed", "magheading",
+    "shadin_uncorr_alt", "trueheading", "magvar", "ias", "traffic_type",
+    "intruder_type", "intruders", "intruder_seed", "intruders_per_frame",
+    "coast_age", "taws_popup", "vor_id", "fms_clock", "fms_rtc_year",
+    "fms_rtc_month", "fms_rtc_day", "fms_rtc_hour", "fms_rtc_min",
+    "fms_rtc_sec"])
+#sampled from the trajectory or the model when there is one
+STATE_OPTIONS = frozenset([
+    "lat", "lon", "alt", "ground_speed", "ground_track", "vertical_speed",
+    "barro_corr_alt", "barro_uncorr_alt", "true_airspeed", "magheading",
+    "trueheading"])
+#--clear NAME: the options whose label is not blocked, so they can stop
+CLEARABLE = {
+    "tawspopup": "taws_popup",
+    "traffictype": "traffic_type",
+    "barrouncorralt": "barro_uncorr_alt",
+    "shadinuncorralt": "shadin_uncorr_alt",
+}
+
+
+def parse_address(text):
+    '''The UDP port of a number, otherwise the AF_UNIX socket path'''
+    if isinstance(text, int):
+        port = text
+    elif text.isdigit():
+        port = int(text)
+    elif text:
+        return text
+    else:
+        raise ValueError("empty control address")
+    if not 0 < port < 65536:
+        raise ValueError("port %d is not in [1,65535]" % port)
+    return port
+
+
+def _raise_error(message):
+    raise ValueError(message)
+
+
+class update_parser(object):
+    '''
+    Parses an update into new options with parser, a ksnsend option parser,
+    and checks them with check(parser, options)
+    '''
+    def __init__(self, parser, check):
+        #its errors raise instead of exiting
+        parser.error = _raise_error
+        self.parser = parser
+        self.check = check
+
+
+    def parse(self, args, options, state=False):
+        '''(new options, names of the changed options) of the update args
+        to options.  state says if a trajectory or model sets the position,
+        altitude, speeds and headings.'''
+        cleared = []
+        rest = []
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg == "--clear":
+                if not args:
+                    raise ValueError("--clear needs an option name")
+                name = args.pop(0).lstrip("-")
+                if name not in CLEARABLE:
+                    raise ValueError("--clear: %s is not one of %s" %
+                                     (name, ", ".join(sorted(CLEARABLE))))
+                cleared.append(CLEARABLE[name])
+            else:
+                rest.append(arg)
+        #the append options are the only mutable values
+        new = optparse.Values(dict(
+            (name, list(value) if isinstance(value, list) else value)
+            for name, value in vars(options).items()))
+        for name in cleared:
+            setattr(new, name, None)
+        if "-h" in rest or "--help" in rest:
+            raise ValueError("--help is not an update")
+        new, extra = self.parser.parse_args(rest, new)
+        if extra:
+            raise ValueError("unexpected arguments: %s" % " ".join(extra))
+        changed = [name for name, value in vars(new).items()
+                   if getattr(options, name, None) != value]
+        fixed = [name for name in changed if name not in LIVE_OPTIONS]
+        if fixed:
+            raise ValueError("cannot change while running: %s" %
+                             ", ".join(sorted(fixed)))
+        if state:
+            sampled = [name for name in changed if name in STATE_OPTIONS]
+            if sampled:
+                raise ValueError("set by the trajectory or model: %s" %
+                                 ", ".join(sorted(sampled)))
+        self.check(self.parser, new)
+        return new, changed
+
+
+class control_stats(object):
+    '''Updates applied and rejected, and the apply latency histogram'''
+    def __init__(self, clock=ksnsched.monotonic):
+        self.clock = clock
+        self.start = clock()
+        self.updates = 0
+        self.rejected = 0
+        self.latency = ksnstats.latency_histogram()
+
+
+    def snapshot(self):
+        elapsed = max(self.clock() - self.start, 1e-9)
+        return {
+            "elapsed": elapsed,
+            "updates": self.updates,
+            "rejected": self.rejected,
+            "updates_per_second": self.updates / elapsed,
+            "latency_us": self.latency.summary(),
+        }
+
+
+    def summary(self):
+        snapshot = self.snapshot()
+        latency = snapshot["latency_us"]
+        return ("%d updates %.1f updates/s, %d rejected  apply latency p50 "
+                "%.2f ms, p99 %.2f ms, max %.2f ms" %
+                (snapshot["updates"], snapshot["updates_per_second"],
+                 snapshot["rejected"], latency["p50"] / 1000.0,
+                 latency["p99"] / 1000.0, latency["max"] / 1000.0))
+
+
+def _socket(family):
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+    except socket.error:
+        pass
+    return sock
+
+
+def _bind(address):
+    '''A datagram socket bound to a local port or socket path'''
+    if isinstance(address, int):
+        sock = _socket(socket.AF_INET)
+        sock.bind((CONTROL_HOST, address))
+        return sock, "udp:%s:%d" % sock.getsockname()
+    if not hasattr(socket, "AF_UNIX"):
+        raise ValueError("AF_UNIX sockets are not available here")
+    #a socket left behind by a previous run
+    try:
+        if stat.S_ISSOCK(os.stat(address).st_mode):
+            os.remove(address)
+    except OSError:
+        pass
+    sock = _socket(socket.AF_UNIX)
+    sock.bind(address)
+    return sock, "unix:%s" % address
+
+
+class control_server(object):
+    '''
+    Receives the updates for scenario (a ksnsend.ksn_scenario) from a
+    daemon thread and keeps them until apply(), which the scheduler calls
+    between two ticks.  parser and check default to the ksnsend ones.
+    '''
+    def __init__(self, address, scenario, parser=None, check=None,
+                 clock=ksnsched.monotonic):
+        if parser is None:
+            import ksnsend
+            parser = ksnsend.setup_command_line()
+            check = ksnsend.check_options
+        self.address = parse_address(address)
+        self.scenario = scenario
+        self.clock = clock
+        self.parser = update_parser(parser, check)
+        self.stats = control_stats(clock)
+        #the options once every update received is applied
+        self.latest = scenario.options
+        #(id, options, changed, receipt time, reply address)
+        self.pending = collections.deque()
+        self.sock, self.name = _bind(self.address)
+        #a reply must never hold up the ticks
+        self.sock.setblocking(False)
+        self._running = True
+        self._thread = threading.Thread(target=self._receive_loop,
+                                        name="ksncontrol")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _receive_loop(self):
+        sock = self.sock
+        while self._running:
+            try:
+                if not select.select([sock], [], [], POLL_INTERVAL)[0]:
+                    continue
+                data, address = sock.recvfrom(MAX_UPDATE_SIZE)
+            except socket.error as error:
+                if error.args[0] in WOULD_BLOCK:
+                    continue
+                #closed by close()
+                return
+            except (ValueError, select.error):
+                return
+            self.receive(data, address, self.clock())
+
+
+    def receive(self, data, address, now):
+        '''Checks one update datagram and queues it for apply()'''
+        try:
+            fields = data.decode("utf-8").split(SEPARATOR)
+        except UnicodeDecodeError:
+            self.stats.rejected += 1
+            self._reply(address, "error ? not UTF-8")
+            return
+        if fields == [STATS_REQUEST]:
+            self._reply(address, json.dumps(self.stats.snapshot(),
+                                            sort_keys=True))
+            return
+        update_id = fields[0]
+        try:
+            options, changed = self.parser.parse(
+                fields[1:], self.latest, self.scenario.state is not None)
+        except ValueError as error:
+            self.stats.rejected += 1
+            self._reply(address, "error %s %s" % (update_id, error))
+            return
+        self.latest = options
+        self.pending.append((update_id, options, changed, now, address))
+
+
+    def apply(self):
+        '''Applies the updates received so far, in order'''
+        pending = self.pending
+        while pending:
+            update_id, options, changed, received, address = pending.popleft()
+            self.scenario.update(options, changed)
+            latency = self.clock() - received
+            self.stats.updates += 1
+            self.stats.latency.record(int(latency * 1e6))
+            self._reply(address, "ok %s %d" % (update_id, latency * 1e6))
+
+
+    def _reply(self, address, text):
+        #unbound AF_UNIX clients cannot be answered, and the replies a
+        #client does not read in time are dropped
+        if not address:
+            return
+        try:
+            self.sock.sendto(text.encode("utf-8"), address)
+        except socket.error:
+            pass
+
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self.sock.close()
+        if not isinstance(self.address, int):
+            try:
+                os.remove(self.address)
+            except OSError:
+                pass
+
+
+class control_client(object):
+    '''Sends updates to a ksnsend --control address'''
+    def __init__(self, address, timeout=REPLY_TIMEOUT):
+        address = parse_address(address)
+        if isinstance(address, int):
+            self.sock = _socket(socket.AF_INET)
+            self.sock.connect((CONTROL_HOST, address))
+        else:
+            self.sock = _socket(socket.AF_UNIX)
+            #an abstract address (Linux) to get the replies on
+            self.sock.bind("")
+            self.sock.connect(address)
+        self.sock.settimeout(timeout)
+        self._next_id = 0
+
+
+    def send(self, *args):
+        '''Sends an update without waiting, returns its id'''
+        self._next_id += 1
+        update_id = str(self._next_id)
+        self.sock.send(SEPARATOR.join((update_id,) + args).encode("utf-8"))
+        return update_id
+
+
+    def receive(self):
+        '''(id, True, microseconds) for an applied update, (id, False,
+        message) for a rejected one'''
+        reply = self.sock.recv(MAX_UPDATE_SIZE).decode("utf-8")
+        result, update_id, value = reply.split(" ", 2)
+        if result == "ok":
+            return update_id, True, int(value)
+        return update_id, False, value
+
+
+    def update(self, *args):
+        '''Sends an update and waits until it is applied, returns the apply
+        latency in microseconds or raises ValueError with why it was
+        rejected'''
+        update_id = self.send(*args)
+        while True:
+            reply_id, applied, value = self.receive()
+            if reply_id == update_id:
+                break
+        if not applied:
+            raise ValueError(value)
+        return value
+
+
+    def stats(self):
+        '''The JSON snapshot of the server stats'''
+        self.sock.send(STATS_REQUEST.encode("ascii"))
+        while True:
+            reply = self.sock.recv(MAX_UPDATE_SIZE).decode("utf-8")
+            if reply.startswith("{"):
+                return json.loads(reply)
+
+
+    def close(self):
+        self.sock.close()
+
+
+def main():
+    '''ADDRESS [options] applies an update, ADDRESS alone prints the
+    stats'''
+    if len(sys.argv) < 2:
+        print("usage: %s PORT|PATH [ksnsend options]" % sys.argv[0])
+        sys.exit(2)
+    client = control_client(sys.argv[1])
+    try:
+        if len(sys.argv) == 2:
+            print(json.dumps(client.stats(), indent=1, sort_keys=True))
+            return
+        try:
+            latency = client.update(*sys.argv[2:])
+        except ValueError as error:
+            sys.exit("error: %s" % error)
+        print("applied in %.2f ms" % (latency / 1000.0))
+    except socket.timeout:
+        sys.exit("error: no reply from %s" % sys.argv[1])
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
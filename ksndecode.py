@@ -0,0 +1,304 @@
+#! /usr/bin/env python
+'''
+Decoder for every IOF label ksnsend sends, and a UDP sink that stands in for
+the KSN unit.
+
+decode() dispatches on (label, packet size) through LAYOUTS, which holds the
+decoder generated by the ksnlabels registry for every label (the record is
+named after the label, its fields are the registry fields), with a few
+custom ones for the channel status pairs, the traffic intruders and the VOR
+ident.  The traffic and ARINC spare labels are told apart by their size,
+traffic frames of any other intruder count are decoded too, the IOF control
+commands are text.
+
+    sink = ksn_sink("127.0.0.1", 3471)
+    sink.run(10)
+    sink.latest[ksnlabels.IOF_GPS_TIME_MARK_INFO].latitude
+
+ksn_sink receives with recvmmsg() batches (see ksnbatch.recv_batch) and
+keeps the latest record, the packet count and the arrival time of every
+label.  The callables in its listeners are called with the label and record
+of every packet decoded (see ksnwait.event_waiter.watch).
+'''
+
+from __future__ import print_function
+import time
+import socket
+import struct
+import optparse
+import collections
+
+import ksnlabels
+import ksnsched
+import ksnbatch
+
+LABEL_FORMAT = struct.Struct("!H")
+
+gps_channel_status = collections.namedtuple("gps_channel_status", [
+    "message", "channels", "status"])
+traffic = collections.namedtuple("traffic", [
+    "discrete", "rts", "intruders", "etx"])
+vor_id = collections.namedtuple("vor_id", ["ident"])
+iof_command = collections.namedtuple("iof_command", ["command", "labels"])
+
+
+class decode_error(Exception):
+    pass
+
+
+def _channel_status(entry):
+    unpack_from = entry.layout.unpack_from
+    def decode(package):
+        values = unpack_from(package)
+        channels = values[2]
+        #channel number and status pairs
+        status = tuple(zip(values[3:3+2*channels:2],
+                           values[4:4+2*channels:2]))
+        return gps_channel_status(values[1], channels, status)
+    return decode
+
+
+def _traffic(entry):
+    unpack_from = entry.layout.unpack_from
+    def decode(package):
+        values = unpack_from(package)
+        #intruder range, altitude and bearing words between the RTS and ETX
+        words = values[3:-1]
+        intruders = tuple(words[i:i+3] for i in range(0, len(words), 3))
+        return traffic(values[1], values[2], intruders, values[-1])
+    return decode
+
+
+def _vor_id(entry):
+    unpack_from = entry.layout.unpack_from
+    def decode(package):
+        #sent reversed and NUL padded
+        ident = unpack_from(package)[1]
+        return vor_id(ident[::-1].rstrip(b"\0").decode("ascii"))
+    return decode
+
+
+#registry labels whose record is not just their fields
+CUSTOM_DECODERS = {
+    "gps_channel_status": _channel_status,
+    "traffic": _traffic,
+    "traffic_duplicates": _traffic,
+    "mmds_vor_ils_station_id": _vor_id,
+}
+
+#(label, packet size): decode(package) -> record
+LAYOUTS = {}
+
+
+def register(entry, decoder=None):
+    '''Decodes the packets of a ksnlabels entry, with its generated decoder
+    unless one is given'''
+    LAYOUTS[(entry.label, entry.size)] = decoder or entry.decoder
+
+
+for _entry in ksnlabels.LABELS:
+    _custom = CUSTOM_DECODERS.get(_entry.name)
+    register(_entry, _custom(_entry) if _custom else None)
+del _entry, _custom
+
+
+def _traffic_frame(size):
+    '''A decoder for traffic frames of size bytes with any number of
+    intruders (see ksntraffic), registered on first use'''
+    words, rest = divmod(size - LABEL_FORMAT.size, 4)
+    if rest or words < 6 or (words - 3) % 3:
+        return None
+    entry = ksnlabels.iof_label("traffic_frame", ksnlabels.TRAFFIC.label,
+                                [ksnlabels.field("word%d" % i, "I")
+                                 for i in range(words)])
+    decoder = _traffic(entry)
+    register(entry, decoder)
+    return decoder
+
+
+def decode_iof_command(package):
+    '''
+    "command\\0low-high\\0label..." after the label.  The labels are
+    returned as (low, high) ranges, a single label being (label, label).
+    '''
+    try:
+        text = bytes(package[LABEL_FORMAT.size:]).decode("ascii")
+        fields = text.split("\0")
+        labels = []
+        for field in fields[1:]:
+            low, sep, high = field.partition("-")
+            labels.append((int(low), int(high if sep else low)))
+    except (UnicodeDecodeError, ValueError):
+        raise decode_error("malformed IOF command %r" % bytes(package))
+    return iof_command(fields[0], tuple(labels))
+
+
+CONTROL_LABELS = (ksnlabels.IOF_MPC1_IOF_CONTROL,
+                  ksnlabels.IOF_MPC2_IOF_CONTROL)
+
+
+def decode(package):
+    '''(label, record) for a packet sent by ksn_send'''
+    if len(package) < LABEL_FORMAT.size:
+        raise decode_error("packet of %d bytes" % len(package))
+    label = LABEL_FORMAT.unpack_from(package)[0]
+    decoder = LAYOUTS.get((label, len(package)))
+    if decoder is None and label == ksnlabels.IOF_TRAFFIC_LABELS_RX:
+        decoder = _traffic_frame(len(package))
+    if decoder is not None:
+        return label, decoder(package)
+    if label in CONTROL_LABELS:
+        return label, decode_iof_command(package)
+    raise decode_error("unknown label %d or size %d" % (label, len(package)))
+
+
+class label_state(object):
+    '''The latest record of a label, when it came and how many did'''
+    __slots__ = ("record", "time", "count")
+
+    def __init__(self):
+        self.record = None
+        self.time = None
+        self.count = 0
+
+
+class ksn_sink(object):
+    '''
+    Receives and decodes what ksn_send sends to host:port.  latest maps
+    every label seen to its last record, state to its label_state.
+    '''
+    def __init__(self, host, port, max_packets=ksnbatch.MAX_BATCH_PACKETS,
+                 clock=ksnsched.monotonic):
+        self.sock = socket.socket(type=socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.receiver = ksnbatch.recv_batch(self.sock, max_packets)
+        self.clock = clock
+        self.latest = {}
+        self.state = {}
+        self.listeners = []
+        self.packets = 0
+        self.bytes = 0
+        self.errors = 0
+        self._running = False
+
+
+    def handle(self, package, now):
+        try:
+            label, record = decode(package)
+        except decode_error:
+            self.errors += 1
+            return
+        state = self.state.get(label)
+        if state is None:
+            state = self.state[label] = label_state()
+        state.record = record
+        state.time = now
+        state.count += 1
+        self.latest[label] = record
+        for listener in self.listeners:
+            listener(label, record)
+
+
+    def poll(self, timeout=None):
+        '''Receives and decodes one batch, returns the number of packets'''
+        packets = self.receiver.recv(timeout)
+        if packets:
+            now = self.clock()
+            handle = self.handle
+            for package in packets:
+                self.bytes += len(package)
+                handle(package, now)
+            self.packets += len(packets)
+        return len(packets)
+
+
+    def stop(self):
+        '''Makes run() return after the current batch'''
+        self._running = False
+
+
+    def run(self, duration=None, poll_interval=0.1):
+        '''Receives for duration seconds, or until stop()'''
+        end_time = None
+        if duration is not None:
+            end_time = self.clock() + duration
+        self._running = True
+        while self._running:
+            timeout = poll_interval
+            if end_time is not None:
+                timeout = min(timeout, end_time - self.clock())
+                if timeout <= 0:
+                    break
+            self.poll(timeout)
+        self._running = False
+
+
+    def close(self):
+        self.sock.close()
+
+
+def print_state(sink):
+    now = sink.clock()
+    for label in sorted(sink.state):
+        state = sink.state[label]
+        print("%5d %8d %6.2fs ago  %s" % (label, state.count, now - state.time,
+                                          state.record))
+
+
+def setup_command_line():
+    usage = """usage: %prog [options]
+
+    Receives and decodes the packets of ksnsend.py, standing in for a KSN
+    unit, and prints the latest value of every label."""
+    parser = optparse.OptionParser(usage=usage)
+    help = "The address to listen on. [default:%default]"
+    parser.add_option(  "--host", action="store", dest="host",
+                        help=help, default="127.0.0.1");
+    help = "The port to listen on. [default:%default]"
+    parser.add_option(  "--port", action="store", dest="port",
+                        help=help, type="int", default=3471);
+    help = "How many seconds to listen, forever by default."
+    parser.add_option(  "--timeout", action="store", dest="timeout",
+                        help=help, type="float");
+    help = "Seconds between the printouts of the label values, 0 for only "
+    help += "at the end. [default:%default]"
+    parser.add_option(  "--printinterval", action="store",
+                        dest="print_interval", help=help, type="float",
+                        default=5);
+    return parser
+
+
+def main():
+    parser = setup_command_line()
+    (options, args) = parser.parse_args()
+    sink = ksn_sink(options.host, options.port)
+    print("Listening on %s:%d" % sink.address)
+    print("Terminate with Ctrl-C")
+    start = time.time()
+    try:
+        if options.print_interval > 0:
+            #the printouts fall between batches, the sink never waits on them
+            while options.timeout is None or time.time() - start < \
+                    options.timeout:
+                duration = options.print_interval
+                if options.timeout is not None:
+                    duration = min(duration,
+                                   options.timeout - (time.time() - start))
+                sink.run(duration)
+                print_state(sink)
+        else:
+            sink.run(options.timeout)
+    except KeyboardInterrupt:
+        print("")
+    finally:
+        sink.close()
+    duration = max(time.time() - start, 1e-3)
+    if options.print_interval <= 0:
+        print_state(sink)
+    print("%d packets, %d bytes, %d undecodable, %.0f packets/s" %
+          (sink.packets, sink.bytes, sink.errors, sink.packets / duration))
+
+
+if __name__ == "__main__":
+    main()
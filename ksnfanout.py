@@ -0,0 +1,369 @@
+#! /usr/bin/env python
+'''
+Drives many KSN units/simulators from one process.
+
+Every --target is "host:port" optionally followed by ksnsend options that
+override the common ones for that target only, e.g.
+
+    ksnfanout.py --timeout 60 --target 10.0.0.1:3471 \\
+                 --target "10.0.0.2:3471 --altitude 8000 --traffictype n"
+
+Targets with identical options form a group whose packets are encoded once
+and sent to every member, each group with its own --trajectory or
+--deadreckoning ownship if it has one.  The targets are spread over
+--workers threads or processes, each with its own deadline scheduler, and
+the packets sent to each target are counted so a starved unit shows up in
+the summary.
+'''
+
+from __future__ import print_function
+import sys
+import time
+import errno
+import shlex
+import socket
+import threading
+import multiprocessing
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import ksnsend
+import ksnsched
+
+WORKER_MODES = ["thread", "process"]
+#options that do not change what is sent to a target
+NOT_ENCODED_OPTIONS = ["host", "port", "targets", "workers", "worker_mode",
+                       "nocleanup", "timeout", "batch", "record",
+                       "record_size", "stats", "stats_interval", "stats_file",
+                       "stats_port", "clock", "clock_speed", "clock_start",
+                       "transport", "transport_path", "ring_slots", "control"]
+IGNORED_ERRORS = (errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.ECONNREFUSED)
+STOP_POLL_INTERVAL = 0.1
+
+
+class target_counter(object):
+    '''Packets, bytes and ignored send errors for one target'''
+    __slots__ = ("packets", "bytes", "errors")
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.errors = 0
+
+
+class fanout_socket(object):
+    '''
+    Stands in for the socket of a ksn_send (see its sock argument) and sends
+    every packet to all the targets of a group.  An unreachable target is
+    counted and skipped so it does not hold up the others.
+    '''
+    def __init__(self, addresses, counters):
+        self.sock = socket.socket(type=socket.SOCK_DGRAM)
+        self.addresses = addresses
+        self.counters = [counters[address] for address in addresses]
+
+
+    def sendto(self, package, address):
+        size = len(package)
+        sendto = self.sock.sendto
+        for address, counter in zip(self.addresses, self.counters):
+            try:
+                sendto(package, address)
+            except socket.error as error:
+                if error.args[0] not in IGNORED_ERRORS:
+                    raise
+                counter.errors += 1
+                continue
+            counter.packets += 1
+            counter.bytes += size
+
+
+    def close(self):
+        self.sock.close()
+
+
+def parse_target(text):
+    '''"host:port [options]" -> ((host, port), [options])'''
+    fields = shlex.split(text)
+    if not fields:
+        raise ValueError("empty target")
+    host, sep, port = fields[0].rpartition(":")
+    if not sep or not host:
+        raise ValueError("target %r is not host:port" % fields[0])
+    return (host, int(port)), fields[1:]
+
+
+def encoding_key(options):
+    '''The options that change the packets, as a hashable key'''
+    #append options are lists
+    return tuple(sorted((name, tuple(value) if isinstance(value, list)
+                         else value)
+                        for name, value in vars(options).items()
+                        if name not in NOT_ENCODED_OPTIONS))
+
+
+def plan_workers(groups, workers):
+    '''
+    Spreads the targets of every group round robin over the workers.
+    groups is a list of (options, addresses), the result has one such list
+    per worker (a group split over several workers is encoded by each).
+    '''
+    plans = [[] for i in range(workers)]
+    next_worker = 0
+    for options, addresses in groups:
+        shares = [[] for i in range(workers)]
+        for address in addresses:
+            shares[next_worker].append(address)
+            next_worker = (next_worker + 1) % workers
+        for plan, share in zip(plans, shares):
+            if share:
+                plan.append((options, share))
+    return plans
+
+
+def _send_plan(plan, duration, stop, counters):
+    senders = []
+    scenarios = []
+    scheduler = ksnsched.deadline_scheduler()
+
+    def check_stop():
+        if stop.is_set():
+            scheduler.stop()
+    try:
+        try:
+            for options, addresses in plan:
+                for address in addresses:
+                    counters[address] = target_counter()
+                sock = fanout_socket(addresses, counters)
+                sender = ksnsend.ksn_send(addresses[0][0], addresses[0][1],
+                                          sock=sock)
+                senders.append(sender)
+                #one trajectory or dead-reckoning ownship per group, checked
+                #by group_targets
+                scenario = ksnsend.ksn_scenario(
+                    sender, options, ksnsend.ownship_state(options))
+                for task in scenario.tasks(options.overrun):
+                    scheduler.add(task)
+                scenarios.append(scenario)
+            scheduler.add(ksnsched.periodic_task("stop", 0,
+                                                 STOP_POLL_INTERVAL,
+                                                 check_stop))
+            scheduler.run(duration)
+        except KeyboardInterrupt:
+            pass
+        #not after a send error, the failed sender is closed already
+        cleanup = [scenario for scenario in scenarios
+                   if not scenario.options.nocleanup]
+        #sending a few to try and make sure it gets unblocked
+        for i in range(0, 10 if cleanup else 0):
+            for scenario in cleanup:
+                scenario.send_cleanup()
+            time.sleep(ksnsend.TASK_INTERVAL)
+    finally:
+        for sender in senders:
+            sender.close()
+
+
+def run_worker(plan, duration, stop, report=None, index=0):
+    '''
+    Sends the groups of one worker until duration expires or stop is set,
+    then cleans up.  Returns (the counters by address, the error that
+    stopped the worker or None), and also puts (index, counters, error) on
+    the report queue for process workers, whether or not it failed.
+    '''
+    counters = {}
+    error = None
+    try:
+        _send_plan(plan, duration, stop, counters)
+    except Exception as send_error:
+        error = "%s: %s" % (send_error.__class__.__name__, send_error)
+    finally:
+        results = dict((address, (counter.packets, counter.bytes,
+                                  counter.errors))
+                       for address, counter in counters.items())
+        if report is not None:
+            report.put((index, results, error))
+    return results, error
+
+
+def collect_reports(processes, report, stop):
+    '''The counters and errors the process workers put on report; a worker
+    that exits without reporting counts as failed instead of being waited
+    for'''
+    results = {}
+    errors = []
+    waiting = set(range(len(processes)))
+    while waiting:
+        #a worker flushes its report before it exits, so one that had
+        #exited before an empty get() never reported
+        exited = [index for index in sorted(waiting)
+                  if processes[index].exitcode is not None]
+        try:
+            index, worker_results, error = report.get(
+                timeout=STOP_POLL_INTERVAL)
+        except queue.Empty:
+            for index in exited:
+                waiting.discard(index)
+                errors.append("worker %d exited with code %d before "
+                              "reporting" % (index,
+                                             processes[index].exitcode))
+            continue
+        except KeyboardInterrupt:
+            print("")
+            print("Shutting down...")
+            stop.set()
+            continue
+        waiting.discard(index)
+        results.update(worker_results)
+        if error is not None:
+            errors.append("worker %d: %s" % (index, error))
+    return results, errors
+
+
+def setup_command_line():
+    parser = ksnsend.setup_command_line()
+    parser.usage = """usage: %prog [options] --target host:port [--target ...]
+
+    Sends the ksnsend labels to every target.  A target may be followed by
+    ksnsend options that only apply to it, e.g. --target "HOST:PORT
+    --altitude 8000".  Targets with the same options share their encoding.
+    """
+    help = "A unit to send to, as 'host:port [ksnsend options]'. Repeat for "
+    help += "every unit."
+    parser.add_option(  "--target", action="append", dest="targets",
+                        help=help, default=[]);
+    help = "Number of workers the targets are spread over. [default:%default]"
+    parser.add_option(  "--workers", action="store", dest="workers",
+                        help=help, type="int", default=1);
+    help = "Whether the workers are threads or processes. [default:%default]"
+    parser.add_option(  "--workermode", action="store", dest="worker_mode",
+                        help=help, type="choice", choices=WORKER_MODES,
+                        default="thread");
+    return parser
+
+
+def group_targets(args):
+    '''Parses the command line into the base options and the target groups,
+    a list of (options, addresses) in command line order'''
+    options = ksnsend.parse_command_line(args, setup_command_line())
+    if not options.targets:
+        setup_command_line().error("at least one --target is needed")
+    if options.workers < 1:
+        setup_command_line().error("workers must be greater than 0")
+
+    groups = {}
+    order = []
+    for text in options.targets:
+        try:
+            address, overrides = parse_target(text)
+        except ValueError as error:
+            setup_command_line().error(str(error))
+        target_options = ksnsend.parse_command_line(args + overrides,
+                                                    setup_command_line())
+        #resolve once instead of on every sendto
+        address = (socket.gethostbyname(address[0]), address[1])
+        key = encoding_key(target_options)
+        if key not in groups:
+            try:
+                ksnsend.check_ownship_state(target_options)
+            except ksnsend.state_error as error:
+                setup_command_line().error("%s: %s" % (text, error))
+            groups[key] = (target_options, [])
+            order.append(key)
+        groups[key][1].append(address)
+    return options, [groups[key] for key in order]
+
+
+def print_counters(results, duration):
+    if not results:
+        print("No targets reported")
+        return
+    print("%-21s %10s %12s %8s %10s" % ("target", "packets", "bytes", "errors",
+                                        "packets/s"))
+    for address in sorted(results):
+        packets, size, errors = results[address]
+        print("%-21s %10d %12d %8d %10.1f" % ("%s:%d" % address, packets, size,
+                                              errors, packets / duration))
+    packets = [result[0] for result in results.values()]
+    print("%d targets, fewest packets %d, most %d" % (len(packets),
+                                                      min(packets),
+                                                      max(packets)))
+
+
+def main():
+    args = sys.argv[1:]
+    options, groups = group_targets(args)
+    workers = min(options.workers, sum(len(group[1]) for group in groups))
+    plans = plan_workers(groups, workers)
+    if options.record != None:
+        print("--record is ignored, record a single target with ksnsend.py")
+    if (options.stats or options.stats_file != None or
+            options.stats_port != None):
+        print("--stats options are ignored, the per-target counters are "
+              "printed at the end")
+    if options.clock != "real":
+        print("--clock options are ignored, the workers run in real time")
+    if options.transport != "udp":
+        print("--transport is ignored, the workers send UDP to every target")
+    if options.control != None:
+        print("--control is ignored, restart the fanout to change a target")
+    print("%d targets in %d encoding groups on %d %s workers" %
+          (sum(len(group[1]) for group in groups), len(groups), workers,
+           options.worker_mode))
+    if options.timeout != None:
+        print("Sending data for %d seconds" % options.timeout)
+    print("Terminate with Ctrl-C")
+
+    results = {}
+    errors = []
+    start = time.time()
+    if options.worker_mode == "thread":
+        stop = threading.Event()
+        threads = []
+        outcomes = []
+        for index, plan in enumerate(plans):
+            thread = threading.Thread(target=lambda plan=plan, index=index:
+                                      outcomes.append((index, run_worker(
+                                          plan, options.timeout, stop))))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(STOP_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            print("")
+            print("Shutting down...")
+            stop.set()
+            for thread in threads:
+                thread.join()
+        for index, (worker_results, error) in sorted(outcomes):
+            results.update(worker_results)
+            if error is not None:
+                errors.append("worker %d: %s" % (index, error))
+    else:
+        stop = multiprocessing.Event()
+        report = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_worker,
+                                             args=(plan, options.timeout,
+                                                   stop, report, index))
+                     for index, plan in enumerate(plans)]
+        for process in processes:
+            process.start()
+        results, errors = collect_reports(processes, report, stop)
+        for process in processes:
+            process.join()
+
+    print_counters(results, max(time.time() - start, 1e-3))
+    for error in errors:
+        print("Failed: %s" % error)
+    if errors:
+        sys.exit(1)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#! /usr/bin/env python
+'''
+Decoder for the records test.getFlightPlanBuffer() returns in the KSN770
+scripts.
+
+Every record starts with its type (the WAYPOINT and WAYPOINT_LIST
+constants of KSN770ScriptEngine, passed in by the scripts):
+
+    WAYPOINT        the name at 5 (9 bytes, NUL padded), the unique
+                    waypoint id at 119 (4 bytes, big-endian) and the
+                    IdentDisplayCode at 128
+    WAYPOINT_LIST   the id of the last (destination) waypoint 8 bytes from
+                    the end
+
+A record is decoded by one precompiled Struct.unpack_from() over it, so a
+bytes, bytearray or memoryview record is not copied (a list of byte values
+is turned into a bytearray first).  waypoint() returns a __slots__ record,
+waypoint_columns() the ids, names and IdentDisplayCodes of a whole buffer as
+NumPy arrays (lists without NumPy), so queries run on whole columns:
+
+    fp_buffer = test.getFlightPlanBuffer(SECONDARY_FP, WAYPOINT)
+    for waypoint_id in ksnfpbuffer.discontinuities(fp_buffer, WAYPOINT):
+        ...
+    ksnfpbuffer.dest_waypoint_id(test.getFlightPlanBuffer(
+        SECONDARY_FP, WAYPOINT_LIST), WAYPOINT_LIST)
+
+Records that already sit back to back in one buffer are mapped onto a NumPy
+structured dtype by waypoint_table(), a view with no copy at all.
+'''
+
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#IdentDisplayCode of a flight plan discontinuity
+DISCONTINUITY = 4
+NAME_OFFSET = 5
+NAME_SIZE = 9
+ID_OFFSET = 119
+IDENT_DISPLAY_CODE_OFFSET = 128
+#type, name, id and IdentDisplayCode of a WAYPOINT record
+WAYPOINT_FORMAT = struct.Struct(">B%dx%ds%dxI%dxB" % (
+    NAME_OFFSET - 1, NAME_SIZE, ID_OFFSET - NAME_OFFSET - NAME_SIZE,
+    IDENT_DISPLAY_CODE_OFFSET - ID_OFFSET - 4))
+WAYPOINT_SIZE = WAYPOINT_FORMAT.size
+#the destination id of a WAYPOINT_LIST record, from its end
+DEST_ID_FORMAT = struct.Struct(">I")
+DEST_ID_FROM_END = 8
+
+
+def _buffer(record):
+    '''The record as something unpack_from() reads without a copy'''
+    if isinstance(record, (bytes, bytearray, memoryview)):
+        return record
+    return bytearray(record)
+
+
+def _waypoint_buffer(record):
+    buffer = _buffer(record)
+    if len(buffer) < WAYPOINT_SIZE:
+        raise ValueError("WAYPOINT record of %d bytes, expected at least %d" %
+                         (len(buffer), WAYPOINT_SIZE))
+    return buffer
+
+
+def _name(raw):
+    return raw.split(b"\0", 1)[0].decode("latin-1")
+
+
+class waypoint_record(object):
+    '''One WAYPOINT record'''
+    __slots__ = ("type", "name", "id", "ident_display_code")
+
+    def __init__(self, type, name, id, ident_display_code):
+        self.type = type
+        self.name = name
+        self.id = id
+        self.ident_display_code = ident_display_code
+
+
+    @property
+    def discontinuity(self):
+        return self.ident_display_code == DISCONTINUITY
+
+
+    def __repr__(self):
+        return "waypoint_record(name=%r, id=%d, ident_display_code=%d)" % (
+            self.name, self.id, self.ident_display_code)
+
+
+def waypoint(record):
+    '''The waypoint_record of a WAYPOINT record'''
+    record_type, name, waypoint_id, code = WAYPOINT_FORMAT.unpack_from(
+        _waypoint_buffer(record))
+    return waypoint_record(record_type, _name(name), waypoint_id, code)
+
+
+def waypoints(fp_buffer, record_type):
+    '''The waypoint_record of every record_type (WAYPOINT) record'''
+    if not fp_buffer:
+        return []
+    return [waypoint(record) for record in fp_buffer
+            if record[0] == record_type]
+
+
+def dest_waypoint_id(fp_buffer, record_type):
+    '''The destination waypoint id in the first record_type (WAYPOINT_LIST)
+    record, False if there is none'''
+    if not fp_buffer:
+        return False
+    for record in fp_buffer:
+        if record[0] == record_type:
+            buffer = _buffer(record)
+            return DEST_ID_FORMAT.unpack_from(
+                buffer, len(buffer) - DEST_ID_FROM_END)[0]
+    return False
+
+
+def waypoint_columns(fp_buffer, record_type):
+    '''
+    (ids, names, ident_display_codes) of the record_type (WAYPOINT) records,
+    NumPy uint32, bytes and uint8 arrays, or lists without NumPy (the names
+    are bytes either way).  Only the three fields are read from each record.
+    '''
+    unpack_from = WAYPOINT_FORMAT.unpack_from
+    ids = []
+    names = []
+    codes = []
+    for record in fp_buffer or ():
+        if record[0] != record_type:
+            continue
+        unused, name, waypoint_id, code = unpack_from(
+            _waypoint_buffer(record))
+        ids.append(waypoint_id)
+        names.append(name.split(b"\0", 1)[0])
+        codes.append(code)
+    if numpy is None:
+        return ids, names, codes
+    return (numpy.array(ids, dtype=numpy.uint32),
+            numpy.array(names, dtype="S%d" % NAME_SIZE),
+            numpy.array(codes, dtype=numpy.uint8))
+
+
+def discontinuities(fp_buffer, record_type):
+    '''The ids of the discontinuity waypoints, in flight plan order'''
+    ids, names, codes = waypoint_columns(fp_buffer, record_type)
+    if numpy is None:
+        return [waypoint_id for waypoint_id, code in zip(ids, codes)
+                if code == DISCONTINUITY]
+    return ids[codes == DISCONTINUITY]
+
+
+def waypoint_dtype(record_size=WAYPOINT_SIZE):
+    '''The NumPy structured dtype of a WAYPOINT record of record_size
+    bytes'''
+    if numpy is None:
+        raise ImportError("waypoint_dtype needs numpy")
+    if record_size < WAYPOINT_SIZE:
+        raise ValueError("records of %d bytes, expected at least %d" %
+                         (record_size, WAYPOINT_SIZE))
+    return numpy.dtype({
+        "names": ["type", "name", "id", "ident_display_code"],
+        "formats": ["u1", "S%d" % NAME_SIZE, ">u4", "u1"],
+        "offsets": [0, NAME_OFFSET, ID_OFFSET, IDENT_DISPLAY_CODE_OFFSET],
+        "itemsize": record_size})
+
+
+def waypoint_table(buffer, record_size=WAYPOINT_SIZE, count=-1, offset=0):
+    '''
+    A NumPy structured array viewing count (all by default) WAYPOINT
+    records of record_size bytes back to back in buffer, e.g.
+    table[table["ident_display_code"] == DISCONTINUITY]["id"]
+    '''
+    return numpy.frombuffer(buffer, dtype=waypoint_dtype(record_size),
+                            count=count, offset=offset)
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+'''
+Bulk flight plan edits for the KSN770 scripts.
+
+Deleting waypoints one at a time costs a full deleteWptRequest /
+expectDeleteWptResponse round trip each.  delete_waypoints() sends every
+delete first and only then gathers the responses, in the same order, and
+waits for the flight plan edit once at the end, so cleaning a long plan
+costs about one round trip instead of N:
+
+    statuses = ksnfpedit.delete_discontinuities(test, SECONDARY_FP, WAYPOINT)
+    for waypoint_id, status in statuses.items():
+        test.verifyBool(status is RESP_STATUS_SUCCESS, ...)
+
+The statuses are whatever expectDeleteWptResponse() returned, by unique
+waypoint id in the order the deletes were sent; the scripts check them
+against the RESP_STATUS_* constants of KSN770ScriptEngine as before.
+pipeline=False falls back to one round trip per waypoint.  The deletes
+go through a ksnpipeline.request_pipeline, the script's own when passed as
+requests so they are counted with its other requests.
+'''
+
+import collections
+
+import ksnfpbuffer
+import ksnpipeline
+
+
+def delete_waypoints(test, fpln, waypoint_ids, pipeline=True, wait=True,
+                     requests=None):
+    '''
+    Delete the waypoints with the unique waypoint_ids from fpln, returning
+    an OrderedDict of the response status by waypoint id.  Ids given twice
+    are deleted once.
+    '''
+    ids = []
+    seen = set()
+    for waypoint_id in waypoint_ids:
+        #NumPy integers from ksnfpbuffer columns
+        waypoint_id = int(waypoint_id)
+        if waypoint_id not in seen:
+            seen.add(waypoint_id)
+            ids.append(waypoint_id)
+
+    if requests is None:
+        requests = ksnpipeline.request_pipeline(test, pipeline)
+    futures = [(waypoint_id, requests.request("deleteWpt", fpln, waypoint_id))
+               for waypoint_id in ids]
+    statuses = collections.OrderedDict(
+        (waypoint_id, future.result()) for waypoint_id, future in futures)
+
+    if wait and ids:
+        requests.wait_fp_edit_complete()
+    return statuses
+
+
+def delete_matching(test, fpln, record_type, predicate, pipeline=True,
+                    wait=True, requests=None):
+    '''
+    Delete the waypoints of fpln whose ksnfpbuffer.waypoint_record matches
+    predicate; record_type is the WAYPOINT constant of the scripts
+    '''
+    fp_buffer = test.getFlightPlanBuffer(fpln, record_type)
+    waypoint_ids = [waypoint.id
+                    for waypoint in ksnfpbuffer.waypoints(fp_buffer,
+                                                          record_type)
+                    if predicate(waypoint)]
+    return delete_waypoints(test, fpln, waypoint_ids, pipeline, wait,
+                            requests)
+
+
+def delete_discontinuities(test, fpln, record_type, pipeline=True,
+                           wait=True, requests=None):
+    '''Delete every discontinuity of fpln'''
+    fp_buffer = test.getFlightPlanBuffer(fpln, record_type)
+    return delete_waypoints(
+        test, fpln, ksnfpbuffer.discontinuities(fp_buffer, record_type),
+        pipeline, wait, requests)
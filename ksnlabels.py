@@ -0,0 +1,282 @@
+#! /usr/bin/env python
+'''
+Registry of the IOF labels sent by ksnsend.
+
+Every label is one iof_label entry listing its fields in wire order with
+their struct codes, units and padding.  The packet layout, size and record
+type are derived from the entry, and the first use of its payload() or
+decoder generates specialised code for exactly its fields
+(the label number is a constant in it, the fields are plain arguments), so
+the send path does no lookups per field:
+
+    payload = A429_TRUE_AIR_SPEED.payload()
+    payload.encode(1, 140.0)        #the packet buffer, label included
+    A429_TRUE_AIR_SPEED.decoder(package)
+        -> a429_true_air_speed(valid=1, value=140.0)
+
+The values are given in the wire unit of their field, the senders convert
+them with the ksnsend conversion functions (ft_to_m() and the like).  A new
+label is one more entry below.
+'''
+
+import struct
+import collections
+
+IOF_GPS_TIME_MARK_INFO = 1024
+IOF_ARINC_SPARE_RX3_ARR = 1029
+IOF_A429_ALTITUDE_RATE = 1065
+IOF_SS_ALTITUDE_RATE = 1096
+IOF_SS_HEADING = 1101
+IOF_SS_ALTITUDE = 1179
+IOF_GPS_IOP_STATUS = 10118
+IOF_MPC2_GPS_CHANNEL_STATUS = 10113
+IOF_FMS_MAGNETIC_VARIATION = 805
+IOF_SHADIN_ALTITUDE = 1055
+IOF_A429_BARO_UNCORR_ALTITUDE = 1057
+IOF_A429_BARRO_CORR_ALTITUDE = 1058
+IOF_A429_TRUE_AIR_SPEED = 1060
+IOF_A429_COMPUTED_AIR_SPEED = 1064
+IOF_MMDS_VOR_ILS_STATION_ID = 1087
+
+IOF_SS_TRUE_AIRSPEED = 1100
+IOF_TRAFFIC_LABELS_RX = 1183
+
+IOF_AHRS_HEADING_ANGLE  = 1042
+IOF_AHRS_TRUE_HEADING = 1044
+
+IOF_MPC1_IOF_CONTROL = 0xFFFF
+IOF_MPC2_IOF_CONTROL = 0xFFFE
+
+#time variables
+IOF_MPC2_GNSS_TX = 2206
+IOF_MPC2_GNSS_RX = 2207
+IOF_MPC2_GNSS_CNTL = 2208
+IOF_FMS_RTC_DATE_TIME = 948
+
+LABEL_CODE = "H"
+
+
+class field(object):
+    '''A named value with its struct code and wire unit'''
+    __slots__ = ("name", "code", "unit")
+
+    def __init__(self, name, code, unit=None):
+        self.name = name
+        self.code = code
+        self.unit = unit
+
+
+class pad(object):
+    '''Bytes the unit ignores'''
+    __slots__ = ("size",)
+    code = None
+
+    def __init__(self, size):
+        self.size = size
+
+
+def _generate(namespace, source, name):
+    exec(compile(source, "<ksnlabels %s>" % name, "exec"), namespace)
+
+
+class iof_label(object):
+    '''
+    One label layout.  layout is its Struct, label included first, record
+    the namedtuple of its fields.  payload() and decoder are generated on
+    first use and kept.
+    '''
+    def __init__(self, name, label, items):
+        self.name = name
+        self.label = label
+        self.items = list(items)
+        self.fields = [item for item in self.items if item.code is not None]
+        self.format = "!" + LABEL_CODE + "".join(
+            item.code if item.code is not None else "x" * item.size
+            for item in self.items)
+        self.layout = struct.Struct(self.format)
+        self.size = self.layout.size
+        self.record = collections.namedtuple(name, [item.name for item in
+                                                    self.fields])
+        self._payload_type = None
+        self._decoder = None
+
+
+    def offset(self, name):
+        '''Byte offset of a field, None being the label'''
+        size = struct.calcsize("!" + LABEL_CODE)
+        if name is None:
+            return 0
+        for item in self.items:
+            if item.code is not None and item.name == name:
+                return size
+            size += struct.calcsize("!" + (item.code or "x" * item.size))
+        raise KeyError(name)
+
+
+    def sub_layout(self, first, last):
+        '''
+        (offset, Struct) of the fields first to last (None being the label)
+        and the padding after last, to pack part of a packet in place
+        '''
+        start = self.offset(first)
+        codes = [LABEL_CODE] if first is None else []
+        inside = first is None
+        for index, item in enumerate(self.items):
+            if item.code is not None and item.name == first:
+                inside = True
+            if inside:
+                codes.append(item.code or "x" * item.size)
+                if item.code is not None and item.name == last:
+                    for after in self.items[index+1:]:
+                        if after.code is not None:
+                            break
+                        codes.append("x" * after.size)
+                    return start, struct.Struct("!" + "".join(codes))
+        raise KeyError(last)
+
+
+    def _namespace(self):
+        return {"_pack_into": self.layout.pack_into,
+                "_unpack_from": self.layout.unpack_from,
+                "_record": self.record}
+
+
+    def payload(self):
+        '''A packet buffer for this label whose encode(*fields) packs the
+        fields only when they changed since the previous call'''
+        if self._payload_type is None:
+            args = ", ".join(item.name for item in self.fields)
+            source = (
+                "class payload(object):\n"
+                "    __slots__ = ('buffer', 'values')\n"
+                "    def __init__(self):\n"
+                "        self.buffer = bytearray(%d)\n"
+                "        self.values = None\n"
+                "    def encode(self, %s):\n"
+                "        values = (%s,)\n"
+                "        if values != self.values:\n"
+                "            _pack_into(self.buffer, 0, %d, %s)\n"
+                "            self.values = values\n"
+                "        return self.buffer\n" %
+                (self.size, args, args, self.label, args))
+            namespace = self._namespace()
+            _generate(namespace, source, self.name)
+            payload_type = namespace["payload"]
+            payload_type.__name__ = self.name + "_payload"
+            self._payload_type = payload_type
+        return self._payload_type()
+
+
+    @property
+    def decoder(self):
+        '''decoder(package) -> record, whatever the label in the packet'''
+        if self._decoder is None:
+            args = ", ".join(item.name for item in self.fields)
+            source = ("def decode(package):\n"
+                      "    label, %s = _unpack_from(package)\n"
+                      "    return _record(%s)\n" % (args, args))
+            namespace = self._namespace()
+            _generate(namespace, source, self.name)
+            self._decoder = namespace["decode"]
+        return self._decoder
+
+
+#every label, and the ones sharing a label number by (label, size)
+LABELS = []
+BY_NAME = {}
+BY_LABEL_AND_SIZE = {}
+
+
+def register(name, label, items):
+    entry = iof_label(name, label, items)
+    if name in BY_NAME or (label, entry.size) in BY_LABEL_AND_SIZE:
+        raise ValueError("label %s (%d, %d bytes) registered twice" %
+                         (name, label, entry.size))
+    LABELS.append(entry)
+    BY_NAME[name] = entry
+    BY_LABEL_AND_SIZE[(label, entry.size)] = entry
+    return entry
+
+
+def _channels(count):
+    items = []
+    for i in range(1, count + 1):
+        items += [field("channel%d" % i, "B"), pad(1),
+                  field("status%d" % i, "B"), pad(7)]
+    return items
+
+
+def _a429(unit, trailing):
+    '''the A429 labels: validity, value, then trailing spare bytes'''
+    return [field("valid", "B"), pad(3), field("value", "f", unit),
+            pad(trailing)]
+
+
+GPS_CHANNELS = 6
+
+GPS_CHANNEL_STATUS = register(
+    "gps_channel_status", IOF_MPC2_GPS_CHANNEL_STATUS,
+    [pad(1), field("message", "B"), field("channels", "B")] +
+    _channels(GPS_CHANNELS))
+
+GPS_TIME_MARK = register("gps_time_mark", IOF_GPS_TIME_MARK_INFO, [
+    field("latitude", "d", "rad"),
+    field("longitude", "d", "rad"),
+    field("altitude", "f", "m"),
+    field("ground_track", "f", "rad"),
+    field("ground_speed", "f", "m/s"),
+    field("vertical_speed", "f", "m/s"),
+    field("year", "H"), field("month", "B"), field("day", "B"),
+    field("hour", "B"), field("minute", "B"), field("second", "B"),
+    pad(1)])
+
+GPS_IOP_STATUS = register("gps_iop_status", IOF_GPS_IOP_STATUS, [
+    pad(1), field("mode", "B"), pad(7),
+    field("hdop", "f"), field("hil", "f", "m"), field("hpe", "f", "m"),
+    field("vdop", "f"), field("vil", "f", "m"), field("vpe", "f", "m"),
+    pad(16)])
+
+SHADIN_ALTITUDE = register("shadin_altitude", IOF_SHADIN_ALTITUDE, [
+    field("valid1", "B"), pad(3), field("altitude1", "f", "ft"),
+    field("valid2", "B"), pad(3), field("altitude2", "f", "ft"), pad(4)])
+
+A429_BARO_UNCORR_ALTITUDE = register(
+    "a429_baro_uncorr_altitude", IOF_A429_BARO_UNCORR_ALTITUDE,
+    _a429("ft", 8))
+A429_BARO_CORR_ALTITUDE = register(
+    "a429_baro_corr_altitude", IOF_A429_BARRO_CORR_ALTITUDE, _a429("ft", 8))
+A429_TRUE_AIR_SPEED = register(
+    "a429_true_air_speed", IOF_A429_TRUE_AIR_SPEED, _a429("kt", 4))
+A429_COMPUTED_AIR_SPEED = register(
+    "a429_computed_air_speed", IOF_A429_COMPUTED_AIR_SPEED, _a429("kt", 4))
+AHRS_HEADING_ANGLE = register(
+    "ahrs_heading_angle", IOF_AHRS_HEADING_ANGLE, _a429("deg", 4))
+AHRS_TRUE_HEADING = register(
+    "ahrs_true_heading", IOF_AHRS_TRUE_HEADING, _a429("deg", 4))
+
+FMS_MAGNETIC_VARIATION = register(
+    "fms_magnetic_variation", IOF_FMS_MAGNETIC_VARIATION,
+    [field("magvar", "f", "deg")])
+
+#ARINC words of one intruder: RTS, range, altitude, bearing, ETX
+TRAFFIC = register("traffic", IOF_TRAFFIC_LABELS_RX, [
+    field("discrete", "I"), field("rts", "I"), field("range", "I"),
+    field("altitude", "I"), field("bearing", "I"), field("etx", "I")])
+TRAFFIC_DUPLICATES = register("traffic_duplicates", IOF_TRAFFIC_LABELS_RX, [
+    field("discrete", "I"), field("rts", "I"),
+    field("range1", "I"), field("altitude1", "I"), field("bearing1", "I"),
+    field("range2", "I"), field("altitude2", "I"), field("bearing2", "I"),
+    field("etx", "I")])
+
+ARINC_SPARE_RX3 = register("arinc_spare_rx3", IOF_ARINC_SPARE_RX3_ARR,
+                           [field("word", "I")])
+
+FMS_RTC_DATE_TIME = register("fms_rtc_date_time", IOF_FMS_RTC_DATE_TIME, [
+    field("second", "B"), field("minute", "B"), field("hour", "B"),
+    field("day", "B"), field("month", "B"), field("flag", "B"),
+    field("year", "H")])
+
+#the ident is sent reversed and NUL padded
+MMDS_VOR_ILS_STATION_ID = register(
+    "mmds_vor_ils_station_id", IOF_MMDS_VOR_ILS_STATION_ID,
+    [field("ident", "4s")])
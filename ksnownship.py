@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+'''
+Dead-reckoning kinematic model of the ownship for ksnsend.
+
+The model integrates the position along the great circle at the ground
+track and speed, the altitude from the vertical speed, and keeps the AHRS
+headings consistent with the track (no wind).  It advances in fixed steps
+that do not depend on the send rates, and reuses the trigonometry between
+steps (the angular distance only changes with the speed, the track terms
+only while turning), so hundreds of ownships can run in one process.
+
+Manoeuvres are scripted as "time:kind:value", time in seconds from start:
+
+    track:DEGREES       turn the shortest way at TURN_RATE
+    altitude:FEET       climb or descend at CLIMB_RATE, or the
+                        vertical speed option when it is not 0
+    speed:KNOTS         accelerate or decelerate at ACCELERATION
+'''
+
+import math
+
+import ksnsend
+import ksnsched
+import ksntraj
+
+EARTH_RADIUS = 6371008.8           #meters, mean radius
+TURN_RATE = math.radians(3.0)      #standard rate turn, radians per second
+CLIMB_RATE = ksnsend.ftpm_to_mps(1000)
+ACCELERATION = ksnsend.kts_to_mps(2)
+DEFAULT_STEP = 0.05
+MANOEUVRES = ["track", "altitude", "speed"]
+TWO_PI = 2 * math.pi
+
+
+class manoeuvre(object):
+    '''A target track (radians), altitude (meters) or speed (m/s) that the
+    model starts to fly towards at time seconds'''
+    __slots__ = ("time", "kind", "value")
+
+    def __init__(self, time, kind, value):
+        if kind not in MANOEUVRES:
+            raise ValueError("unknown manoeuvre %r" % kind)
+        self.time = time
+        self.kind = kind
+        self.value = value
+
+
+def parse_manoeuvre(text):
+    '''"time:kind:value" in seconds, degrees, feet and knots'''
+    try:
+        time, kind, value = text.split(":")
+        time = float(time)
+        value = float(value)
+    except ValueError:
+        raise ValueError("manoeuvre %r is not time:kind:value" % text)
+    if kind == "track":
+        value = math.radians(value) % TWO_PI
+    elif kind == "altitude":
+        value = ksnsend.ft_to_m(value)
+    elif kind == "speed":
+        value = ksnsend.kts_to_mps(value)
+    return manoeuvre(time, kind, value)
+
+
+class ownship(object):
+    '''
+    Ownship state in wire units: latitude and longitude in radians, altitude
+    in meters, ground track in radians, speeds in meters per second.
+    magvar (degrees, east positive) turns the true heading into the AHRS
+    magnetic heading, true_airspeed is passed through to the air data.
+    '''
+    def __init__(self, latitude, longitude, altitude, ground_track,
+                 ground_speed, vertical_speed, magvar=0.0, true_airspeed=0.0,
+                 manoeuvres=(), step=DEFAULT_STEP, clock=ksnsched.monotonic):
+        if step <= 0:
+            raise ValueError("step must be > 0 (got %r)" % step)
+        self.latitude = latitude
+        self.longitude = longitude
+        self.altitude = altitude
+        self.ground_track = ground_track % TWO_PI
+        self.ground_speed = ground_speed
+        self.vertical_speed = vertical_speed
+        self.magvar = magvar
+        self.true_airspeed = true_airspeed
+        self.step = step
+        self.clock = clock
+        self.epoch = None
+        #model time, always a whole number of steps
+        self.time = 0.0
+        self.steps = 0
+
+        self._pending = sorted(manoeuvres, key=lambda m: m.time)
+        self._target_track = None
+        self._target_altitude = None
+        self._target_speed = None
+        self._climb_rate = abs(vertical_speed) or CLIMB_RATE
+        self._level_off = False
+
+        self._sin_lat = math.sin(latitude)
+        self._cos_lat = math.cos(latitude)
+        self._speed = None
+        self._track = None
+        self._update_speed_terms()
+        self._update_track_terms()
+
+
+    def _update_speed_terms(self):
+        if self.ground_speed != self._speed:
+            delta = self.ground_speed * self.step / EARTH_RADIUS
+            self._sin_delta = math.sin(delta)
+            self._cos_delta = math.cos(delta)
+            self._speed = self.ground_speed
+
+
+    def _update_track_terms(self):
+        if self.ground_track != self._track:
+            self._sin_track = math.sin(self.ground_track)
+            self._cos_track = math.cos(self.ground_track)
+            self._track = self.ground_track
+
+
+    def _start_manoeuvres(self):
+        pending = self._pending
+        while pending and pending[0].time <= self.time:
+            item = pending.pop(0)
+            if item.kind == "track":
+                self._target_track = item.value
+            elif item.kind == "altitude":
+                self._target_altitude = item.value
+            else:
+                self._target_speed = item.value
+
+
+    def _fly_manoeuvres(self, dt):
+        if self._target_track is not None:
+            #shortest way round, in (-pi, pi]
+            error = ((self._target_track - self.ground_track + math.pi) %
+                     TWO_PI) - math.pi
+            turn = TURN_RATE * dt
+            if abs(error) <= turn:
+                self.ground_track = self._target_track
+                self._target_track = None
+            else:
+                self.ground_track = (self.ground_track +
+                                     math.copysign(turn, error)) % TWO_PI
+
+        if self._target_altitude is not None:
+            error = self._target_altitude - self.altitude
+            if abs(error) <= self._climb_rate * dt:
+                #this step lands on the altitude, level off after it
+                self.vertical_speed = error / dt
+                self._target_altitude = None
+                self._level_off = True
+            else:
+                self.vertical_speed = math.copysign(self._climb_rate, error)
+
+        if self._target_speed is not None:
+            error = self._target_speed - self.ground_speed
+            if abs(error) <= ACCELERATION * dt:
+                self.ground_speed = self._target_speed
+                self._target_speed = None
+            else:
+                self.ground_speed += math.copysign(ACCELERATION * dt, error)
+
+
+    def integrate(self):
+        '''Advances the model by one step'''
+        dt = self.step
+        if self._pending:
+            self._start_manoeuvres()
+        if (self._target_track is not None or
+                self._target_altitude is not None or
+                self._target_speed is not None):
+            self._fly_manoeuvres(dt)
+            self._update_speed_terms()
+            self._update_track_terms()
+
+        if self._speed:
+            #great circle destination from the current point
+            sin_lat = self._sin_lat
+            cos_lat = self._cos_lat
+            sin_lat2 = (sin_lat * self._cos_delta +
+                        cos_lat * self._sin_delta * self._cos_track)
+            sin_lat2 = max(-1.0, min(1.0, sin_lat2))
+            self.longitude += math.atan2(
+                self._sin_track * self._sin_delta * cos_lat,
+                self._cos_delta - sin_lat * sin_lat2)
+            if not -math.pi <= self.longitude <= math.pi:
+                self.longitude = ((self.longitude + math.pi) % TWO_PI -
+                                  math.pi)
+            self.latitude = math.asin(sin_lat2)
+            self._sin_lat = sin_lat2
+            self._cos_lat = math.sqrt(1.0 - sin_lat2 * sin_lat2)
+
+        self.altitude += self.vertical_speed * dt
+        if self._level_off:
+            self.vertical_speed = 0.0
+            self._level_off = False
+        self.steps += 1
+        self.time = self.steps * dt
+
+
+    def advance_to(self, elapsed):
+        '''Integrates whole steps up to elapsed seconds of model time'''
+        target = int(elapsed / self.step + 1e-9)
+        while self.steps < target:
+            self.integrate()
+
+
+    def start(self):
+        self.epoch = self.clock()
+
+
+    def sample(self):
+        '''The state at the current clock time, in the fields of a
+        ksntraj.trajectory_sample (the baro altitude in feet, headings in
+        degrees)'''
+        if self.epoch is None:
+            self.start()
+        self.advance_to(self.clock() - self.epoch)
+        true_heading = math.degrees(self.ground_track)
+        return ksntraj.trajectory_sample(
+            self.latitude, self.longitude, self.altitude, self.ground_track,
+            self.ground_speed, self.vertical_speed,
+            self.altitude / ksnsend.ft_to_m(1), self.true_airspeed,
+            (true_heading - self.magvar) % 360.0, true_heading)
+
+
+def from_options(options, manoeuvres=(), clock=ksnsched.monotonic):
+    '''An ownship starting from the ksnsend command line values.  The ground
+    track option is taken in radians, like the rest of the GPS time mark.'''
+    return ownship(ksnsend.dec_to_rad(options.lat),
+                   ksnsend.dec_to_rad(options.lon),
+                   ksnsend.ft_to_m(options.alt), options.ground_track,
+                   ksnsend.kts_to_mps(options.ground_speed),
+                   ksnsend.ftpm_to_mps(options.vertical_speed),
+                   magvar=options.magvar or 0.0,
+                   true_airspeed=options.true_airspeed, manoeuvres=manoeuvres,
+                   step=options.model_step / 1000.0, clock=clock)
@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+'''
+Pipelined requests for the KSN770 scripts.
+
+The script engine pairs every <kind>Request() with an
+expect<Kind>Response(), and calling them back to back pays a full round
+trip per step even where the next step does not need the response.
+request_pipeline.request() sends the request at once and returns a
+response_future; the response is only read when the script needs it
+(result()), or at drain() before a waitFpEditComplete():
+
+    requests = ksnpipeline.request_pipeline(test)
+    arrival = requests.request("arrival", SECONDARY_FP, "LSZB")
+    requests.request("setArrivalAppr", SECONDARY_FP, 'RNAV 14')
+    requests.request("setArrivalApprTrans", SECONDARY_FP, 'BIRKI')
+    requests.request("activateArrival", SECONDARY_FP)
+    test.verifyBool(arrival.result()[0] is RESP_STATUS_SUCCESS, ...)
+    requests.wait_fp_edit_complete()
+
+The responses of a kind come back in the order of its requests, so a
+future is matched to its response by kind and sequence number: result()
+reads the outstanding responses of its kind up to its own, resolving the
+earlier futures on the way.  The first wait for responses after requests
+were sent counts as one round trip (the later responses of those requests
+are on their way by then), summary() gives the requests, the round trips
+waited and the round trips saved against waiting after every request.
+'''
+
+import collections
+
+
+def _response_method(kind):
+    '''"insertWpt" -> "expectInsertWptResponse"'''
+    return "expect%s%sResponse" % (kind[0].upper(), kind[1:])
+
+
+class response_future(object):
+    '''The response to the sequence-th request of kind'''
+    __slots__ = ("pipeline", "kind", "sequence", "value", "done")
+
+    def __init__(self, pipeline, kind, sequence):
+        self.pipeline = pipeline
+        self.kind = kind
+        self.sequence = sequence
+        self.value = None
+        self.done = False
+
+
+    def result(self):
+        '''The response, read now if it has not been yet'''
+        if not self.done:
+            self.pipeline._resolve(self)
+        return self.value
+
+
+    def __repr__(self):
+        return "response_future(%s #%d%s)" % (
+            self.kind, self.sequence,
+            ", %r" % (self.value,) if self.done else "")
+
+
+class request_pipeline(object):
+    '''
+    Sends the requests of test back to back and reads their responses on
+    demand.  pipelined=False reads every response right after its request,
+    as the scripts did before.
+    '''
+    def __init__(self, test, pipelined=True):
+        self.test = test
+        self.pipelined = pipelined
+        #kind: the futures of its outstanding requests, oldest first
+        self.pending = collections.OrderedDict()
+        self.sequences = collections.defaultdict(int)
+        self.requests = 0
+        self.round_trips = 0
+        #requests were sent since the last wait
+        self._in_flight = False
+
+
+    def request(self, kind, *args):
+        '''Send <kind>Request(*args) and return the future of its
+        response'''
+        getattr(self.test, kind + "Request")(*args)
+        self.sequences[kind] += 1
+        future = response_future(self, kind, self.sequences[kind])
+        self.pending.setdefault(kind, collections.deque()).append(future)
+        self.requests += 1
+        self._in_flight = True
+        if not self.pipelined:
+            self._resolve(future)
+        return future
+
+
+    def _read(self, kind):
+        future = self.pending[kind].popleft()
+        if not self.pending[kind]:
+            del self.pending[kind]
+        future.value = getattr(self.test, _response_method(kind))()
+        future.done = True
+
+
+    def _wait(self):
+        if self._in_flight:
+            self.round_trips += 1
+            self._in_flight = False
+
+
+    def _resolve(self, future):
+        self._wait()
+        while not future.done:
+            self._read(future.kind)
+
+
+    def outstanding(self):
+        return sum(len(futures) for futures in self.pending.values())
+
+
+    def drain(self):
+        '''Read every outstanding response, one round trip for all'''
+        if not self.pending:
+            return
+        self._wait()
+        while self.pending:
+            self._read(next(iter(self.pending)))
+
+
+    def wait_fp_edit_complete(self):
+        '''drain(), then test.waitFpEditComplete()'''
+        self.drain()
+        self.test.waitFpEditComplete()
+
+
+    def saved(self):
+        '''Round trips saved against one per request'''
+        return self.requests - self.round_trips
+
+
+    def summary(self):
+        return "%d requests, %d round trips, %d round trips saved" % (
+            self.requests, self.round_trips, self.saved())
@@ -0,0 +1,312 @@
+#! /usr/bin/env python
+'''
+Binary recorder for everything ksn_send puts on the wire.
+
+record() only packs a small header and queues the packet, a background
+thread writes the queue in large sequential blocks.  Recordings rotate by
+size into numbered segments, each with a block index so that a time range
+or a set of labels can be read without scanning the whole file:
+
+    NAME.0000.ksnrec    "KSNREC01", then length-prefixed records
+    NAME.0000.ksnidx    one entry per written block
+
+    record      "<IBdHH"  length of the rest, kind, monotonic timestamp,
+                          target id, label, then the packet
+    index       "<ddQIIH" first and last timestamp, offset, size, records,
+                          label count, then that many "<H" labels
+
+Target records (kind 1) carry "host:port" and start every segment, so each
+segment can be read on its own.
+'''
+
+from __future__ import print_function
+import sys
+import glob
+import mmap
+import struct
+import threading
+import collections
+
+import ksnsched
+
+MAGIC = b"KSNREC01"
+RECORD_FORMAT = struct.Struct("<IBdHH")
+LENGTH_SIZE = 4
+INDEX_FORMAT = struct.Struct("<ddQIIH")
+LABEL_FORMAT = struct.Struct("!H")
+KIND_PACKET = 0
+KIND_TARGET = 1
+RECORD_SUFFIX = ".ksnrec"
+INDEX_SUFFIX = ".ksnidx"
+
+MAX_SEGMENT_BYTES = 256 * 1024 * 1024
+FLUSH_INTERVAL = 0.25
+MAX_BLOCK_BYTES = 1024 * 1024
+
+
+def segment_paths(base, segment):
+    prefix = "%s.%04d" % (base, segment)
+    return prefix + RECORD_SUFFIX, prefix + INDEX_SUFFIX
+
+
+class packet_recorder(object):
+    '''
+    Records (timestamp, target, label, packet) for one or more targets.
+    record() is safe to call from any thread, close() writes what is left.
+    '''
+    def __init__(self, base, max_segment_bytes=MAX_SEGMENT_BYTES,
+                 flush_interval=FLUSH_INTERVAL, clock=ksnsched.monotonic):
+        self.base = base
+        self.max_segment_bytes = max_segment_bytes
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.targets = {}
+        self.records = 0
+        self.bytes = 0
+        self.blocks = 0
+        self.segment = -1
+        self.error = None
+        #packets not queued because the writer stopped on error
+        self.dropped = 0
+        self._queue = collections.deque()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._data_file = None
+        self._index_file = None
+        self._open_segment()
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name="ksnrecord writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+
+    def target(self, host, port):
+        '''Returns the id to record packets sent to host:port with'''
+        key = "%s:%d" % (host, port)
+        target_id = self.targets.get(key)
+        if target_id is None:
+            target_id = len(self.targets)
+            self.targets[key] = target_id
+            self._queue.append(self._target_record(key, target_id))
+        return target_id
+
+
+    def _target_record(self, key, target_id):
+        name = key.encode("ascii")
+        header = RECORD_FORMAT.pack(RECORD_FORMAT.size - LENGTH_SIZE +
+                                    len(name), KIND_TARGET, self.clock(),
+                                    target_id, 0)
+        return (None, None, header + name)
+
+
+    def record(self, target_id, package):
+        '''Queues a packet, copying it so the caller may reuse its buffer.
+        Once the writer has failed the packet is only counted as dropped.'''
+        if self.error is not None:
+            self.dropped += 1
+            return
+        timestamp = self.clock()
+        label = LABEL_FORMAT.unpack_from(package)[0]
+        header = RECORD_FORMAT.pack(RECORD_FORMAT.size - LENGTH_SIZE +
+                                    len(package), KIND_PACKET, timestamp,
+                                    target_id, label)
+        self._queue.append((timestamp, label, header + bytes(package)))
+
+
+    def _open_segment(self):
+        if self._data_file is not None:
+            self._data_file.close()
+            self._index_file.close()
+        self.segment += 1
+        data_path, index_path = segment_paths(self.base, self.segment)
+        self._data_file = open(data_path, "wb")
+        self._index_file = open(index_path, "wb")
+        self._data_file.write(MAGIC)
+        self._offset = len(MAGIC)
+        #every segment starts with the target table
+        for key, target_id in sorted(self.targets.items(),
+                                     key=lambda item: item[1]):
+            self._write_block([self._target_record(key, target_id)])
+
+
+    def _write_block(self, entries):
+        if self._offset >= self.max_segment_bytes:
+            self._open_segment()
+        packets = [entry for entry in entries if entry[0] is not None]
+        data = b"".join(entry[2] for entry in entries)
+        self._data_file.write(data)
+        if packets:
+            labels = sorted(set(entry[1] for entry in packets))
+            self._index_file.write(
+                INDEX_FORMAT.pack(packets[0][0], packets[-1][0], self._offset,
+                                  len(data), len(packets), len(labels)) +
+                struct.pack("<%dH" % len(labels), *labels))
+        self._offset += len(data)
+        self.bytes += len(data)
+        self.records += len(packets)
+        self.blocks += 1
+
+
+    def _drain(self):
+        queue = self._queue
+        entries = []
+        size = 0
+        while queue:
+            entry = queue.popleft()
+            entries.append(entry)
+            size += len(entry[2])
+            if size >= MAX_BLOCK_BYTES:
+                self._write_block(entries)
+                entries = []
+                size = 0
+        if entries:
+            self._write_block(entries)
+        self._data_file.flush()
+        self._index_file.flush()
+
+
+    def _write_loop(self):
+        try:
+            while not self._stopping:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                self._drain()
+            self._drain()
+        except (IOError, OSError) as error:
+            #the send path keeps going, close() reports the error
+            self.error = error
+            self._queue.clear()
+
+
+    def close(self):
+        '''Writes the queued records and closes the segment'''
+        self._stopping = True
+        self._wake.set()
+        self._writer.join()
+        self._data_file.close()
+        self._index_file.close()
+        if self.error is not None:
+            raise self.error
+
+
+class packet_record(object):
+    '''One recorded packet, payload is a memoryview into the mapped file'''
+    __slots__ = ("timestamp", "target", "label", "payload")
+
+    def __init__(self, timestamp, target, label, payload):
+        self.timestamp = timestamp
+        self.target = target
+        self.label = label
+        self.payload = payload
+
+
+class recording_segment(object):
+    '''One memory-mapped segment of a recording and its index'''
+    def __init__(self, data_path, index_path):
+        self.data_path = data_path
+        self._file = open(data_path, "rb")
+        self.map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("%s is not a ksnsend recording" % data_path)
+        self.view = memoryview(self.map) if sys.version_info[0] >= 3 \
+            else self.map
+        self.blocks = []
+        with open(index_path, "rb") as index_file:
+            index = index_file.read()
+        offset = 0
+        while offset + INDEX_FORMAT.size <= len(index):
+            first, last, start, size, count, nlabels = \
+                INDEX_FORMAT.unpack_from(index, offset)
+            offset += INDEX_FORMAT.size
+            labels = frozenset(struct.unpack_from("<%dH" % nlabels, index,
+                                                  offset))
+            offset += 2 * nlabels
+            self.blocks.append((first, last, start, size, labels))
+        self.targets = {}
+        self._read_targets()
+
+
+    def _read_targets(self):
+        offset = len(MAGIC)
+        while offset + RECORD_FORMAT.size <= len(self.map):
+            length, kind, timestamp, target, label = \
+                RECORD_FORMAT.unpack_from(self.map, offset)
+            if kind != KIND_TARGET:
+                break
+            start = offset + RECORD_FORMAT.size
+            end = offset + LENGTH_SIZE + length
+            self.targets[target] = self.map[start:end].decode("ascii")
+            offset = end
+
+
+    def records(self, start=None, end=None, labels=None):
+        '''
+        Packets with start <= timestamp <= end and a label in labels (None
+        for no limit), read only from the blocks the index selects
+        '''
+        view = self.view
+        unpack_from = RECORD_FORMAT.unpack_from
+        header_size = RECORD_FORMAT.size
+        for first, last, offset, size, block_labels in self.blocks:
+            if start is not None and last < start:
+                continue
+            if end is not None and first > end:
+                break
+            if labels is not None and block_labels.isdisjoint(labels):
+                continue
+            block_end = offset + size
+            while offset < block_end:
+                length, kind, timestamp, target, label = \
+                    unpack_from(view, offset)
+                next_offset = offset + LENGTH_SIZE + length
+                if (kind == KIND_PACKET and
+                        (start is None or timestamp >= start) and
+                        (end is None or timestamp <= end) and
+                        (labels is None or label in labels)):
+                    yield packet_record(timestamp, target, label,
+                                        view[offset+header_size:next_offset])
+                offset = next_offset
+
+
+    def close(self):
+        #records still holding payload views keep the map open
+        self.view = None
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+
+def open_recording(base):
+    '''All the segments of the recording base, oldest first'''
+    data_paths = sorted(glob.glob(base + ".[0-9][0-9][0-9][0-9]" +
+                                  RECORD_SUFFIX))
+    if not data_paths:
+        raise IOError("no recording segments for %s" % base)
+    return [recording_segment(path, path[:-len(RECORD_SUFFIX)] +
+                              INDEX_SUFFIX) for path in data_paths]
+
+
+def main():
+    '''Prints a summary of a recording, or its packets in a time range'''
+    if len(sys.argv) not in (2, 4):
+        print("usage: %s NAME [start end]" % sys.argv[0])
+        sys.exit(2)
+    start = end = None
+    if len(sys.argv) == 4:
+        start = float(sys.argv[2])
+        end = float(sys.argv[3])
+    counts = collections.Counter()
+    for segment in open_recording(sys.argv[1]):
+        for record in segment.records(start, end):
+            counts[(segment.targets.get(record.target), record.label)] += 1
+        print("%s: %d blocks" % (segment.data_path, len(segment.blocks)))
+        segment.close()
+    for (target, label), count in sorted(counts.items()):
+        print("%-21s %6d %8d" % (target, label, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#! /usr/bin/env python
+'''
+Replays a ksnsend recording (see ksnrecord.py) to a unit or simulator.
+
+    ksnreplay.py --host 127.0.0.1 --speed 100 --label GPS_TIME_MARK_INFO \\
+                 --label TRAFFIC_LABELS_RX --patchtime field-issue
+
+The packets keep their recorded spacing divided by --speed (0 sends them as
+fast as possible).  Only the packets sent to one recorded target are
+replayed, the first one recorded unless --target names another.  The
+recording is memory-mapped and the packets are sent straight from the map,
+only the packets whose time fields are patched are copied first.
+'''
+
+from __future__ import print_function
+import sys
+import time
+import errno
+import socket
+import optparse
+
+import ksnsend
+import ksnsched
+import ksnlabels
+import ksnbatch
+import ksnrecord
+
+#the FMS RTC fields after the label
+FMS_RTC_TIME_OFFSET, FMS_RTC_TIME_FORMAT = \
+    ksnlabels.FMS_RTC_DATE_TIME.sub_layout("second", "year")
+IGNORED_ERRORS = (errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.ECONNREFUSED)
+#sleeps shorter than this are not worth a syscall
+MIN_SLEEP = 0.0005
+
+
+def parse_label(text):
+    '''A label number, or a ksnlabels IOF_* name with or without the
+    prefix'''
+    try:
+        return int(text, 0)
+    except ValueError:
+        pass
+    name = text.upper()
+    if not name.startswith("IOF_"):
+        name = "IOF_" + name
+    value = getattr(ksnlabels, name, None)
+    if not isinstance(value, int):
+        raise ValueError("unknown label %r" % text)
+    return value
+
+
+def find_target(segments, name=None):
+    '''The id of the recorded target name ("host:port"), of the first target
+    recorded if None'''
+    targets = {}
+    for segment in segments:
+        targets.update(segment.targets)
+    if not targets:
+        return None
+    if name is None:
+        return min(targets)
+    for target, target_name in targets.items():
+        if target_name == name:
+            return target
+    raise ValueError("no target %s in the recording, it has %s" %
+                     (name, ", ".join(sorted(targets.values()))))
+
+
+def _patch_gps_time_mark(package, now):
+    ksnsend.GPS_DATE_TIME_FORMAT.pack_into(package,
+                                           ksnsend.GPS_DATE_TIME_OFFSET,
+                                           now.tm_year, now.tm_mon,
+                                           now.tm_mday, now.tm_hour,
+                                           now.tm_min, now.tm_sec)
+
+
+def _patch_fms_rtc(package, now):
+    FMS_RTC_TIME_FORMAT.pack_into(package, FMS_RTC_TIME_OFFSET, now.tm_sec,
+                                  now.tm_min, now.tm_hour, now.tm_mday,
+                                  now.tm_mon, 1, now.tm_year)
+
+
+#label: (patch function, packet size)
+TIME_PATCHES = {
+    ksnsend.IOF_GPS_TIME_MARK_INFO: (_patch_gps_time_mark,
+                                     ksnsend.GPS_TIME_MARK_SIZE),
+    ksnsend.IOF_FMS_RTC_DATE_TIME: (_patch_fms_rtc,
+                                    ksnlabels.FMS_RTC_DATE_TIME.size),
+}
+
+
+class replay_engine(object):
+    '''
+    Sends the packets of a recording to host:port.  start and end are
+    seconds from the start of the recording, labels a collection of labels
+    to send (None for all) and target the recorded target id to send the
+    packets of (None for the first recorded, see find_target()).
+    '''
+    def __init__(self, segments, host, port, speed=1.0, labels=None,
+                 start=None, end=None, patch_time=False, batch=False,
+                 target=None, clock=ksnsched.monotonic, sleep=time.sleep):
+        if speed < 0:
+            raise ValueError("speed must be >= 0 (got %r)" % speed)
+        self.segments = segments
+        self.address = (host, port)
+        self.speed = speed
+        self.labels = frozenset(labels) if labels is not None else None
+        self.patch_time = patch_time
+        self.target = find_target(segments) if target is None else target
+        self.clock = clock
+        self.sleep = sleep
+        self.packets = 0
+        self.bytes = 0
+        self.errors = 0
+        self.late = 0.0
+        self._stopping = False
+
+        first = None
+        for segment in segments:
+            if segment.blocks:
+                first = segment.blocks[0][0]
+                break
+        self.first = first
+        self.start = None if start is None or first is None else first + start
+        self.end = None if end is None or first is None else first + end
+
+        self.sock = socket.socket(type=socket.SOCK_DGRAM)
+        self.batch = None
+        if batch:
+            self.sock.connect(self.address)
+            self.batch = ksnbatch.send_batch(self.sock)
+        #one reusable buffer per patched label
+        self._patched = dict((label, bytearray(size)) for label, (patch, size)
+                             in TIME_PATCHES.items())
+
+
+    def _send(self, package):
+        if self.batch is not None:
+            error = self.batch.append(package)
+        else:
+            error = None
+            try:
+                self.sock.sendto(package, self.address)
+            except socket.error as send_error:
+                error = send_error
+        if error is not None:
+            if error.args[0] not in IGNORED_ERRORS:
+                raise error
+            self.errors += 1
+
+
+    def _flush(self):
+        if self.batch is not None:
+            error = self.batch.flush()
+            if error is not None:
+                if error.args[0] not in IGNORED_ERRORS:
+                    raise error
+                self.errors += 1
+
+
+    def _patch(self, record, now):
+        patch, size = TIME_PATCHES[record.label]
+        package = self._patched[record.label]
+        if len(record.payload) != size:
+            #not a packet ksnsend would have sent, leave it as recorded
+            return record.payload
+        package[:] = record.payload
+        patch(package, now)
+        return package
+
+
+    def stop(self):
+        '''Makes run() return before the next packet'''
+        self._stopping = True
+
+
+    def run(self):
+        '''Sends the selected packets at their (scaled) recorded times'''
+        clock = self.clock
+        speed = self.speed
+        patch_time = self.patch_time
+        target = self.target
+        epoch = None
+        recorded_epoch = None
+        for segment in self.segments:
+            for record in segment.records(self.start, self.end, self.labels):
+                if record.target != target:
+                    continue
+                if self._stopping:
+                    self._flush()
+                    return
+                if epoch is None:
+                    epoch = clock()
+                    recorded_epoch = record.timestamp
+                if speed:
+                    deadline = epoch + (record.timestamp -
+                                        recorded_epoch) / speed
+                    delay = deadline - clock()
+                    if delay > 0:
+                        self._flush()
+                        if delay > MIN_SLEEP:
+                            self.sleep(delay)
+                    else:
+                        self.late = max(self.late, -delay)
+                package = record.payload
+                if patch_time and record.label in TIME_PATCHES:
+                    package = self._patch(record, time.localtime())
+                self._send(package)
+                self.packets += 1
+                self.bytes += len(package)
+        self._flush()
+
+
+    def close(self):
+        self.sock.close()
+        for segment in self.segments:
+            segment.close()
+
+
+def setup_command_line():
+    usage = """usage: %prog [options] NAME
+
+    Replays the recording NAME (NAME.NNNN.ksnrec written by ksnsend.py
+    --record) to a KSN unit or simulator."""
+    parser = optparse.OptionParser(usage=usage)
+    help = "The host to replay to. [default:%default]"
+    parser.add_option(  "--host", action="store", dest="host",
+                        help=help, default="127.0.0.1");
+    help = "The port to replay to. [default:%default]"
+    parser.add_option(  "--port", action="store", dest="port",
+                        help=help, type="int", default=3471);
+    help = "How many times faster than recorded to replay, 0 for as fast as "
+    help += "possible. [default:%default]"
+    parser.add_option(  "--speed", action="store", dest="speed",
+                        help=help, type="float", default=1.0);
+    help = "Only replay this label, a number or a ksnsend IOF name such as "
+    help += "GPS_TIME_MARK_INFO.  Repeat for every label, all by default."
+    parser.add_option(  "--label", action="append", dest="labels",
+                        help=help, default=[]);
+    help = "Seconds from the start of the recording to start at."
+    parser.add_option(  "--start", action="store", dest="start",
+                        help=help, type="float");
+    help = "Seconds from the start of the recording to stop at."
+    parser.add_option(  "--end", action="store", dest="end",
+                        help=help, type="float");
+    help = "The recorded host:port to replay the packets of, the first "
+    help += "target recorded by default."
+    parser.add_option(  "--target", action="store", dest="target",
+                        help=help);
+    help = "If true, the GPS time mark and FMS RTC date and time are set to "
+    help += "the time of the replay. [default:%default]"
+    parser.add_option(  "--patchtime", action="store_true", dest="patch_time",
+                        help=help, default=False);
+    help = "If true, packets due at the same time are sent as one batch. "
+    help += "[default:%default]"
+    parser.add_option(  "--batch", action="store_true", dest="batch",
+                        help=help, default=False);
+    return parser
+
+
+def main():
+    parser = setup_command_line()
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("one recording NAME is needed")
+    if options.speed < 0:
+        parser.error("speed must be greater than or equal to 0")
+    try:
+        labels = [parse_label(text) for text in options.labels] or None
+    except ValueError as error:
+        parser.error(str(error))
+    try:
+        segments = ksnrecord.open_recording(args[0])
+    except (IOError, ValueError) as error:
+        sys.exit("error: %s" % error)
+    try:
+        target = find_target(segments, options.target)
+    except ValueError as error:
+        for segment in segments:
+            segment.close()
+        sys.exit("error: %s" % error)
+
+    engine = replay_engine(segments, options.host, options.port,
+                           speed=options.speed, labels=labels,
+                           start=options.start, end=options.end,
+                           patch_time=options.patch_time, batch=options.batch,
+                           target=target)
+    print("Replaying %s to %s:%d" % (args[0], options.host, options.port))
+    print("Terminate with Ctrl-C")
+    start = time.time()
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        print("")
+        print("Shutting down...")
+    finally:
+        duration = time.time() - start
+        engine.close()
+    print("%d packets, %d bytes in %.2f seconds, %d ignored errors, "
+          "latest packet %.1f ms behind" % (engine.packets, engine.bytes,
+                                            duration, engine.errors,
+                                            engine.late * 1000))
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
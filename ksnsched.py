@@ -0,0 +1,166 @@
+#! /usr/bin/env python
+'''
+Deadline scheduler for the periodic label groups sent by ksnsend.
+
+Every task runs at absolute deadlines (epoch + start + n*interval) on a
+monotonic clock, so the period error does not accumulate and the scheduler
+only wakes up when something is due.
+'''
+
+import heapq
+import time
+import ctypes
+import ctypes.util
+
+#what to do when a task is already late for its next deadline
+OVERRUN_SKIP = "skip"          #drop the missed periods, keep the phase
+OVERRUN_CATCH_UP = "catchup"   #run the missed periods back to back
+OVERRUN_POLICIES = [OVERRUN_SKIP, OVERRUN_CATCH_UP]
+
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+def _libc_monotonic():
+    '''clock_gettime(CLOCK_MONOTONIC) for pythons without time.monotonic'''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    now = _timespec()
+
+    def monotonic():
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now))
+        return now.tv_sec + now.tv_nsec * 1e-9
+    return monotonic
+
+
+monotonic = getattr(time, "monotonic", None) or _libc_monotonic() or time.time
+
+
+class periodic_task(object):
+    '''A callback run every interval seconds, starting start seconds after
+    the scheduler epoch'''
+    def __init__(self, name, start, interval, callback, overrun=OVERRUN_SKIP):
+        if interval <= 0:
+            raise ValueError("task %s: interval must be > 0 (got %r)" %
+                             (name, interval))
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError("task %s: unknown overrun policy %r" %
+                             (name, overrun))
+        self.name = name
+        self.start = start
+        self.interval = interval
+        self.callback = callback
+        self.overrun = overrun
+        #number of the next period, the deadline is start + n*interval
+        self.period = 0
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+
+
+    def deadline(self, epoch):
+        return epoch + self.start + self.period * self.interval
+
+
+    def advance(self, epoch, now):
+        '''Moves to the next period, applying the overrun policy if that
+        deadline has already passed.  Returns the new deadline.'''
+        self.period += 1
+        deadline = self.deadline(epoch)
+        if deadline < now:
+            self.overruns += 1
+            if self.overrun == OVERRUN_SKIP:
+                #first deadline after now, in whole periods
+                missed = int((now - deadline) // self.interval) + 1
+                self.skipped += missed
+                self.period += missed
+                deadline = self.deadline(epoch)
+        return deadline
+
+
+class deadline_scheduler(object):
+    '''Runs periodic tasks from a priority queue of absolute deadlines'''
+    def __init__(self, clock=monotonic, sleep=time.sleep, on_tick=None,
+                 stats=None):
+        self.clock = clock
+        self.sleep = sleep
+        #called after all the tasks due at a deadline have run
+        self.on_tick = on_tick
+        #its deadline is set to the one of the running task (see ksnstats)
+        self.stats = stats
+        self.tasks = []
+        self.epoch = None
+        self._queue = []
+        self._running = False
+
+
+    def add(self, task):
+        '''Adds a task.  Tasks added while running start from the current
+        epoch.'''
+        self.tasks.append(task)
+        if self.epoch is not None:
+            self._push(task, task.deadline(self.epoch))
+        return task
+
+
+    def _push(self, task, deadline):
+        #the insertion order breaks ties between tasks due at the same time
+        heapq.heappush(self._queue, (deadline, self.tasks.index(task), task))
+
+
+    def stop(self):
+        '''Makes run() return before the next deadline'''
+        self._running = False
+
+
+    def run(self, duration=None):
+        '''Runs the tasks until stop() is called or for duration seconds'''
+        clock = self.clock
+        sleep = self.sleep
+        queue = self._queue
+        stats = self.stats
+
+        self.epoch = clock()
+        end_time = None
+        if duration is not None:
+            end_time = self.epoch + duration
+        del queue[:]
+        for task in self.tasks:
+            self._push(task, task.deadline(self.epoch))
+
+        self._running = True
+        while self._running and queue:
+            deadline, order, task = queue[0]
+            if end_time is not None and deadline > end_time:
+                delay = end_time - clock()
+                if delay > 0:
+                    sleep(delay)
+                break
+
+            delay = deadline - clock()
+            if delay > 0:
+                sleep(delay)
+
+            #everything due by now runs in the same tick
+            now = max(clock(), deadline)
+            while queue and queue[0][0] <= now:
+                deadline, order, task = heapq.heappop(queue)
+                if stats is not None:
+                    stats.deadline = deadline
+                task.callback()
+                task.runs += 1
+                heapq.heappush(queue, (task.advance(self.epoch, clock()),
+                                       order, task))
+            if self.on_tick is not None:
+                self.on_tick()
+            if stats is not None:
+                stats.deadline = None
+        self._running = False
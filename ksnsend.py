@@ -1,44 +1,33 @@
 #! /usr/bin/env python
 
-import time
+from __future__ import print_function
 import struct
 import socket
 import sys
 import math
-import errno
+import ksnsched
+import ksnclock
+import ksnlabels
+import ksntransport
+import arinc429
 from optparse import OptionParser, OptionValueError
+from arinc429 import word_layout, bnr, discrete
 
-#keep these here? put in class?
-IOF_GPS_TIME_MARK_INFO = 1024
-IOF_ARINC_SPARE_RX3_ARR = 1029
-IOF_A429_ALTITUDE_RATE = 1065
-IOF_SS_ALTITUDE_RATE = 1096
-IOF_SS_HEADING = 1101
-IOF_SS_ALTITUDE = 1179
-IOF_GPS_IOP_STATUS = 10118
-IOF_MPC2_GPS_CHANNEL_STATUS = 10113
-IOF_FMS_MAGNETIC_VARIATION = 805
-IOF_SHADIN_ALTITUDE = 1055
-IOF_A429_BARO_UNCORR_ALTITUDE = 1057
-IOF_A429_BARRO_CORR_ALTITUDE = 1058
-IOF_A429_TRUE_AIR_SPEED = 1060
-IOF_A429_COMPUTED_AIR_SPEED = 1064
-IOF_MMDS_VOR_ILS_STATION_ID = 1087
-
-IOF_SS_TRUE_AIRSPEED = 1100
-IOF_TRAFFIC_LABELS_RX = 1183
-
-IOF_AHRS_HEADING_ANGLE  = 1042
-IOF_AHRS_TRUE_HEADING = 1044
-
-IOF_MPC1_IOF_CONTROL = 0xFFFF
-IOF_MPC2_IOF_CONTROL = 0xFFFE
-
-#time variables
-IOF_MPC2_GNSS_TX = 2206
-IOF_MPC2_GNSS_RX = 2207
-IOF_MPC2_GNSS_CNTL = 2208
-IOF_FMS_RTC_DATE_TIME = 948
+#the label numbers and layouts are kept in the ksnlabels registry
+from ksnlabels import (IOF_GPS_TIME_MARK_INFO, IOF_ARINC_SPARE_RX3_ARR,
+                       IOF_A429_ALTITUDE_RATE, IOF_SS_ALTITUDE_RATE,
+                       IOF_SS_HEADING, IOF_SS_ALTITUDE, IOF_GPS_IOP_STATUS,
+                       IOF_MPC2_GPS_CHANNEL_STATUS,
+                       IOF_FMS_MAGNETIC_VARIATION, IOF_SHADIN_ALTITUDE,
+                       IOF_A429_BARO_UNCORR_ALTITUDE,
+                       IOF_A429_BARRO_CORR_ALTITUDE, IOF_A429_TRUE_AIR_SPEED,
+                       IOF_A429_COMPUTED_AIR_SPEED,
+                       IOF_MMDS_VOR_ILS_STATION_ID, IOF_SS_TRUE_AIRSPEED,
+                       IOF_TRAFFIC_LABELS_RX, IOF_AHRS_HEADING_ANGLE,
+                       IOF_AHRS_TRUE_HEADING, IOF_MPC1_IOF_CONTROL,
+                       IOF_MPC2_IOF_CONTROL, IOF_MPC2_GNSS_TX,
+                       IOF_MPC2_GNSS_RX, IOF_MPC2_GNSS_CNTL,
+                       IOF_FMS_RTC_DATE_TIME)
 
 fifty_ms = 50/1000.0
 one_hundred_ms = 100/1000.0
@@ -47,7 +36,6 @@ five_hundred_ms = 500/1000.0
 TASK_INTERVAL = fifty_ms
 CONTROL_START = 0
 CONTROL_INTERVAL = 1
-TIME_EPSILON = 10/1000.0
 
 GPS_START = fifty_ms
 GPS_INTERVAL = two_hundred_ms
@@ -61,30 +49,179 @@ AHRS_INTERVAL = two_hundred_ms
 FMS_RTC_START = two_hundred_ms
 FMS_RTC_INTERVAL = five_hundred_ms
 
+#packet layouts generated from the ksnlabels registry (every layout starts
+#with the "!H" label)
+PXPRESS_3A_CHANNELS = ksnlabels.GPS_CHANNELS
+PXPRESS_3A_FORMAT = ksnlabels.GPS_CHANNEL_STATUS.layout
+GPS_TIME_MARK_SIZE = ksnlabels.GPS_TIME_MARK.size
+GPS_POSITION_FORMAT = ksnlabels.GPS_TIME_MARK.sub_layout(None,
+                                                         "vertical_speed")[1]
+#year, month, day, hour, minute, second follow the position fields
+GPS_DATE_TIME_OFFSET, GPS_DATE_TIME_FORMAT = \
+    ksnlabels.GPS_TIME_MARK.sub_layout("year", "second")
+PXPRESS_31_FORMAT = ksnlabels.GPS_IOP_STATUS.layout
+SHADIN_ALTITUDE_FORMAT = ksnlabels.SHADIN_ALTITUDE.layout
+A429_ALTITUDE_FORMAT = ksnlabels.A429_BARO_CORR_ALTITUDE.layout
+A429_VALUE_FORMAT = ksnlabels.A429_TRUE_AIR_SPEED.layout
+MAGVAR_FORMAT = ksnlabels.FMS_MAGNETIC_VARIATION.layout
+TRAFFIC_FORMAT = ksnlabels.TRAFFIC.layout
+TRAFFIC_DUPLICATES_FORMAT = ksnlabels.TRAFFIC_DUPLICATES.layout
+ARINC_WORD_FORMAT = ksnlabels.ARINC_SPARE_RX3.layout
+FMS_RTC_FORMAT = ksnlabels.FMS_RTC_DATE_TIME.layout
+VOR_ID_FORMAT = ksnlabels.MMDS_VOR_ILS_STATION_ID.layout
+
+#ARINC 429 words of the traffic, traffic computer and TAWS labels, as the IOF
+#takes them (the label as written, no parity)
+TCAS_STATUS_WORD = word_layout(0o274, [
+    discrete("age", 9, 13), discrete("standby", 25), discrete("coast", 26),
+    discrete("operating", 28), discrete("bit32", 32)], name="tcas_status")
+TCAS_TEST_WORD = word_layout(0o016, [discrete("test", 25)], ssm=2,
+                             name="tcas_test")
+TCAS_COMPUTER_WORD = word_layout(0o350, [discrete("computer_unit", 10)],
+                                 name="tcas_computer")
+TAWS_WORD = word_layout(0o274, [discrete("ground_proximity", 12),
+                                discrete("pull_up", 13)], name="taws")
+#RTS and ETX around the intruder words, count being the words from RTS to
+#ETX
+BLOCK_WORD = word_layout(0o357, [discrete("count", 9, 8),
+                                 discrete("control", 25, 8)], name="block")
+RTS_CONTROL = 0x12
+ETX_CONTROL = 0x03
+INTRUDER_RANGE_WORD = word_layout(
+    0o130, [bnr("range", 17, 13, 1 / 128.0, overflow=arinc429.OVERFLOW_CLAMP)],
+    ssm=3, fixed=0x8000, name="intruder_range")
+INTRUDER_ALTITUDE_WORD = word_layout(
+    0o131, [discrete("trend", 11, 2),
+            bnr("altitude", 22, 8, 50.0, signed=True,
+                overflow=arinc429.OVERFLOW_CLAMP)],
+    ssm=3, fixed=0x108000, name="intruder_altitude")
+INTRUDER_BEARING_WORD = word_layout(
+    0o132, [discrete("threat", 16, 3),
+            bnr("bearing", 19, 11, 180 / 1024.0, signed=True,
+                overflow=arinc429.OVERFLOW_WRAP)],
+    ssm=3, name="intruder_bearing")
+
+#the words ksn_send sends, the one intruder is 5 NM away at 45 degrees,
+#1000 feet above
+TRAFFIC_UNAVAILABLE = TCAS_STATUS_WORD.encode()
+TRAFFIC_STANDBY = TCAS_STATUS_WORD.encode(standby=1)
+TRAFFIC_OPERATING = TCAS_STATUS_WORD.encode(operating=1, bit32=1)
+TRAFFIC_TEST = TCAS_TEST_WORD.encode(test=1)
+TRAFFIC_COMPUTER_UNIT = TCAS_COMPUTER_WORD.encode(computer_unit=1)
+TAWS_PULL_UP = TAWS_WORD.encode(pull_up=1)
+TAWS_GROUND_PROXIMITY = TAWS_WORD.encode(ground_proximity=1)
+TAWS_CLEAR = TAWS_WORD.encode()
+INTRUDER_RANGE = INTRUDER_RANGE_WORD.encode(range=5.0)
+INTRUDER_ALTITUDE = INTRUDER_ALTITUDE_WORD.encode(altitude=1000.0)
+#by intruder type, nt, ta, ra and pa
+INTRUDER_BEARINGS = [INTRUDER_BEARING_WORD.encode(threat, 45.0)
+                     for threat in range(4)]
+#around one intruder (5 words from RTS to ETX) and two (8 words)
+ONE_INTRUDER_RTS = BLOCK_WORD.encode(5, RTS_CONTROL)
+ONE_INTRUDER_ETX = BLOCK_WORD.encode(5, ETX_CONTROL)
+TWO_INTRUDERS_RTS = BLOCK_WORD.encode(8, RTS_CONTROL)
+TWO_INTRUDERS_ETX = BLOCK_WORD.encode(8, ETX_CONTROL)
+
+#message, channel count, then the number and status (0x04) of each channel
+PXPRESS_3A_VALUES = ((42, PXPRESS_3A_CHANNELS) +
+                     tuple(value for i in range(PXPRESS_3A_CHANNELS)
+                           for value in (i+1, 0x04)))
+
+
 class ksn_send(object):
-    def __init__(self, host, port):
-        '''Constructor'''
+    def __init__(self, host, port, batch=False, sock=None, recorder=None,
+                 stats=None, clock=None, transport=None):
+        '''Constructor.  transport (see ksntransport) defaults to UDP to
+        host:port on sock, which may be any object with the sendto() and
+        close() of a datagram socket (see ksnasync).  With batch the packets
+        due at the same time go out together at flush(), on a connected
+        socket.  recorder is an optional ksnrecord.packet_recorder that gets
+        a copy of every packet, stats an optional ksnstats.send_stats that
+        counts them.  clock (a ksnclock clock, real time by default) gives
+        the date and time sent.'''
         self.host = host
         self.port = port
-        self.sock = socket.socket(type=socket.SOCK_DGRAM)
+        if clock is None:
+            clock = ksnclock.real_clock()
+        self.clock = clock
+        if transport is None:
+            transport = ksntransport.udp_transport(host, port, batch=batch,
+                                                   sock=sock, timed=False)
+        self.transport = transport
+        self._transport_send = transport.send
+        
+        self.stats = stats
+        self.recorder = recorder
+        if recorder is not None:
+            self._record_target = recorder.target(host, port)
+        
+        #one reusable buffer per label, with the encoder generated from the
+        #registry.  Labels whose values do not change between ticks are
+        #encoded once and then resent as-is.
+        self._pxpress_3a = ksnlabels.GPS_CHANNEL_STATUS.payload()
+        self._gps_time_mark = bytearray(GPS_TIME_MARK_SIZE)
+        self._gps_position = None
+        self._pxpress_31 = ksnlabels.GPS_IOP_STATUS.payload()
+        self._shadin_alt = ksnlabels.SHADIN_ALTITUDE.payload()
+        self._a429_uncorr_alt = ksnlabels.A429_BARO_UNCORR_ALTITUDE.payload()
+        self._a429_corr_alt = ksnlabels.A429_BARO_CORR_ALTITUDE.payload()
+        self._a429_tas = ksnlabels.A429_TRUE_AIR_SPEED.payload()
+        self._ahrs_mag_heading = ksnlabels.AHRS_HEADING_ANGLE.payload()
+        self._ahrs_true_heading = ksnlabels.AHRS_TRUE_HEADING.payload()
+        self._magvar = ksnlabels.FMS_MAGNETIC_VARIATION.payload()
+        self._ias = ksnlabels.A429_COMPUTED_AIR_SPEED.payload()
+        self._trfc = ksnlabels.TRAFFIC.payload()
+        self._trfc_duplicates = ksnlabels.TRAFFIC_DUPLICATES.payload()
+        self._taws = ksnlabels.ARINC_SPARE_RX3.payload()
+        self._fms_rtc = ksnlabels.FMS_RTC_DATE_TIME.payload()
+        self._vor_id = ksnlabels.MMDS_VOR_ILS_STATION_ID.payload()
+        #block/unblock commands, keyed by (command, block flags)
+        self._iof_commands = {}
     
     
     def __send(self, package):
-        '''Internal socket wrapper'''
+        '''Internal transport wrapper'''
+        if self.recorder is not None:
+            self.recorder.record(self._record_target, package)
+        if self.stats is not None:
+            self.stats.packet(package)
         try:
-            self.sock.sendto(package, (self.host, self.port))
-        except socket.error, (value,message):
-            if value ==  errno.EHOSTDOWN or value == errno.EHOSTUNREACH:
-                pass
-            else:
-                self.close()
-                raise
+            self._transport_send(package)
+        except socket.error as error:
+            self.__send_error(error)
         return
     
     
+    def __send_error(self, error):
+        '''A down host, or a refused port or missing socket path (only seen
+        on connected and AF_UNIX sockets), is counted and ignored.  With
+        batching the error is reported once for the whole batch.'''
+        if error.args[0] in ksntransport.IGNORED_ERRORS:
+            if self.stats is not None:
+                self.stats.error(error.args[0])
+            return
+        self.close()
+        raise error
+    
+    
+    def flush(self):
+        '''Sends the packets queued since the last flush as one batch'''
+        try:
+            self.transport.flush()
+        except socket.error as error:
+            self.__send_error(error)
+    
+    
     def _send_iof_command(self, command, block_magvar, block_ias,
                          block_true_heading, block_time, block_vor_id):
         '''Block certain labels'''
+        key = (command, block_magvar, block_ias, block_true_heading,
+               block_time, block_vor_id)
+        package = self._iof_commands.get(key)
+        if package is not None:
+            self.__send(package)
+            return
+        
         label = struct.pack("!H", IOF_MPC2_IOF_CONTROL)
         str_format = "\0%d-%d"
         str_format += "\0%d"*2
@@ -111,7 +248,8 @@ class ksn_send(object):
         traffic is already being sent to the unit
         '''
         formatted_values = str_format % tuple(values)
-        package = label + command + formatted_values
+        package = label + (command + formatted_values).encode("ascii")
+        self._iof_commands[key] = package
         self.__send(package)
     
     
@@ -131,102 +269,103 @@ class ksn_send(object):
     
     def send_pxpress_3a(self):
         '''To keep fms happy'''
-        package = struct.pack("!HxBB", IOF_MPC2_GPS_CHANNEL_STATUS, 42, 6)
-        for i in range(6):
-            package += struct.pack("!BxBxxxxxxx", i+1, 0x04)
+        package = self._pxpress_3a.encode(*PXPRESS_3A_VALUES)
         self.__send(package)
     
     
     def send_gps_time_mark( self, latitude, longitude, altitude, ground_track,
                             ground_speed, vertical_speed):
         '''Send GPS info and current date/time'''
+        self.send_gps_time_mark_si(dec_to_rad(latitude), dec_to_rad(longitude),
+                                   ft_to_m(altitude), ground_track,
+                                   kts_to_mps(ground_speed),
+                                   ftpm_to_mps(vertical_speed))
+    
+    
+    def send_gps_time_mark_si(self, latitude, longitude, altitude,
+                              ground_track, ground_speed, vertical_speed):
+        '''Send GPS info and current date/time, with the position already in
+        radians, meters and meters per second'''
         label = IOF_GPS_TIME_MARK_INFO
+        package = self._gps_time_mark
         
-        current_time = time.localtime()
-        year = current_time.tm_year
-        month = current_time.tm_mon
-        day = current_time.tm_mday
-        hour = current_time.tm_hour
-        minute = current_time.tm_min
-        second = current_time.tm_sec
+        #only the time fields change between ticks unless the position does
+        position = (latitude, longitude, altitude, ground_track, ground_speed,
+                    vertical_speed)
+        if position != self._gps_position:
+            GPS_POSITION_FORMAT.pack_into(package, 0, label, latitude,
+                                          longitude, altitude, ground_track,
+                                          ground_speed, vertical_speed)
+            self._gps_position = position
         
-        package = struct.pack(  "!HddffffHBBBBBx", label, dec_to_rad(latitude), 
-                                dec_to_rad(longitude), ft_to_m(altitude),
-                                ground_track, kts_to_mps(ground_speed),
-                                ftpm_to_mps(vertical_speed), year, month, day,
-                                hour, minute, second)
+        current_time = self.clock.localtime()
+        GPS_DATE_TIME_FORMAT.pack_into(package, GPS_DATE_TIME_OFFSET,
+                                       current_time.tm_year,
+                                       current_time.tm_mon,
+                                       current_time.tm_mday,
+                                       current_time.tm_hour,
+                                       current_time.tm_min,
+                                       current_time.tm_sec)
         self.__send(package)
     
     
     def send_pxpress_31(self):
         '''To keep FMS happy'''
-        label = IOF_GPS_IOP_STATUS
         mode = 0x02
         hdop = vdop = 1
         hpe = vpe = 555
         hil = vil = 100
-
-        format = "!HxB""x""x""x""xxxx""ffffff""x""x""xx""x""xxxx""xxxx""xx""x"
         
-        package = struct.pack(  format, label, mode, hdop, hil, hpe, vdop, 
-                                vil, vpe)
+        package = self._pxpress_31.encode(mode, hdop, hil, hpe, vdop,
+                                          vil, vpe)
         self.__send(package)
     
     
     def send_shadin_barro_uncorr_alt(self, altitude):
         '''end uncorrected shadin altitude'''
-        label = IOF_SHADIN_ALTITUDE
-        #data1 is valid, data2 is invalid
-        package = struct.pack("!HBxxxfBxxxfxxxx", label, 1, altitude, 0, 0)
+        package = self._shadin_alt.encode(1, altitude, 0, 0)
         self.__send(package)
     
     
     def send_a429_barro_uncorr_alt(self, altitude):
         '''Send uncorrected ARINC 429 altitude'''
-        label = IOF_A429_BARO_UNCORR_ALTITUDE
-        package = struct.pack("!HBxxxfxxxxxxxx", label, 1, altitude)
+        package = self._a429_uncorr_alt.encode(1, altitude)
         self.__send(package)
     
     
     def send_a429_barro_corr_alt(self, altitude):
         '''Send corrected ARINC 429 altitude'''
-        label = IOF_A429_BARRO_CORR_ALTITUDE
-        package = struct.pack("!HBxxxfxxxxxxxx", label, 1, altitude)
+        package = self._a429_corr_alt.encode(1, altitude)
         self.__send(package)
     
     
     def send_a429_true_airspeed(self, tas):
         '''send TAS'''
-        label = IOF_A429_TRUE_AIR_SPEED
-        package = struct.pack("!HBxxxfxxxx", label, 1, tas)
+        package = self._a429_tas.encode(1, tas)
         self.__send(package)
     
     
     def send_ahrs_mag_heading_angle(self, angle):
         '''send mag heading'''
-        label = IOF_AHRS_HEADING_ANGLE
-        package = struct.pack("!HBxxxfxxxx", label, 1, angle)
+        package = self._ahrs_mag_heading.encode(1, angle)
         self.__send(package)
     
     
     def send_ahrs_true_heading_angle(self, angle):
         #send true heading
-        label = IOF_AHRS_TRUE_HEADING
-        package = struct.pack("!HBxxxfxxxx", label, 1, angle)
-        self.__send(package)    
+        package = self._ahrs_true_heading.encode(1, angle)
+        self.__send(package)
     
     
     def send_magvar(self, magvar):
         '''send magnetic variation'''
-        label = IOF_FMS_MAGNETIC_VARIATION
-        package = struct.pack("!Hf", label, magvar)
+        package = self._magvar.encode(magvar)
         self.__send(package)
 
 
     def send_ias(self, ias):
         '''send indicated airspeed'''
-        label = IOF_A429_COMPUTED_AIR_SPEED
-        package = struct.pack("!HBxxxfxxxx", label, 1, ias)
+        package = self._ias.encode(1, ias)
         self.__send(package)
     
     def _send_basic_trfc_packet(self, discrete_label, intruder_type):
@@ -236,58 +375,50 @@ class ksn_send(object):
             intruder_type = 0
         elif intruder_type > 3:
             intruder_type = 3
-        
-        label = IOF_TRAFFIC_LABELS_RX
-        arinc_rts = 0x120005EF # 5 count
-        arinc_etx = 0x030005EF # 5 count
-        intruder_range = 0x62808058
-        intruder_altitude = 0x62908059
-        intruder_bearing = 0x6400005A #bits 16, 17, 18 determine type
-        intruder_bearing |= (intruder_type << 15)
-        package = struct.pack("!HIIIIII", label, discrete_label, arinc_rts,
-                              intruder_range, intruder_altitude,
-                              intruder_bearing, arinc_etx)
+        package = self._trfc.encode(discrete_label, ONE_INTRUDER_RTS,
+                                    INTRUDER_RANGE, INTRUDER_ALTITUDE,
+                                    INTRUDER_BEARINGS[intruder_type],
+                                    ONE_INTRUDER_ETX)
         self.__send(package)
     
     
     def send_trfc_duplicates(self):
-        intruder_type = 0
-        label = IOF_TRAFFIC_LABELS_RX
-        discrete_label = 0x880000bc
-        arinc_rts = 0x120008EF # 8 count
-        arinc_etx = 0x030008EF # 8 count
-        intruder_range = 0x62808058
-        intruder_altitude = 0x62908059
-        intruder_bearing = 0x6400005A #bits 16, 17, 18 determine type
-        intruder_bearing |= (intruder_type << 15)
-        package = struct.pack("!HIIIIIIIII", label, discrete_label, arinc_rts,
-                              intruder_range, intruder_altitude, 
-                              intruder_bearing, intruder_range,
-                              intruder_altitude, intruder_bearing, arinc_etx)
+        #the same intruder twice
+        intruder_bearing = INTRUDER_BEARINGS[0]
+        package = self._trfc_duplicates.encode(TRAFFIC_OPERATING,
+                                               TWO_INTRUDERS_RTS,
+                                               INTRUDER_RANGE,
+                                               INTRUDER_ALTITUDE,
+                                               intruder_bearing,
+                                               INTRUDER_RANGE,
+                                               INTRUDER_ALTITUDE,
+                                               intruder_bearing,
+                                               TWO_INTRUDERS_ETX)
         self.__send(package)
     
     
+    def send_trfc_frames(self, frames):
+        '''sends traffic frames already encoded, e.g. by a
+        ksntraffic.traffic_engine'''
+        for package in frames:
+            self.__send(package)
+    
+    
     def send_trfc_comp_unit(self):
-        label = IOF_TRAFFIC_LABELS_RX
-        arinc_0350 = 0x000000e8
-        TCAS_COMPUTER_UNIT = 0x00000200
-        arinc_0350 |= TCAS_COMPUTER_UNIT
-        self._send_basic_trfc_packet(arinc_0350, 0)
+        self._send_basic_trfc_packet(TRAFFIC_COMPUTER_UNIT, 0)
     
     def send_trfc_unavailable(self, intruder_type):
         '''
         creates an unavailable annunciation
         '''
-        arinc_0274 = 0x000000bc
-        self._send_basic_trfc_packet(arinc_0274, intruder_type)
+        self._send_basic_trfc_packet(TRAFFIC_UNAVAILABLE, intruder_type)
     
     
     def send_trfc_standby(self, intruder_type):
         '''
         creates a stanby annunciaiton
         '''
-        arinc_0274 = 0x010000bc
-        self._send_basic_trfc_packet(arinc_0274, intruder_type)
+        self._send_basic_trfc_packet(TRAFFIC_STANDBY, intruder_type)
     
     
     def send_trfc_operating(self, intruder_type):
@@ -295,8 +426,7 @@ class ksn_send(object):
         displays a single intruder with no special annunciation, i.e. normal
         operations
         '''
-        arinc_0274 = 0x880000bc
-        self._send_basic_trfc_packet(arinc_0274, intruder_type)
+        self._send_basic_trfc_packet(TRAFFIC_OPERATING, intruder_type)
         
     
     def send_trfc_coast(self, age, intruder_type):
@@ -310,63 +440,243 @@ class ksn_send(object):
         if age >= 8192:
             age = 8191
             
-        age_offset = 8 #age starts at the ninth bit and goes to the 21st
-        arinc_0274 = 0x020000bc | (age << age_offset)
+        #age starts at the ninth bit and goes to the 21st
+        arinc_0274 = TCAS_STATUS_WORD.encode(age=age, coast=1)
         self._send_basic_trfc_packet(arinc_0274, intruder_type)
     
         
     def send_trfc_test(self, intruder_type):
         '''Creates a test annunciation'''
-        arinc_016 = 0x4100000e
-        self._send_basic_trfc_packet(arinc_016, intruder_type)
+        self._send_basic_trfc_packet(TRAFFIC_TEST, intruder_type)
         
         
     def send_TAWS_warning_popup(self):
         '''creates a TAWS warning popup'''
-        label = IOF_ARINC_SPARE_RX3_ARR
-        arinc_0274 = 0x00000010bc # GP_TAWS_ANNUN_PULL_UP should be set in 274
-        package = struct.pack("!HI", label, arinc_0274)
+        package = self._taws.encode(TAWS_PULL_UP)
         self.__send(package)
     
     
     def send_TAWS_caution_popup(self):
         '''creates a TAWS caution popup'''
-        label = IOF_ARINC_SPARE_RX3_ARR
-        arinc_0274 = 0x00000008bc # GP_TAWS_ANNUN_GND_PROX should be set in 274
-        package = struct.pack("!HI", label, arinc_0274)
+        package = self._taws.encode(TAWS_GROUND_PROXIMITY)
         self.__send(package)
     
     
     def send_TAWS_clear_inhibit_popup(self):
         '''clears TAWS popup inhibition (needs to be done to be able to send
         another TAWS popup)'''
-        label = IOF_ARINC_SPARE_RX3_ARR
-        arinc_0274 = 0x00000000bc # Blank 274 word
-        package = struct.pack("!HI", label, arinc_0274)
+        package = self._taws.encode(TAWS_CLEAR)
         self.__send(package)
     
    
     def send_fms_rtc(self, year, month, day, hours, minutes, seconds):
         '''sends fms real time clock information'''
-        label = IOF_FMS_RTC_DATE_TIME
-        package = struct.pack("!HBBBBBBH", label, seconds, minutes, hours, day,
-                              month, 1, year)
+        package = self._fms_rtc.encode(seconds, minutes, hours, day,
+                                       month, 1, year)
         self.__send(package)
         
     def send_vor_id(self, id):
         '''sends VOR ILS station id'''
-        label = IOF_MMDS_VOR_ILS_STATION_ID
         id = id[:4] #limit to 4
         while len(id) < 4:
             id += '\0'
-        id = id[::-1] #reverse
-        package = struct.pack("!Hcccc", label, id[0], id[1], id[2], id[3])
+        id = id[::-1].encode("ascii") #reverse
+        package = self._vor_id.encode(id)
         self.__send(package)
     
     
     def close(self):
-        '''closes the socket'''
-        self.sock.close()
+        '''closes the transport'''
+        self.transport.close()
+
+
+class ksn_scenario(object):
+    '''
+    The label groups sent by main(), built from the parsed command line
+    options.  Each send_* method sends one group through sender.  With a
+    state (a ksntraj.trajectory_player or a ksnownship.ownship) the position,
+    altitude, speeds and headings are sampled from it at each send instead.
+    traffic (a ksntraffic.traffic_engine) defaults to the --intruders one.
+    '''
+    def __init__(self, sender, options, state=None, traffic=None):
+        self.sender = sender
+        self.options = options
+        self.state = state
+        if traffic is None and options.intruders:
+            import ksntraffic
+            traffic = ksntraffic.from_options(options, sender.clock.now)
+        self.traffic = traffic
+        self._set_flags()
+    
+    
+    def _set_flags(self):
+        options = self.options
+        self.time_set = options.fms_rtc_sec != None or options.fms_clock
+        self.magvar_set = options.magvar != None
+        self.ias_set = options.ias != None
+        self.true_heading_set = options.trueheading != None
+        self.barro_uncorr_alt_set = options.barro_uncorr_alt != None
+        self.shadin_uncorr_alt_set = options.shadin_uncorr_alt != None
+        self.vor_id_set = options.vor_id != None
+    
+    
+    def update(self, options, changed):
+        '''
+        Switches to new options between two ticks (see ksncontrol).  changed
+        names the options that differ.  The labels keep their cached packets
+        and only the ones whose values changed are encoded again.  A TAWS
+        popup that changed is cleared first so the new one shows, new
+        --intruders options start a new traffic engine.
+        '''
+        if "taws_popup" in changed and self.options.taws_popup != None:
+            self.sender.send_TAWS_clear_inhibit_popup()
+        self.options = options
+        if ("intruders" in changed or "intruder_seed" in changed or
+                "intruders_per_frame" in changed):
+            self.traffic = None
+            if options.intruders:
+                import ksntraffic
+                self.traffic = ksntraffic.from_options(options,
+                                                       self.sender.clock.now)
+        self._set_flags()
+    
+    
+    def tasks(self, overrun=ksnsched.OVERRUN_SKIP):
+        '''The periodic tasks for every label group, at the option rates'''
+        options = self.options
+        return [
+            ksnsched.periodic_task("control", CONTROL_START,
+                                   options.ctrl_interval / 1000.0,
+                                   self.send_control, overrun),
+            ksnsched.periodic_task("gps", GPS_START,
+                                   options.gps_interval / 1000.0,
+                                   self.send_gps, overrun),
+            ksnsched.periodic_task("adc", ADC_START,
+                                   options.adc_interval / 1000.0,
+                                   self.send_adc, overrun),
+            ksnsched.periodic_task("ahrs", AHRS_START,
+                                   options.ahrs_interval / 1000.0,
+                                   self.send_ahrs, overrun),
+            ksnsched.periodic_task("fms_rtc", FMS_RTC_START,
+                                   options.rtc_interval / 1000.0,
+                                   self.send_fms_rtc, overrun)]
+    
+    
+    def send_control(self):
+        ksnsend = self.sender
+        options = self.options
+        ksnsend.send_block_iof(self.magvar_set, self.ias_set,
+                               self.true_heading_set, self.time_set,
+                               self.vor_id_set)
+        
+        ksnsend.send_pxpress_3a()
+        if self.magvar_set:
+            ksnsend.send_magvar(options.magvar)
+        if self.ias_set:
+            ksnsend.send_ias(options.ias);
+    
+    
+    def send_gps(self):
+        ksnsend = self.sender
+        options = self.options
+        if self.state is not None:
+            state = self.state.sample()
+            ksnsend.send_gps_time_mark_si(state.latitude, state.longitude,
+                                          state.altitude, state.ground_track,
+                                          state.ground_speed,
+                                          state.vertical_speed)
+            ksnsend.send_pxpress_31()
+            return
+        ksnsend.send_gps_time_mark(options.lat, options.lon, 
+                                   options.alt, options.ground_track,
+                                   options.ground_speed, 
+                                   options.vertical_speed)
+        ksnsend.send_pxpress_31()
+    
+    
+    def send_adc(self):
+        ksnsend = self.sender
+        options = self.options
+        if self.state is not None:
+            state = self.state.sample()
+            if self.barro_uncorr_alt_set:
+                ksnsend.send_a429_barro_uncorr_alt(state.baro_altitude)
+            else:
+                ksnsend.send_a429_barro_corr_alt(state.baro_altitude)
+            ksnsend.send_a429_true_airspeed(state.true_airspeed)
+        else:
+            if self.barro_uncorr_alt_set:
+                ksnsend.send_a429_barro_uncorr_alt(options.barro_uncorr_alt)
+            else:
+                ksnsend.send_a429_barro_corr_alt(options.barro_corr_alt)
+            ksnsend.send_a429_true_airspeed(options.true_airspeed)
+        
+        if self.shadin_uncorr_alt_set:
+            ksnsend.send_shadin_barro_uncorr_alt(options.shadin_uncorr_alt)
+            
+        if options.traffic_type == "s":
+            ksnsend.send_trfc_standby(options.intruder_type)
+        elif options.traffic_type == "u":
+            ksnsend.send_trfc_unavailable(options.intruder_type)
+        elif options.traffic_type == "c":
+            ksnsend.send_trfc_coast(options.coast_age,
+                                    options.intruder_type)
+        elif options.traffic_type == "t":
+            ksnsend.send_trfc_test(options.intruder_type)
+        elif options.traffic_type == "n":
+            ksnsend.send_trfc_operating(options.intruder_type)
+        elif options.traffic_type == "d":
+            ksnsend.send_trfc_duplicates()
+        elif options.traffic_type == "f":
+            ksnsend.send_trfc_comp_unit()
+        elif self.traffic is not None:
+            ksnsend.send_trfc_frames(self.traffic.update())
+        
+        if options.taws_popup == "w":
+            ksnsend.send_TAWS_warning_popup()
+        elif options.taws_popup == "c":
+            ksnsend.send_TAWS_caution_popup()
+    
+    
+    def send_ahrs(self):
+        ksnsend = self.sender
+        options = self.options
+        if self.vor_id_set:
+            ksnsend.send_vor_id(options.vor_id)
+        if self.state is not None:
+            state = self.state.sample()
+            ksnsend.send_ahrs_mag_heading_angle(state.magheading)
+            if self.true_heading_set:
+                ksnsend.send_ahrs_true_heading_angle(state.true_heading)
+        else:
+            ksnsend.send_ahrs_mag_heading_angle(options.magheading)
+            if self.true_heading_set:
+                ksnsend.send_ahrs_true_heading_angle(options.trueheading)
+    
+    
+    def send_fms_rtc(self):
+        #should go once every half-second (at least that is what the fms does)
+        options = self.options
+        if options.fms_clock:
+            now = self.sender.clock.localtime()
+            self.sender.send_fms_rtc(now.tm_year, now.tm_mon, now.tm_mday,
+                                     now.tm_hour, now.tm_min, now.tm_sec)
+        elif self.time_set:
+            self.sender.send_fms_rtc(options.fms_rtc_year,
+                                     options.fms_rtc_month,
+                                     options.fms_rtc_day,
+                                     options.fms_rtc_hour,
+                                     options.fms_rtc_min,
+                                     options.fms_rtc_sec)
+    
+    
+    def send_cleanup(self):
+        '''unblocks the labels and clears the TAWS popup inhibition'''
+        self.sender.send_unblock_iof(self.magvar_set, self.ias_set,
+                                     self.true_heading_set, self.time_set,
+                                     self.vor_id_set)
+        if self.options.taws_popup != None:
+            self.sender.send_TAWS_clear_inhibit_popup()
 
 
 def handle_rtc_time(option, opt_str, value, parser):
@@ -449,6 +759,12 @@ def setup_command_line():
     parser.add_option(  "--fmstime", action="callback", callback=handle_rtc_time,
                         help=help, type="int", dest="fms_rtc_sec",nargs=6);
 
+    help = "If true, the FMS real time clock is sent with the date and time "
+    help += "of the clock (see --clock), like the GPS time mark. "
+    help += "[default:%default]"
+    parser.add_option(  "--fmsclock", action="store_true", dest="fms_clock",
+                        help=help, default=False);
+
     help = "Timeout of the script (in seconds).  If not set, the script will run"
     help += " until the keyboard interrupt signal (Ctrl-C) is given."
     parser.add_option(  "--timeout", action="store", dest="timeout", help=help,
@@ -517,6 +833,21 @@ def setup_command_line():
                       callback=handle_intruder_type, dest="intruder_type",
                       help=help, type="choice", choices=choices, default=0)
     
+    help = "Sends this many moving intruders (see ksntraffic.py) with no "
+    help += "annunciation instead of a traffic type.  Not sent by default."
+    parser.add_option(  "--intruders", action="store", dest="intruders",
+                        help=help, type="int", default=0);
+    help = "Seed of the --intruders positions and motion, the same seed "
+    help += "gives the same traffic. [default:%default]"
+    parser.add_option(  "--intruderseed", action="store",
+                        dest="intruder_seed", help=help, type="int",
+                        default=0);
+    help = "Intruders per traffic packet for --intruders, the rest go in "
+    help += "more packets. [default:%default]"
+    parser.add_option(  "--intrudersperframe", action="store",
+                        dest="intruders_per_frame", help=help, type="int",
+                        default=30);
+    
     help = "Age of the coast annunciation.  Ages > 12 changes the coast "
     help += "annunciation to a removed annunciation.  Ages should be greater "
     help += "than or equal to 0 and less than 8192.  Option is ignored if the "
@@ -536,6 +867,133 @@ def setup_command_line():
     help = "the id blink on the simulator since the simulator self-sends the id."
     parser.add_option("--ident", action="store", dest="vor_id", help=help)
     
+    help = "Period of the block command, pxpress 3A, magvar and IAS (in "
+    help += "milliseconds). [default:%default]"
+    parser.add_option(  "--ctrlinterval", action="store", dest="ctrl_interval",
+                        help=help, type="float",
+                        default=CONTROL_INTERVAL*1000);
+    help = "Period of the GPS time mark and pxpress 31 (in milliseconds). "
+    help += "[default:%default]"
+    parser.add_option(  "--gpsinterval", action="store", dest="gps_interval",
+                        help=help, type="float", default=GPS_INTERVAL*1000);
+    help = "Period of the air data, traffic and TAWS labels (in milliseconds). "
+    help += "[default:%default]"
+    parser.add_option(  "--adcinterval", action="store", dest="adc_interval",
+                        help=help, type="float", default=ADC_INTERVAL*1000);
+    help = "Period of the AHRS labels and VOR id (in milliseconds). "
+    help += "[default:%default]"
+    parser.add_option(  "--ahrsinterval", action="store", dest="ahrs_interval",
+                        help=help, type="float", default=AHRS_INTERVAL*1000);
+    help = "Period of the FMS real time clock (in milliseconds). "
+    help += "[default:%default]"
+    parser.add_option(  "--rtcinterval", action="store", dest="rtc_interval",
+                        help=help, type="float",
+                        default=FMS_RTC_INTERVAL*1000);
+    help = "What to do when a label group misses its deadline.  'skip' drops "
+    help += "the missed periods, 'catchup' sends them back to back. "
+    help += "[default:%default]"
+    parser.add_option(  "--overrun", action="store", dest="overrun",
+                        help=help, type="choice",
+                        choices=ksnsched.OVERRUN_POLICIES,
+                        default=ksnsched.OVERRUN_SKIP);
+    
+    help = "The clock the label groups run on.  'real' is real time, "
+    help += "'virtual' jumps straight to the next deadline, so a run takes "
+    help += "only the time to send its packets and sends the same ones at the "
+    help += "same clock times every run, and 'scaled' runs clockspeed times "
+    help += "faster than real time.  The timeout, the trajectory and the "
+    help += "sent date and time follow it. [default:%default]"
+    parser.add_option(  "--clock", action="store", dest="clock", help=help,
+                        type="choice", choices=ksnclock.CLOCKS,
+                        default="real");
+    help = "How many times faster than real time the scaled clock runs. "
+    help += "[default:%default]"
+    parser.add_option(  "--clockspeed", action="store", dest="clock_speed",
+                        help=help, type="float", default=10.0);
+    help = "The date and time the virtual or scaled clock starts at, as "
+    help += "YYYY-MM-DDTHH:MM:SS local time.  The current time by default."
+    parser.add_option(  "--clockstart", action="store", dest="clock_start",
+                        help=help);
+    
+    help = "If true, the packets due at the same time are sent as one batch "
+    help += "(sendmmsg on Linux) on a connected socket. [default:%default]"
+    parser.add_option(  "--batch", action="store_true", dest="batch",
+                        help=help, default=False);
+    help = "How the packets are sent.  'udp' sends them to the host and port, "
+    help += "'udpconnected' too on a connected socket, 'unix' to the AF_UNIX "
+    help += "datagram socket bound at transportpath and 'ring' writes them to "
+    help += "the shared memory ring buffer file transportpath for a local "
+    help += "simulator (see ksntransport.py). [default:%default]"
+    parser.add_option(  "--transport", action="store", dest="transport",
+                        help=help, type="choice",
+                        choices=ksntransport.TRANSPORTS, default="udp");
+    help = "The socket path or ring file of the unix and ring transports."
+    parser.add_option(  "--transportpath", action="store",
+                        dest="transport_path", help=help);
+    help = "How many packets the ring holds. [default:%default]"
+    parser.add_option(  "--ringslots", action="store", dest="ring_slots",
+                        help=help, type="int",
+                        default=ksntransport.RING_SLOTS);
+    
+    help = "Records every packet sent, with its time, to NAME.NNNN.ksnrec "
+    help += "segments (see ksnrecord.py).  Not used by default."
+    parser.add_option(  "--record", action="store", dest="record",
+                        metavar="NAME", help=help);
+    help = "Size at which a recording segment is closed and the next one "
+    help += "started (in megabytes). [default:%default]"
+    parser.add_option(  "--recordsize", action="store", dest="record_size",
+                        help=help, type="int", default=256);
+    
+    help = "If true, a one-line summary of the packet rates, send lateness, "
+    help += "overruns and errors is printed every statsinterval seconds. "
+    help += "[default:%default]"
+    parser.add_option(  "--stats", action="store_true", dest="stats",
+                        help=help, default=False);
+    help = "[default:%default]"
+    parser.add_option(  "--statsinterval", action="store",
+                        dest="stats_interval", help=help, type="float",
+                        default=5);
+    help = "Writes the send statistics as JSON to this file at the end.  Not "
+    help += "used by default."
+    parser.add_option(  "--statsfile", action="store", dest="stats_file",
+                        help=help);
+    help = "Answers connections to this local TCP port with the send "
+    help += "statistics as JSON (see ksnstats.py).  Not used by default."
+    parser.add_option(  "--statsport", action="store", dest="stats_port",
+                        help=help, type="int");
+    
+    help = "Plays back a trajectory (CSV, or compiled with ksntraj.py) "
+    help += "instead of sending a constant position, altitude, speeds and "
+    help += "heading.  Not used by default."
+    parser.add_option(  "--trajectory", action="store", dest="trajectory",
+                        help=help);
+    help = "If true, the trajectory starts over at its end instead of holding "
+    help += "the last sample. [default:%default]"
+    parser.add_option(  "--trajectoryloop", action="store_true",
+                        dest="trajectory_loop", help=help, default=False);
+    
+    help = "If true, the position and altitude move with the ground speed, "
+    help += "track (in radians) and vertical speed, and the AHRS headings "
+    help += "follow the track. [default:%default]"
+    parser.add_option(  "--deadreckoning", action="store_true",
+                        dest="dead_reckoning", help=help, default=False);
+    help = "A scripted manoeuvre for --deadreckoning, as time:kind:value with "
+    help += "the time in seconds from start and kind 'track' (degrees), "
+    help += "'altitude' (feet) or 'speed' (knots).  Repeat for every "
+    help += "manoeuvre."
+    parser.add_option(  "--manoeuvre", action="append", dest="manoeuvres",
+                        help=help, default=[]);
+    help = "Integration step of --deadreckoning (in milliseconds). "
+    help += "[default:%default]"
+    parser.add_option(  "--modelstep", action="store", dest="model_step",
+                        help=help, type="float", default=50);
+    
+    help = "Accepts live option updates (see ksncontrol.py) on this local UDP "
+    help += "port, or the AF_UNIX datagram socket at this path, and applies "
+    help += "them between two ticks.  Not used by default."
+    parser.add_option(  "--control", action="store", dest="control",
+                        metavar="PORT|PATH", help=help);
+    
     help = "If true, the script does not send the unblock command at the end. "
     help += "[default:%default]"
     parser.add_option(  "--nocleanup", action="store_true", dest="nocleanup",
@@ -569,148 +1027,232 @@ def valid_coast_age(age):
         return False
 
 
-def main():
-    parser = setup_command_line()
-    (options, args) = parser.parse_args()
+def parse_command_line(args=None, parser=None):
+    '''Parses and checks the command line, returns the options.  parser
+    defaults to setup_command_line(), tools may pass an extended one.'''
+    if parser is None:
+        parser = setup_command_line()
+    (options, args) = parser.parse_args(args)
+    check_options(parser, options)
     
-    traffic_type_set = False
+    #don't need the parser anymore
+    parser.destroy()
+    return options
+
+
+def check_options(parser, options):
+    '''Checks the options that depend on each other, calls parser.error()
+    with the first problem'''
     if options.traffic_type != None:
-        traffic_type_set = True
         if options.traffic_type == "c" and not valid_coast_age(options.coast_age):
             parser.error("coastage must be greater than or equal to 0 and less than 8192.")
     
-    timeout_set = False
+    if options.intruders < 0:
+        parser.error("intruders must be greater than or equal to 0")
+    if options.intruders:
+        import ksntraffic
+        if options.traffic_type != None:
+            parser.error("--intruders and --traffictype are exclusive")
+        if not 1 <= options.intruders_per_frame <= ksntraffic.MAX_PER_FRAME:
+            parser.error("intrudersperframe must be in [1,%d]" %
+                         ksntraffic.MAX_PER_FRAME)
+    
     if options.timeout != None:
-        timeout_set = True
         if options.timeout < 0:
             parser.error("timeout must be greater than or equal to 0")
     
-    time_set = options.fms_rtc_sec != None
-    magvar_set = options.magvar != None
-    ias_set = options.ias != None
-    true_heading_set = options.trueheading != None
-    barro_uncorr_alt_set = options.barro_uncorr_alt != None
-    shadin_uncorr_alt_set = options.shadin_uncorr_alt != None
-    vor_id_set = options.vor_id != None
-    
-    #don't need the parser anymore
-    parser.destroy()
+    for interval in (options.ctrl_interval, options.gps_interval,
+                     options.adc_interval, options.ahrs_interval,
+                     options.rtc_interval):
+        if interval <= 0:
+            parser.error("label intervals must be greater than 0")
+    
+    if options.trajectory != None and options.dead_reckoning:
+        parser.error("--trajectory and --deadreckoning are exclusive")
+    if options.model_step <= 0:
+        parser.error("modelstep must be greater than 0")
+    if options.record_size <= 0:
+        parser.error("recordsize must be greater than 0")
+    if options.stats_interval <= 0:
+        parser.error("statsinterval must be greater than 0")
+    if options.clock_speed <= 0:
+        parser.error("clockspeed must be greater than 0")
+    if options.clock_start != None:
+        if options.clock == "real":
+            parser.error("--clockstart needs a virtual or scaled --clock")
+        try:
+            ksnclock.parse_start(options.clock_start)
+        except ValueError as error:
+            parser.error("clockstart: %s" % error)
+    if options.fms_clock and options.fms_rtc_sec != None:
+        parser.error("--fmsclock and --fmstime are exclusive")
+    if options.transport in ("unix", "ring"):
+        if options.transport_path == None:
+            parser.error("--transport %s needs --transportpath" %
+                         options.transport)
+    elif options.transport_path != None:
+        parser.error("--transportpath needs the unix or ring --transport")
+    if options.transport == "ring" and options.batch:
+        parser.error("--batch needs a socket --transport")
+    if options.ring_slots <= 0:
+        parser.error("ringslots must be greater than 0")
+    if options.control != None:
+        import ksncontrol
+        try:
+            ksncontrol.parse_address(options.control)
+        except ValueError as error:
+            parser.error("control: %s" % error)
+
+
+class state_error(Exception):
+    pass
+
+
+def ownship_state(options, clock=ksnsched.monotonic):
+    '''
+    The trajectory player (--trajectory) or dead-reckoning model
+    (--deadreckoning) the options ask for, None for the fixed position
+    options.  Raises state_error when the trajectory or a manoeuvre cannot
+    be read.
+    '''
+    if options.trajectory != None:
+        import ksntraj
+        try:
+            trajectory = ksntraj.load(options.trajectory)
+        except (IOError, OSError, ksntraj.trajectory_error) as error:
+            raise state_error(str(error))
+        return ksntraj.trajectory_player(trajectory,
+                                         ksntraj.option_defaults(options),
+                                         loop=options.trajectory_loop,
+                                         clock=clock)
+    if options.dead_reckoning:
+        import ksnownship
+        try:
+            manoeuvres = [ksnownship.parse_manoeuvre(text)
+                          for text in options.manoeuvres]
+        except ValueError as error:
+            raise state_error(str(error))
+        return ksnownship.from_options(options, manoeuvres, clock)
+    return None
+
+
+def check_ownship_state(options):
+    '''Raises state_error if ownship_state() would, without keeping the
+    trajectory it opens mapped'''
+    state = ownship_state(options)
+    close = getattr(state, "close", None)
+    if close is not None:
+        close()
+
+
+def main():
+    options = parse_command_line()
+    
+    #everything timed runs on the same clock
+    clock = ksnclock.from_options(options)
+    recorder = None
+    if options.record != None:
+        import ksnrecord
+        recorder = ksnrecord.packet_recorder(
+            options.record, max_segment_bytes=options.record_size << 20,
+            clock=clock.now)
+    stats = None
+    if (options.stats or options.stats_file != None or
+            options.stats_port != None):
+        import ksnstats
+        stats = ksnstats.send_stats(clock=clock.now)
+        if options.stats_port != None:
+            stats.serve(options.stats_port)
+    try:
+        transport = ksntransport.from_options(options,
+                                              timed=stats is not None)
+    except (socket.error, ValueError) as error:
+        sys.exit("error: %s: %s" % (options.transport, error))
+    if stats is not None:
+        stats.transport = transport.stats
+    ksnsend = ksn_send(host=options.host, port=options.port,
+                       recorder=recorder, stats=stats, clock=clock,
+                       transport=transport)
+    try:
+        state = ownship_state(options, clock.now)
+    except state_error as error:
+        ksnsend.close()
+        sys.exit("error: %s" % error)
+    scenario = ksn_scenario(ksnsend, options, state)
+    control = None
+    on_tick = ksnsend.flush
+    if options.control != None:
+        import ksncontrol
+        try:
+            control = ksncontrol.control_server(options.control, scenario,
+                                                setup_command_line(),
+                                                check_options)
+        except (socket.error, ValueError) as error:
+            ksnsend.close()
+            sys.exit("error: control %s: %s" % (options.control, error))
+        print("Accepting option updates on %s" % control.name)
+        def on_tick():
+            control.apply()
+            ksnsend.flush()
+    
+    #set up the label groups at their absolute deadlines, everything a tick
+    #sends goes out together
+    scheduler = ksnsched.deadline_scheduler(clock=clock.now,
+                                            sleep=clock.sleep,
+                                            on_tick=on_tick,
+                                            stats=stats)
+    for task in scenario.tasks(options.overrun):
+        scheduler.add(task)
+    if stats is not None:
+        stats.watch(scheduler.tasks)
+        if options.stats:
+            scheduler.add(ksnsched.periodic_task(
+                "stats", options.stats_interval, options.stats_interval,
+                lambda: print(stats.summary())))
     
-    ksnsend = ksn_send(host=options.host, port=options.port)
-    
-    #set up times
-    ctrl_next_time = CONTROL_START - TIME_EPSILON
-    gps_next_time = GPS_START - TIME_EPSILON
-    adc_next_time = ADC_START - TIME_EPSILON
-    ahrs_next_time = AHRS_START - TIME_EPSILON
-    fms_rtc_next_time = FMS_RTC_START - TIME_EPSILON
-    end_time = None
-    if timeout_set:
-        print "Sending data for %d seconds" % options.timeout
-    print "Terminate with Ctrl-Break on Win32, Ctr-C on Unix"
-    print "(Run with the -h or --help option for further help)"
+    if options.timeout != None:
+        print("Sending data for %d seconds" % options.timeout)
+    print("Terminate with Ctrl-Break on Win32, Ctr-C on Unix")
+    print("(Run with the -h or --help option for further help)")
     try:
-        
-        while True:
-            now = time.time()
-            if timeout_set:
-                if end_time == None:
-                    end_time = now + options.timeout
-                
-                if now > end_time:
-                    break
-            
-            if now >= ctrl_next_time:
-                ctrl_nex_time = now + CONTROL_INTERVAL - TIME_EPSILON
-                
-                ksnsend.send_block_iof(magvar_set, ias_set, true_heading_set,
-                                       time_set, vor_id_set)
-                
-                ksnsend.send_pxpress_3a()
-                if magvar_set:
-                    ksnsend.send_magvar(options.magvar)
-                if ias_set:
-                    ksnsend.send_ias(options.ias);
-            
-            if now >= gps_next_time:
-                gps_next_time = now + GPS_INTERVAL - TIME_EPSILON
-                ksnsend.send_gps_time_mark(options.lat, options.lon, 
-                                        options.alt, options.ground_track,
-                                        options.ground_speed, 
-                                        options.vertical_speed)
-                ksnsend.send_pxpress_31()
-            
-            if now >= adc_next_time:
-                adc_next_time = now + ADC_INTERVAL - TIME_EPSILON
-                if barro_uncorr_alt_set:
-                    ksnsend.send_a429_barro_uncorr_alt(options.barro_uncorr_alt)
-                else:
-                    ksnsend.send_a429_barro_corr_alt(options.barro_corr_alt)
-                ksnsend.send_a429_true_airspeed(options.true_airspeed)
-                
-                if shadin_uncorr_alt_set:
-                    ksnsend.send_shadin_barro_uncorr_alt(options.shadin_uncorr_alt)
-                    
-                if options.traffic_type == "s":
-                    ksnsend.send_trfc_standby(options.intruder_type)
-                elif options.traffic_type == "u":
-                    ksnsend.send_trfc_unavailable(options.intruder_type)
-                elif options.traffic_type == "c":
-                    ksnsend.send_trfc_coast(options.coast_age,
-                                            options.intruder_type)
-                elif options.traffic_type == "t":
-                    ksnsend.send_trfc_test(options.intruder_type)
-                elif options.traffic_type == "n":
-                    ksnsend.send_trfc_operating(options.intruder_type)
-                elif options.traffic_type == "d":
-                    ksnsend.send_trfc_duplicates()
-                elif options.traffic_type == "f":
-                    ksnsend.send_trfc_comp_unit()
-                
-                if options.taws_popup == "w":
-                    ksnsend.send_TAWS_warning_popup()
-                elif options.taws_popup == "c":
-                    ksnsend.send_TAWS_caution_popup()
-            
-            if now >= ahrs_next_time:
-                ahrs_next_time = now + AHRS_INTERVAL - TIME_EPSILON
-                if vor_id_set:
-                    ksnsend.send_vor_id(options.vor_id)
-                ksnsend.send_ahrs_mag_heading_angle(options.magheading)
-                if true_heading_set:
-                    ksnsend.send_ahrs_true_heading_angle(options.trueheading)
-
-            if now >= fms_rtc_next_time:
-                fms_rtc_next_time = now + FMS_RTC_INTERVAL - TIME_EPSILON
-                #should go once every half-second (at least that is what the
-                #fms does)
-                if time_set:
-                    ksnsend.send_fms_rtc(options.fms_rtc_year,
-                                         options.fms_rtc_month,
-                                         options.fms_rtc_day,
-                                         options.fms_rtc_hour,
-                                         options.fms_rtc_min,
-                                         options.fms_rtc_sec)
-            
-            time.sleep(TASK_INTERVAL)
+        if state is not None:
+            state.start()
+        scheduler.run(options.timeout)
     except KeyboardInterrupt:
-        print ""
-        print "Shutting down..."
+        print("")
+        print("Shutting down...")
     except:
-        print "Unexpected error:", sys.exc_info()[0]
+        print("Unexpected error:", sys.exc_info()[0])
         raise
     finally:
+        if control is not None:
+            control.close()
+            print("Control: %s" % control.stats.summary())
         if not options.nocleanup:
-            print "Cleaning up..."
+            print("Cleaning up...")
             #sending a few to try and make sure it gets unblocked
             for i in range(0, 10):
-                ksnsend.send_unblock_iof(magvar_set, ias_set, true_heading_set,
-                                     time_set, vor_id_set)
-                if options.taws_popup != None:
-                    ksnsend.send_TAWS_clear_inhibit_popup()
-                time.sleep(TASK_INTERVAL)
+                scenario.send_cleanup()
+                ksnsend.flush()
+                clock.sleep(TASK_INTERVAL)
         ksnsend.close()
-        print "Done"
+        if stats is not None:
+            stats.close()
+            if options.stats:
+                print("Transport %s: %s" % (transport.name,
+                                            transport.stats.summary()))
+            if options.stats_file != None:
+                stats.dump(options.stats_file)
+        if recorder is not None:
+            try:
+                recorder.close()
+            except (IOError, OSError) as error:
+                print("Recording stopped: %s (%d packets dropped)" %
+                      (error, recorder.dropped))
+            else:
+                print("Recorded %d packets in %d segments" %
+                      (recorder.records, recorder.segment + 1))
+        print("Done")
         
 if __name__ == "__main__":
-    main();
\ No newline at end of file
+    main();
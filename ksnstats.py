@@ -0,0 +1,280 @@
+#! /usr/bin/env python
+'''
+Send-timing instrumentation for ksnsend.
+
+A send_stats counts the packets and bytes of every label, how late each
+packet was sent compared to the deadline of the label group that sent it,
+the errors ksn_send ignores, and the overruns of the scheduler tasks.  The
+lateness goes into fixed-size log-linear histograms (HDR style, about 3%
+precision from 1 microsecond to over half an hour), so memory does not grow
+with the length of the run.
+
+It is read as a periodic one-line summary, as JSON (snapshot(), or dump()
+at shutdown) and through a local TCP port that answers every connection
+with the JSON snapshot:
+
+    ksnstats.py 3480
+
+With --batch the lateness is measured when the packet is queued, the batch
+goes out at the end of the same tick.
+'''
+
+from __future__ import print_function
+import sys
+import json
+import errno
+import socket
+import struct
+import threading
+
+import ksnsched
+
+LABEL_FORMAT = struct.Struct("!H")
+#histogram layout: 2**SUB_BUCKET_BITS values per power of two
+SUB_BUCKET_BITS = 6
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+MAX_VALUE_BITS = 32
+MAX_BUCKET = MAX_VALUE_BITS - SUB_BUCKET_BITS
+PERCENTILES = [50.0, 90.0, 99.0, 99.9]
+QUERY_HOST = "127.0.0.1"
+
+
+class latency_histogram(object):
+    '''
+    Counts of integer values (microseconds) in log-linear buckets: exact
+    below SUB_BUCKET_COUNT, then SUB_BUCKET_HALF buckets per power of two.
+    Values above 2**MAX_VALUE_BITS - 1 are clamped.
+    '''
+    __slots__ = ("counts", "count", "total", "min", "max")
+
+    SIZE = ((MAX_VALUE_BITS - SUB_BUCKET_BITS) * SUB_BUCKET_HALF +
+            SUB_BUCKET_COUNT)
+
+    def __init__(self):
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.total = 0
+        self.min = 1 << MAX_VALUE_BITS
+        self.max = 0
+
+
+    @staticmethod
+    def value_at(index):
+        '''The middle of the values counted at index'''
+        if index < SUB_BUCKET_COUNT:
+            return index
+        bucket = (index - SUB_BUCKET_COUNT) // SUB_BUCKET_HALF + 1
+        low = (index - bucket * SUB_BUCKET_HALF) << bucket
+        return low + (1 << (bucket - 1))
+
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        bucket = value.bit_length() - SUB_BUCKET_BITS
+        if bucket <= 0:
+            index = value
+        else:
+            if bucket > MAX_BUCKET:
+                value = (1 << MAX_VALUE_BITS) - 1
+                bucket = MAX_BUCKET
+            index = bucket * SUB_BUCKET_HALF + (value >> bucket)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value < self.min:
+            self.min = value
+
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        rank = max(int(self.count * percent / 100.0 + 0.5), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.value_at(index), self.max)
+        return self.max
+
+
+    def summary(self):
+        result = {"count": self.count, "max": self.max,
+                  "min": self.min if self.count else 0,
+                  "mean": float(self.total) / self.count if self.count else 0}
+        for percent in PERCENTILES:
+            result["p%g" % percent] = self.percentile(percent)
+        return result
+
+
+class label_counter(object):
+    '''Packets, bytes and send lateness of one label'''
+    __slots__ = ("packets", "bytes", "lateness")
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.lateness = latency_histogram()
+
+
+class send_stats(object):
+    '''
+    Filled in by ksn_send (packet() and error()) and by a deadline_scheduler,
+    which sets deadline while a task runs.  The scheduler tasks passed to
+    watch() are reported with their runs, overruns and skipped periods.
+    '''
+    def __init__(self, clock=ksnsched.monotonic):
+        self.clock = clock
+        self.deadline = None
+        self.labels = {}
+        self.errors = {}
+        self.tasks = []
+        self.start = clock()
+        self.packets = 0
+        self.bytes = 0
+        self._last = (self.start, 0, 0)
+        self._server = None
+        #the ksntransport.transport_stats of the sender, when set
+        self.transport = None
+
+
+    def watch(self, tasks):
+        self.tasks.extend(tasks)
+
+
+    def packet(self, package, unpack_from=LABEL_FORMAT.unpack_from):
+        '''Counts a packet as it is handed to the socket'''
+        label = unpack_from(package)[0]
+        counter = self.labels.get(label)
+        if counter is None:
+            counter = self.labels[label] = label_counter()
+        size = len(package)
+        counter.packets += 1
+        counter.bytes += size
+        self.packets += 1
+        self.bytes += size
+        deadline = self.deadline
+        if deadline is not None:
+            counter.lateness.record(int((self.clock() - deadline) * 1e6))
+
+
+    def error(self, value):
+        '''Counts a send error (an errno) that was ignored'''
+        self.errors[value] = self.errors.get(value, 0) + 1
+
+
+    def snapshot(self):
+        '''Everything counted so far, as JSON-friendly dicts'''
+        elapsed = max(self.clock() - self.start, 1e-9)
+        labels = {}
+        for label, counter in list(self.labels.items()):
+            labels[str(label)] = {"packets": counter.packets,
+                                  "bytes": counter.bytes,
+                                  "lateness_us": counter.lateness.summary()}
+        snapshot = {
+            "elapsed": elapsed,
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "packets_per_second": self.packets / elapsed,
+            "bytes_per_second": self.bytes / elapsed,
+            "errors": dict((errno.errorcode.get(value, str(value)), count)
+                           for value, count in list(self.errors.items())),
+            "labels": labels,
+            "tasks": dict((task.name, {"runs": task.runs,
+                                       "overruns": task.overruns,
+                                       "skipped": task.skipped})
+                          for task in self.tasks),
+        }
+        if self.transport is not None:
+            snapshot["transport"] = self.transport.snapshot()
+        return snapshot
+
+
+    def summary(self):
+        '''One line: rates since the previous summary, the worst label p99
+        and maximum lateness, overruns and errors so far'''
+        now = self.clock()
+        last_time, last_packets, last_bytes = self._last
+        self._last = (now, self.packets, self.bytes)
+        interval = max(now - last_time, 1e-9)
+        worst_label = None
+        worst_p99 = worst_max = 0
+        for label, counter in list(self.labels.items()):
+            lateness = counter.lateness
+            if lateness.max > worst_max:
+                worst_label = label
+                worst_max = lateness.max
+            worst_p99 = max(worst_p99, lateness.percentile(99.0))
+        #no label when none was late
+        label = "" if worst_label is None else " (label %s)" % worst_label
+        return ("%7.1fs %8.1f packets/s %8.1f kB/s  late p99 %.2f ms, max "
+                "%.2f ms%s  overruns %d  errors %d" %
+                (now - self.start, (self.packets - last_packets) / interval,
+                 (self.bytes - last_bytes) / interval / 1000.0,
+                 worst_p99 / 1000.0, worst_max / 1000.0, label,
+                 sum(task.overruns for task in self.tasks),
+                 sum(self.errors.values())))
+
+
+    def dump(self, path):
+        with open(path, "w") as dump_file:
+            json.dump(self.snapshot(), dump_file, indent=1, sort_keys=True)
+
+
+    def serve(self, port, host=QUERY_HOST):
+        '''Answers every connection to host:port with the JSON snapshot,
+        from a daemon thread'''
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(4)
+        self._server = server
+        thread = threading.Thread(target=self._serve_loop, args=(server,),
+                                  name="ksnstats query")
+        thread.daemon = True
+        thread.start()
+        return server.getsockname()[1]
+
+
+    def _serve_loop(self, server):
+        while True:
+            try:
+                connection, address = server.accept()
+            except (socket.error, OSError):
+                #closed by close()
+                return
+            try:
+                data = json.dumps(self.snapshot(), sort_keys=True) + "\n"
+                connection.sendall(data.encode("ascii"))
+            except socket.error:
+                pass
+            finally:
+                connection.close()
+
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+
+def main():
+    '''Prints the snapshot of a running ksnsend, the port defaults to 3480'''
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 3480
+    connection = socket.create_connection((QUERY_HOST, port))
+    data = b""
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    connection.close()
+    print(json.dumps(json.loads(data.decode("ascii")), indent=1,
+                     sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
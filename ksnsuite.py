@@ -0,0 +1,409 @@
+#! /usr/bin/env python
+'''
+Suite planning for the KSN770 scripts, so a suite run does not spend its
+time cold starting the unit.
+
+A script declares the preferences it needs, and whether it needs a fresh
+cold start regardless, in a module level literal the planner reads
+without running the script:
+
+    REQUIRES = { "prefs": { 1083: 0x3FFF } }    #PREF2_SBAS_PROVIDERS
+
+A script that changes a preference itself after ensure() also lists what
+it leaves behind, so the plan counts the writes and the pending cold start
+it hands to the next script:
+
+    REQUIRES = { "prefs": { 1083: 0x3FFF }, "leaves": { 1083: 0x3FFE } }
+
+and brings the unit there through a unit_state instead of reading,
+setting and cold starting itself:
+
+    unit = ksnsuite.unit_state.load()
+    unit.ensure( test, REQUIRES )
+    try:
+        ...
+    finally:
+        unit.release( test )
+
+A preference a script does not list is needed at the value the unit had
+before the suite, so REQUIRES = {} asks for the unit as it was.  A script
+without REQUIRES does not use a unit_state; the suite runs the --teardown
+script before it whenever a preference is changed or a cold start pending.
+
+unit_state caches the preference values it has read or written, so a
+setPref of the value the unit already has and the coldStart that went with
+it are skipped.  Run on its own a script restores the preferences it
+changed in release(), as the scripts did before.  Run by the suite
+(ksnsuite.py --run), the state is kept in a file named by KSN_SUITE_STATE
+between the scripts, release() leaves the preferences for the next script
+and the --teardown script restores them at the end (unit.restore(test)).
+
+plan() orders the scripts so that the ones needing the same preferences
+run together, greedily picking the group that is cheapest to reach from
+the current preferences, and cost() estimates the pref writes and cold
+starts of an order:
+
+    python ksnsuite.py fasDataBlock.py Americas_777.py ...
+    python ksnsuite.py --run --teardown suiteTeardown.py *.py
+'''
+
+from __future__ import print_function
+import os
+import ast
+import sys
+import json
+import optparse
+import subprocess
+
+STATE_ENVIRONMENT = "KSN_SUITE_STATE"
+REQUIRES_NAME = "REQUIRES"
+#what the FMS proxy answers a setPref with, and how long to wait for it
+PREF_OK = ("OK", 2)
+PREF_TIMEOUT = 80
+#the unit applies a setPref after answering it: seconds to wait before
+#reading it back, and reads before giving up
+PREF_SETTLE_INTERVAL = 1
+PREF_SETTLE_READS = 5
+#rough seconds of the transitions, only to compare plans
+PREF_WRITE_COST = 5.0
+COLD_START_COST = 60.0
+
+
+class pref_error(Exception):
+    pass
+
+
+def get_pref(test, pref):
+    test.startFmsTransaction('getPref', [pref])
+    return test.expectFmsProxyMessage('getPrefResponse', PREF_TIMEOUT)
+
+
+def write_pref(test, pref, value):
+    test.startFmsTransaction('setPref', [pref, [value]])
+    response = test.expectFmsProxyMessage('setPrefResponse', PREF_TIMEOUT)
+    test.log("Response {}".format(response))
+    if response != PREF_OK:
+        raise pref_error("setPref %d to %#x answered %r" %
+                         (pref, value, response))
+
+
+class unit_state(object):
+    '''
+    What is known about the unit: the preference values read or written,
+    the values they had when first seen, and whether a preference was
+    written since the last cold start.  path is the state file of a suite
+    run, None for a script run on its own.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.prefs = {}
+        self.original = {}
+        self.cold_start_needed = False
+        self.pref_writes = 0
+        self.cold_starts = 0
+        self.skipped_writes = 0
+        self.skipped_cold_starts = 0
+        if path is not None and os.path.exists(path):
+            with open(path) as state_file:
+                self._from_json(json.load(state_file))
+
+
+    @classmethod
+    def load(cls):
+        '''The state of the suite run, if the script is run by one'''
+        return cls(os.environ.get(STATE_ENVIRONMENT))
+
+
+    @property
+    def suite(self):
+        return self.path is not None
+
+
+    def _from_json(self, state):
+        #JSON object keys are strings
+        self.prefs = dict((int(pref), value)
+                          for pref, value in state["prefs"].items())
+        self.original = dict((int(pref), value)
+                             for pref, value in state["original"].items())
+        self.cold_start_needed = state["cold_start_needed"]
+        for name in ("pref_writes", "cold_starts", "skipped_writes",
+                     "skipped_cold_starts"):
+            setattr(self, name, state[name])
+
+
+    def save(self):
+        if self.path is None:
+            return
+        state = {"prefs": self.prefs, "original": self.original,
+                 "cold_start_needed": self.cold_start_needed,
+                 "pref_writes": self.pref_writes,
+                 "cold_starts": self.cold_starts,
+                 "skipped_writes": self.skipped_writes,
+                 "skipped_cold_starts": self.skipped_cold_starts}
+        with open(self.path, "w") as state_file:
+            json.dump(state, state_file, indent=1, sort_keys=True)
+
+
+    def value(self, test, pref):
+        '''The value of pref, read from the unit only the first time'''
+        if pref not in self.prefs:
+            self.prefs[pref] = get_pref(test, pref)
+            self.original.setdefault(pref, self.prefs[pref])
+        return self.prefs[pref]
+
+
+    def set_pref(self, test, pref, value):
+        '''Write pref unless the unit already has value, and read it back
+        until it has settled; it takes effect at the next cold_start()'''
+        if self.value(test, pref) == value:
+            self.skipped_writes += 1
+            return False
+        write_pref(test, pref, value)
+        self.prefs[pref] = value
+        self.pref_writes += 1
+        self.cold_start_needed = True
+        self.save()
+        for read in range(PREF_SETTLE_READS):
+            test.wait(PREF_SETTLE_INTERVAL)
+            response = get_pref(test, pref)
+            if response == value:
+                return True
+        raise pref_error("pref %d reads %r %ds after setPref to %#x" %
+                         (pref, response,
+                          PREF_SETTLE_READS * PREF_SETTLE_INTERVAL, value))
+
+
+    def cold_start(self, test):
+        test.coldStart()
+        self.cold_starts += 1
+        self.cold_start_needed = False
+        self.save()
+
+
+    @property
+    def changed(self):
+        '''Whether a preference differs from its original value or a cold
+        start is pending'''
+        return self.cold_start_needed or any(
+            self.prefs.get(pref, value) != value
+            for pref, value in self.original.items())
+
+
+    def ensure(self, test, requires):
+        '''
+        Bring the unit to the preferences of requires (a REQUIRES
+        declaration), and the ones it does not list back to their original
+        values, cold starting it if any was written, a cold start is still
+        pending or requires asks for it.  Returns whether it was cold
+        started.
+        '''
+        prefs = dict((pref, value) for pref, value in self.original.items()
+                     if self.prefs.get(pref) != value)
+        prefs.update(requires.get("prefs", {}))
+        for pref in sorted(prefs):
+            self.set_pref(test, pref, prefs[pref])
+        if self.cold_start_needed or requires.get("cold_start"):
+            self.cold_start(test)
+            return True
+        if prefs:
+            self.skipped_cold_starts += 1
+            self.save()
+        return False
+
+
+    def restore(self, test):
+        '''Write back the preferences as they were first seen, cold
+        starting if any changed'''
+        for pref in sorted(self.original):
+            self.set_pref(test, pref, self.original[pref])
+        if self.cold_start_needed:
+            self.cold_start(test)
+
+
+    def release(self, test):
+        '''The end of a script: restore() on its own, in a suite the next
+        script or the teardown takes the unit from here'''
+        if self.suite:
+            self.save()
+        else:
+            self.restore(test)
+
+
+    def summary(self):
+        return ("%d pref writes, %d cold starts, %d pref writes and %d cold "
+                "starts skipped" % (self.pref_writes, self.cold_starts,
+                                    self.skipped_writes,
+                                    self.skipped_cold_starts))
+
+
+def read_requires(path):
+    '''The REQUIRES declaration of the script at path, None without one'''
+    with open(path) as script_file:
+        tree = ast.parse(script_file.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id == REQUIRES_NAME
+                for target in node.targets):
+            return ast.literal_eval(node.value)
+    return None
+
+
+def transition(prefs, requires, pending=False):
+    '''(pref writes, cold starts) to go from the changed prefs, with a cold
+    start pending or not, to requires, writing back the changed ones
+    requires does not list; a preference not known yet counts as a write'''
+    needed = requires.get("prefs", {})
+    writes = sum(1 for pref in needed if prefs.get(pref) != needed[pref])
+    writes += sum(1 for pref in prefs if pref not in needed)
+    cold_starts = 1 if (writes or pending or
+                        requires.get("cold_start")) else 0
+    return writes, cold_starts
+
+
+def after(requires):
+    '''(the changed prefs, whether a cold start is pending) once a script
+    with requires has run'''
+    prefs = dict(requires.get("prefs", {}))
+    leaves = requires.get("leaves", {})
+    prefs.update(leaves)
+    return prefs, bool(leaves)
+
+
+def _cost(writes, cold_starts):
+    return writes * PREF_WRITE_COST + cold_starts * COLD_START_COST
+
+
+def cost(scripts, prefs=None):
+    '''(pref writes, cold starts) of running the (path, requires) scripts
+    in order'''
+    prefs = dict(prefs or {})
+    pending = False
+    total_writes = total_cold_starts = 0
+    for path, requires in scripts:
+        writes, cold_starts = transition(prefs, requires, pending)
+        total_writes += writes
+        total_cold_starts += cold_starts
+        prefs, pending = after(requires)
+    return total_writes, total_cold_starts
+
+
+def plan(scripts, prefs=None):
+    '''
+    The (path, requires) scripts reordered: the scripts needing the same
+    preferences are grouped, in the order given, and the group cheapest to
+    reach from the current preferences runs next.  Scripts that need the
+    original preferences run first.
+    '''
+    groups = []
+    keys = {}
+    for path, requires in scripts:
+        key = (tuple(sorted(requires.get("prefs", {}).items())),
+               tuple(sorted(requires.get("leaves", {}).items())),
+               bool(requires.get("cold_start")))
+        if key not in keys:
+            keys[key] = len(groups)
+            groups.append([])
+        groups[keys[key]].append((path, requires))
+
+    prefs = dict(prefs or {})
+    pending = False
+    order = []
+    while groups:
+        best = min(range(len(groups)), key=lambda index: (
+            _cost(*transition(prefs, groups[index][0][1], pending)), index))
+        group = groups.pop(best)
+        order.extend(group)
+        prefs, pending = after(group[0][1])
+    return order
+
+
+def setup_command_line():
+    usage = """usage: %prog [options] SCRIPT...
+
+    Orders the KSN770 scripts by the preferences they declare in REQUIRES,
+    so that the unit is reconfigured and cold started as rarely as
+    possible, prints the plan and with --run runs it."""
+    parser = optparse.OptionParser(usage=usage)
+    help = "Run the scripts in the planned order."
+    parser.add_option(  "--run", action="store_true", dest="run",
+                        help=help, default=False);
+    help = "How to run a script, %s is its path. [default:%default]"
+    parser.add_option(  "--command", action="store", dest="command",
+                        help=help, default=sys.executable + " %s");
+    help = "The unit state file of the run, started afresh. "
+    help += "[default:%default]"
+    parser.add_option(  "--state", action="store", dest="state",
+                        help=help, default=".ksnsuite_state.json");
+    help = "A script that restores the preferences, run last and before "
+    help += "every script without REQUIRES that follows a change."
+    parser.add_option(  "--teardown", action="store", dest="teardown",
+                        help=help);
+    help = "Run the scripts in the order given, only reusing the state."
+    parser.add_option(  "--noreorder", action="store_true", dest="no_reorder",
+                        help=help, default=False);
+    return parser
+
+
+def print_plan(title, scripts):
+    writes, cold_starts = cost(scripts)
+    print("%s: %d pref writes, %d cold starts, about %.0fs" %
+          (title, writes, cold_starts, _cost(writes, cold_starts)))
+
+
+def main():
+    parser = setup_command_line()
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("no scripts given")
+    undeclared = set()
+    scripts = []
+    for path in args:
+        requires = read_requires(path)
+        if requires is None:
+            #needs the preferences the unit had
+            undeclared.add(path)
+            requires = {}
+        scripts.append((path, requires))
+    order = scripts if options.no_reorder else plan(scripts)
+    print_plan("Given order", scripts)
+    print_plan("Planned order", order)
+    prefs = {}
+    pending = False
+    for path, requires in order:
+        writes, cold_starts = transition(prefs, requires, pending)
+        prefs, pending = after(requires)
+        print("  %-30s %d pref writes %s%s" %
+              (path, writes, "cold start" if cold_starts else "",
+               " (no REQUIRES)" if path in undeclared else ""))
+    if not options.run:
+        return
+    if undeclared and not options.teardown:
+        parser.error("scripts without REQUIRES (%s) need a --teardown to "
+                     "restore the preferences before them" %
+                     " ".join(sorted(undeclared)))
+
+    if os.path.exists(options.state):
+        os.remove(options.state)
+    environment = dict(os.environ)
+    environment[STATE_ENVIRONMENT] = os.path.abspath(options.state)
+    paths = [path for path, requires in order]
+    if options.teardown:
+        paths.append(options.teardown)
+    failed = []
+    for path in paths:
+        run = [path]
+        if path in undeclared and unit_state(options.state).changed:
+            run.insert(0, options.teardown)
+        for script in run:
+            print("Running %s" % script)
+            if subprocess.call(options.command % script, shell=True,
+                               env=environment):
+                failed.append(script)
+    print(unit_state(options.state).summary())
+    if failed:
+        print("Failed: %s" % " ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
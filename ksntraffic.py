@@ -0,0 +1,311 @@
+#! /usr/bin/env python
+'''
+Multi-intruder TCAS traffic for ksnsend.
+
+A traffic_engine keeps the intruders as arrays of their position relative to
+the ownship (NM right of and ahead of the nose), relative velocity (knots),
+relative altitude (feet), vertical speed (feet per minute) and threat type,
+moves them all every tick, and encodes the range, altitude and bearing ARINC
+429 words of every intruder in one pass.  The words go out in as many
+IOF_TRAFFIC_LABELS_RX frames as needed, per_frame intruders each:
+
+    label, discrete, RTS, (range, altitude, bearing) * n, ETX
+
+the RTS and ETX words counting the 3 * n + 2 words from RTS to ETX, like the
+5 and 8 counts of the one and two intruder packets of ksnsend.
+
+The words are the arinc429 layouts of ksnsend (INTRUDER_RANGE_WORD and
+the others), its fixed intruder being 5 NM ahead and to the right at 45
+degrees, 1000 feet above, level:
+
+    range       bits 17-29  unsigned, 1/128 NM
+    altitude    bits 22-29  two's complement, 50 feet
+                bits 11-12  vertical trend, 1 climbing, 2 descending
+    bearing     bits 19-29  two's complement, 180/1024 degrees
+                bits 16-18  threat type, 0 other, 1 TA, 2 RA, 3 proximate
+
+Intruders that get past max_range or max_altitude turn back, so the count
+stays the same for the whole run.  The threat types follow the range and
+relative altitude when classify is true (a distance test, not the TCAS tau
+logic).
+
+NumPy is used for the update and the encoding when it is installed, the
+packets are the same without it.
+'''
+
+import math
+import random
+import struct
+import collections
+
+import ksnsend
+import ksnlabels
+import ksnsched
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+TRAFFIC_LABEL = ksnlabels.IOF_TRAFFIC_LABELS_RX
+#ARINC 274 discrete of ksnsend.send_trfc_operating, no annunciation
+OPERATING_DISCRETE = ksnsend.TRAFFIC_OPERATING
+#label, discrete and RTS
+FRAME_HEADER = struct.Struct("!HII")
+ETX_FORMAT = struct.Struct("!I")
+WORDS_PER_INTRUDER = 3
+#the RTS to ETX count is 8 bits
+MAX_PER_FRAME = (0xFF - 2) // WORDS_PER_INTRUDER
+DEFAULT_PER_FRAME = 30
+RANGE_WORD = ksnsend.INTRUDER_RANGE_WORD
+ALTITUDE_WORD = ksnsend.INTRUDER_ALTITUDE_WORD
+BEARING_WORD = ksnsend.INTRUDER_BEARING_WORD
+
+TREND_LEVEL = 0
+TREND_CLIMBING = 1
+TREND_DESCENDING = 2
+#vertical speed (feet per minute) shown as a climbing or descending arrow
+TREND_RATE = 500.0
+
+OTHER = 0
+TRAFFIC_ADVISORY = 1
+RESOLUTION_ADVISORY = 2
+PROXIMATE = 3
+#threat type: (range NM, relative altitude feet) it starts within
+THREAT_LIMITS = [(RESOLUTION_ADVISORY, 1.0, 600.0),
+                 (TRAFFIC_ADVISORY, 2.0, 850.0),
+                 (PROXIMATE, 6.0, 1200.0)]
+
+MAX_RANGE = 12.0
+MAX_ALTITUDE = 3000.0
+MAX_SPEED = 300.0
+MAX_VERTICAL_SPEED = 1500.0
+#knots to NM per second, feet per minute to feet per second
+PER_HOUR = 1 / 3600.0
+PER_MINUTE = 1 / 60.0
+
+intruder = collections.namedtuple("intruder", [
+    "x", "y", "vx", "vy", "altitude", "vertical_speed", "threat"])
+intruder_words = collections.namedtuple("intruder_words", [
+    "range", "altitude", "bearing", "trend", "threat"])
+
+
+def random_intruders(count, seed=None, max_range=MAX_RANGE,
+                     max_altitude=MAX_ALTITUDE):
+    '''count intruders spread around the ownship, the same ones for a seed'''
+    rng = random.Random(seed)
+    intruders = []
+    for i in range(count):
+        distance = rng.uniform(0.5, max_range)
+        bearing = rng.uniform(0.0, 2 * math.pi)
+        speed = rng.uniform(0.0, MAX_SPEED)
+        heading = rng.uniform(0.0, 2 * math.pi)
+        intruders.append(intruder(
+            distance * math.sin(bearing), distance * math.cos(bearing),
+            speed * math.sin(heading), speed * math.cos(heading),
+            rng.uniform(-max_altitude, max_altitude),
+            rng.uniform(-MAX_VERTICAL_SPEED, MAX_VERTICAL_SPEED), OTHER))
+    return intruders
+
+
+def decode_words(range_word, altitude_word, bearing_word):
+    '''The range (NM), relative altitude (feet), bearing (degrees), trend
+    and threat type in the words of one intruder'''
+    altitude = ALTITUDE_WORD.decode(altitude_word)
+    bearing = BEARING_WORD.decode(bearing_word)
+    return intruder_words(RANGE_WORD.decode(range_word).range,
+                          altitude.altitude, bearing.bearing, altitude.trend,
+                          bearing.threat)
+
+
+def _trend(vertical_speed):
+    if vertical_speed >= TREND_RATE:
+        return TREND_CLIMBING
+    if vertical_speed <= -TREND_RATE:
+        return TREND_DESCENDING
+    return TREND_LEVEL
+
+
+def _classify(distance, altitude):
+    altitude = abs(altitude)
+    for threat, limit_range, limit_altitude in THREAT_LIMITS:
+        if distance < limit_range and altitude < limit_altitude:
+            return threat
+    return OTHER
+
+
+class traffic_engine(object):
+    '''
+    Moves and encodes intruders (a list of intruder).  update() advances
+    them to the clock and returns the frames, reusable bytearrays that are
+    rewritten by the next update().
+    '''
+    def __init__(self, intruders, per_frame=DEFAULT_PER_FRAME,
+                 discrete=OPERATING_DISCRETE, classify=True,
+                 max_range=MAX_RANGE, max_altitude=MAX_ALTITUDE,
+                 clock=ksnsched.monotonic, use_numpy=None):
+        if not 1 <= per_frame <= MAX_PER_FRAME:
+            raise ValueError("per_frame must be in [1,%d] (got %r)" %
+                             (MAX_PER_FRAME, per_frame))
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise ValueError("numpy is not installed")
+        self.count = len(intruders)
+        self.per_frame = per_frame
+        self.classify = classify
+        self.max_range = max_range
+        self.max_altitude = max_altitude
+        self.clock = clock
+        self.use_numpy = use_numpy
+        self.last = None
+        self.time = 0.0
+
+        columns = list(zip(*intruders)) or [()] * len(intruder._fields)
+        if use_numpy:
+            (self.x, self.y, self.vx, self.vy, self.altitude,
+             self.vertical_speed) = [numpy.array(column, dtype=numpy.float64)
+                                     for column in columns[:6]]
+            self.threat = numpy.array(columns[6], dtype=numpy.uint32)
+        else:
+            (self.x, self.y, self.vx, self.vy, self.altitude,
+             self.vertical_speed, self.threat) = [list(column)
+                                                  for column in columns]
+
+        #one buffer per frame, the discrete, RTS and ETX packed once
+        self.frames = []
+        self._slices = []
+        for start in range(0, self.count, per_frame):
+            count = min(per_frame, self.count - start)
+            words = WORDS_PER_INTRUDER * count
+            frame = bytearray(FRAME_HEADER.size + 4 * words +
+                              ETX_FORMAT.size)
+            block = ksnsend.BLOCK_WORD.encode
+            FRAME_HEADER.pack_into(frame, 0, TRAFFIC_LABEL, discrete,
+                                   block(words + 2, ksnsend.RTS_CONTROL))
+            ETX_FORMAT.pack_into(frame, len(frame) - ETX_FORMAT.size,
+                                 block(words + 2, ksnsend.ETX_CONTROL))
+            if use_numpy:
+                view = numpy.frombuffer(frame, dtype=">u4", count=words,
+                                        offset=FRAME_HEADER.size)
+            else:
+                view = struct.Struct("!%dI" % words)
+            self.frames.append(frame)
+            self._slices.append((start, start + count, view))
+
+
+    def step(self, dt):
+        '''Moves the intruders by dt seconds'''
+        if self.use_numpy:
+            self._step_numpy(dt)
+        else:
+            self._step_python(dt)
+        self.time += dt
+
+
+    def _step_numpy(self, dt):
+        x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        x += vx * (dt * PER_HOUR)
+        y += vy * (dt * PER_HOUR)
+        self.altitude += self.vertical_speed * (dt * PER_MINUTE)
+        #turn back the ones moving away past the limits
+        away = (x * x + y * y > self.max_range * self.max_range) & \
+            (x * vx + y * vy > 0)
+        vx[away] = -vx[away]
+        vy[away] = -vy[away]
+        climbing_out = (numpy.abs(self.altitude) > self.max_altitude) & \
+            (self.altitude * self.vertical_speed > 0)
+        self.vertical_speed[climbing_out] = -self.vertical_speed[climbing_out]
+
+
+    def _step_python(self, dt):
+        x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        altitude, vertical_speed = self.altitude, self.vertical_speed
+        horizontal = dt * PER_HOUR
+        vertical = dt * PER_MINUTE
+        limit = self.max_range * self.max_range
+        for i in range(self.count):
+            x[i] += vx[i] * horizontal
+            y[i] += vy[i] * horizontal
+            altitude[i] += vertical_speed[i] * vertical
+            if x[i] * x[i] + y[i] * y[i] > limit and \
+                    x[i] * vx[i] + y[i] * vy[i] > 0:
+                vx[i] = -vx[i]
+                vy[i] = -vy[i]
+            if abs(altitude[i]) > self.max_altitude and \
+                    altitude[i] * vertical_speed[i] > 0:
+                vertical_speed[i] = -vertical_speed[i]
+
+
+    def encode(self):
+        '''Writes the words of every intruder into the frames'''
+        if self.use_numpy:
+            self._encode_numpy()
+        else:
+            self._encode_python()
+        return self.frames
+
+
+    def _encode_numpy(self):
+        x, y, altitude = self.x, self.y, self.altitude
+        distance = numpy.hypot(x, y)
+        if self.classify:
+            threat = numpy.full(self.count, OTHER, dtype=numpy.uint32)
+            #the most severe limits last, so they win
+            for kind, limit_range, limit_altitude in THREAT_LIMITS[::-1]:
+                threat[(distance < limit_range) &
+                       (numpy.abs(altitude) < limit_altitude)] = kind
+            self.threat = threat
+        trend = numpy.where(self.vertical_speed >= TREND_RATE,
+                            TREND_CLIMBING,
+                            numpy.where(self.vertical_speed <= -TREND_RATE,
+                                        TREND_DESCENDING, TREND_LEVEL))
+        words = numpy.empty((self.count, WORDS_PER_INTRUDER),
+                            dtype=numpy.uint32)
+        words[:, 0] = RANGE_WORD.encode_many(distance)
+        words[:, 1] = ALTITUDE_WORD.encode_many(trend, altitude)
+        words[:, 2] = BEARING_WORD.encode_many(
+            self.threat, numpy.degrees(numpy.arctan2(x, y)))
+        flat = words.reshape(-1)
+        for start, end, view in self._slices:
+            view[:] = flat[WORDS_PER_INTRUDER * start:
+                           WORDS_PER_INTRUDER * end]
+
+
+    def _encode_python(self):
+        words = []
+        append = words.append
+        threat = self.threat
+        encode_range = RANGE_WORD.encode
+        encode_altitude = ALTITUDE_WORD.encode
+        encode_bearing = BEARING_WORD.encode
+        for i in range(self.count):
+            x = self.x[i]
+            y = self.y[i]
+            altitude = self.altitude[i]
+            distance = math.hypot(x, y)
+            if self.classify:
+                threat[i] = _classify(distance, altitude)
+            append(encode_range(distance))
+            append(encode_altitude(_trend(self.vertical_speed[i]), altitude))
+            append(encode_bearing(threat[i], math.degrees(math.atan2(x, y))))
+        for (start, end, layout), frame in zip(self._slices, self.frames):
+            layout.pack_into(frame, FRAME_HEADER.size,
+                             *words[WORDS_PER_INTRUDER * start:
+                                    WORDS_PER_INTRUDER * end])
+
+
+    def update(self):
+        '''Moves the intruders to the clock time and returns the frames'''
+        now = self.clock()
+        if self.last is not None:
+            self.step(now - self.last)
+        self.last = now
+        return self.encode()
+
+
+def from_options(options, clock=ksnsched.monotonic):
+    '''The traffic of the ksnsend --intruders options'''
+    return traffic_engine(random_intruders(options.intruders,
+                                           options.intruder_seed),
+                          per_frame=options.intruders_per_frame, clock=clock)
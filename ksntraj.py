@@ -0,0 +1,376 @@
+#! /usr/bin/env python
+'''
+Time-indexed trajectories for ksnsend playback.
+
+Trajectories are authored as CSV with a header row.  The time (seconds),
+latitude, longitude (degrees) and altitude (feet) columns are required,
+ground_track, ground_speed (knots), vertical_speed (feet per minute),
+true_airspeed, magheading and true_heading are optional and fall back to the
+command line values when missing.
+
+For production runs the CSV is compiled to a columnar binary file, already
+converted to the units that go on the wire, which is memory-mapped so long
+high-rate profiles are never loaded into RAM:
+
+    ksntraj.py profile.csv profile.ksntraj
+
+    header      "<8sII"  magic, rows, columns
+    names       16 bytes per column, NUL padded
+    padding     up to a multiple of 8 bytes
+    data        one little-endian float64 array per column
+
+NumPy is used for the conversions and the column views when it is installed,
+the file format and the playback do not depend on it.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import csv
+import math
+import mmap
+import struct
+import bisect
+import tempfile
+import collections
+
+import ksnsend
+import ksnsched
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b"KSNTRAJ1"
+HEADER_FORMAT = struct.Struct("<8sII")
+NAME_SIZE = 16
+VALUE_FORMAT = struct.Struct("<d")
+
+#authored (CSV) columns, their wire units and conversions
+TIME = "time"
+REQUIRED_COLUMNS = [TIME, "latitude", "longitude", "altitude"]
+OPTIONAL_COLUMNS = ["ground_track", "ground_speed", "vertical_speed",
+                    "true_airspeed", "magheading", "true_heading"]
+#the binary file and the samples hold these, in wire units
+WIRE_COLUMNS = ["latitude", "longitude", "altitude", "ground_track",
+                "ground_speed", "vertical_speed", "baro_altitude",
+                "true_airspeed", "magheading", "true_heading"]
+#wire column: (authored column, conversion)
+CONVERSIONS = {
+    "latitude": ("latitude", ksnsend.dec_to_rad),
+    "longitude": ("longitude", ksnsend.dec_to_rad),
+    "altitude": ("altitude", ksnsend.ft_to_m),
+    "ground_track": ("ground_track", None),
+    "ground_speed": ("ground_speed", ksnsend.kts_to_mps),
+    "vertical_speed": ("vertical_speed", ksnsend.ftpm_to_mps),
+    "baro_altitude": ("altitude", None),
+    "true_airspeed": ("true_airspeed", None),
+    "magheading": ("magheading", None),
+    "true_heading": ("true_heading", None),
+}
+
+#angle columns: (period, offset), interpolated the shorter way round and
+#normalised to [-offset, period - offset)
+ANGLES = {
+    "longitude": (2 * math.pi, math.pi),
+    "ground_track": (2 * math.pi, 0.0),
+    "magheading": (360.0, 0.0),
+    "true_heading": (360.0, 0.0),
+}
+
+trajectory_sample = collections.namedtuple("trajectory_sample", WIRE_COLUMNS)
+
+
+class trajectory_error(Exception):
+    pass
+
+
+def _convert(values, conversion):
+    '''Applies a ksnsend unit conversion to a whole column at once'''
+    if conversion is None:
+        return values
+    if numpy is not None:
+        return conversion(numpy.asarray(values, dtype=numpy.float64))
+    return [conversion(value) for value in values]
+
+
+def read_csv(path):
+    '''Returns {authored column: list of floats} sorted by time'''
+    with open(path) as csv_file:
+        reader = csv.reader(csv_file)
+        try:
+            names = [name.strip() for name in next(reader)]
+        except StopIteration:
+            raise trajectory_error("%s: empty file" % path)
+        for name in REQUIRED_COLUMNS:
+            if name not in names:
+                raise trajectory_error("%s: missing column %s" % (path, name))
+        known = [name for name in names
+                 if name in REQUIRED_COLUMNS or name in OPTIONAL_COLUMNS]
+        columns = dict((name, []) for name in known)
+        indexes = [(names.index(name), columns[name]) for name in known]
+        for line, row in enumerate(reader, 2):
+            if not row:
+                continue
+            try:
+                for index, column in indexes:
+                    column.append(float(row[index]))
+            except (ValueError, IndexError):
+                raise trajectory_error("%s:%d: bad row %r" % (path, line, row))
+
+    times = columns[TIME]
+    if not times:
+        raise trajectory_error("%s: no samples" % path)
+    order = sorted(range(len(times)), key=times.__getitem__)
+    for name in columns:
+        column = columns[name]
+        columns[name] = [column[i] for i in order]
+    return columns
+
+
+def compile_csv(csv_path, binary_path):
+    '''Converts an authored CSV trajectory to the memory-mapped format.
+    The file is written under a temporary name and renamed into place, so
+    a process that has the old one mapped keeps reading it whole.'''
+    authored = read_csv(csv_path)
+    rows = len(authored[TIME])
+    columns = [(TIME, authored[TIME])]
+    for name in WIRE_COLUMNS:
+        source, conversion = CONVERSIONS[name]
+        if source in authored:
+            columns.append((name, _convert(authored[source], conversion)))
+
+    directory, name = os.path.split(binary_path)
+    fd, temporary_path = tempfile.mkstemp(prefix=name + ".",
+                                          dir=directory or ".")
+    try:
+        with os.fdopen(fd, "wb") as binary_file:
+            header = HEADER_FORMAT.pack(MAGIC, rows, len(columns))
+            names = b"".join(struct.pack("%ds" % NAME_SIZE,
+                                         name.encode("ascii"))
+                             for name, values in columns)
+            binary_file.write(header + names)
+            binary_file.write(b"\0" * (-(len(header) + len(names)) % 8))
+            for name, values in columns:
+                if numpy is not None:
+                    binary_file.write(numpy.asarray(values, dtype="<f8")
+                                      .tobytes())
+                else:
+                    binary_file.write(struct.pack("<%dd" % rows, *values))
+        #mkstemp() makes it private to the user
+        os.chmod(temporary_path, 0o644)
+        os.rename(temporary_path, binary_path)
+    except:
+        os.remove(temporary_path)
+        raise
+    return rows
+
+
+class _mapped_column(object):
+    '''Sequence view of one float64 column of the mapped file'''
+    def __init__(self, buffer, offset, rows):
+        self.buffer = buffer
+        self.offset = offset
+        self.rows = rows
+
+
+    def __len__(self):
+        return self.rows
+
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.rows
+        if not 0 <= index < self.rows:
+            raise IndexError(index)
+        return VALUE_FORMAT.unpack_from(self.buffer,
+                                        self.offset + 8 * index)[0]
+
+
+class trajectory(object):
+    '''A compiled trajectory, memory-mapped read-only'''
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise trajectory_error("%s: empty file" % path)
+        magic, rows, count = HEADER_FORMAT.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise trajectory_error("%s: not a compiled trajectory" % path)
+        offset = HEADER_FORMAT.size
+        names = []
+        for i in range(count):
+            name = self._map[offset:offset+NAME_SIZE].rstrip(b"\0")
+            names.append(name.decode("ascii"))
+            offset += NAME_SIZE
+        offset += -offset % 8
+        if len(self._map) < offset + 8 * rows * count:
+            self.close()
+            raise trajectory_error("%s: truncated" % path)
+
+        self.rows = rows
+        self.columns = {}
+        for name in names:
+            if numpy is not None:
+                column = numpy.frombuffer(self._map, dtype="<f8", count=rows,
+                                          offset=offset)
+            else:
+                column = _mapped_column(self._map, offset, rows)
+            self.columns[name] = column
+            offset += 8 * rows
+        self.times = self.columns[TIME]
+        self.duration = self.times[rows-1] - self.times[0]
+
+
+    def close(self):
+        self.columns = {}
+        self.times = None
+        try:
+            self._map.close()
+        except BufferError:
+            #numpy views are still alive, the map goes with them
+            pass
+        self._file.close()
+
+
+def load(path):
+    '''Opens a compiled trajectory, compiling a CSV next to it first when
+    the compiled file is missing or older than the CSV'''
+    if path.lower().endswith(".csv"):
+        binary_path = path[:-4] + ".ksntraj"
+        if (not os.path.exists(binary_path) or
+                os.path.getmtime(binary_path) < os.path.getmtime(path)):
+            compile_csv(path, binary_path)
+        path = binary_path
+    return trajectory(path)
+
+
+class trajectory_player(object):
+    '''
+    Interpolated samples of a trajectory at the time elapsed on clock since
+    start().  Columns the trajectory does not have come from defaults (wire
+    units).  Past the end the last sample is held, or the trajectory loops.
+    '''
+    def __init__(self, trajectory, defaults, loop=False,
+                 clock=ksnsched.monotonic):
+        self.trajectory = trajectory
+        self.loop = loop
+        self.clock = clock
+        self.epoch = None
+        self._cursor = 0
+        self._columns = []
+        self._defaults = []
+        self._angles = []
+        for name in WIRE_COLUMNS:
+            column = trajectory.columns.get(name)
+            self._columns.append(column)
+            self._defaults.append(defaults.get(name, 0.0))
+            self._angles.append(ANGLES.get(name))
+
+
+    def start(self):
+        self.epoch = self.clock()
+
+
+    def close(self):
+        self.trajectory.close()
+
+
+    def _find(self, t):
+        '''Index i with times[i] <= t < times[i+1], searching forward from
+        the last one since playback mostly moves ahead'''
+        times = self.trajectory.times
+        last = self.trajectory.rows - 1
+        cursor = self._cursor
+        if times[cursor] <= t:
+            steps = 0
+            while cursor < last and times[cursor+1] <= t:
+                cursor += 1
+                steps += 1
+                if steps == 8:
+                    cursor = bisect.bisect_right(times, t, cursor) - 1
+                    break
+        else:
+            cursor = max(bisect.bisect_right(times, t) - 1, 0)
+        self._cursor = cursor
+        return cursor
+
+
+    def sample(self, elapsed=None):
+        if elapsed is None:
+            if self.epoch is None:
+                self.start()
+            elapsed = self.clock() - self.epoch
+        trajectory = self.trajectory
+        times = trajectory.times
+        if self.loop and trajectory.duration > 0:
+            elapsed %= trajectory.duration
+        t = times[0] + elapsed
+
+        i = self._find(t)
+        j = min(i + 1, trajectory.rows - 1)
+        t0 = times[i]
+        t1 = times[j]
+        if t1 > t0 and t > t0:
+            fraction = min((t - t0) / (t1 - t0), 1.0)
+        else:
+            fraction = 0.0
+
+        values = []
+        for column, default, angle in zip(self._columns, self._defaults,
+                                          self._angles):
+            if column is None:
+                values.append(default)
+            elif angle is None:
+                v0 = column[i]
+                values.append(float(v0 + (column[j] - v0) * fraction))
+            else:
+                #350 to 10 degrees goes through 0, not 180
+                period, offset = angle
+                v0 = float(column[i])
+                delta = (float(column[j]) - v0 + period / 2) % period - \
+                    period / 2
+                values.append((v0 + delta * fraction + offset) % period -
+                              offset)
+        return trajectory_sample(*values)
+
+
+def option_defaults(options):
+    '''Wire-unit values for the columns a trajectory does not provide'''
+    baro_altitude = options.barro_corr_alt
+    if options.barro_uncorr_alt != None:
+        baro_altitude = options.barro_uncorr_alt
+    return {
+        "latitude": ksnsend.dec_to_rad(options.lat),
+        "longitude": ksnsend.dec_to_rad(options.lon),
+        "altitude": ksnsend.ft_to_m(options.alt),
+        "ground_track": options.ground_track,
+        "ground_speed": ksnsend.kts_to_mps(options.ground_speed),
+        "vertical_speed": ksnsend.ftpm_to_mps(options.vertical_speed),
+        "baro_altitude": baro_altitude,
+        "true_airspeed": options.true_airspeed,
+        "magheading": options.magheading,
+        "true_heading": options.trueheading or 0.0,
+    }
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("usage: %s trajectory.csv trajectory.ksntraj" % sys.argv[0])
+        sys.exit(2)
+    try:
+        rows = compile_csv(sys.argv[1], sys.argv[2])
+    except trajectory_error as error:
+        print(error)
+        sys.exit(1)
+    print("%d samples written to %s" % (rows, sys.argv[2]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,528 @@
+#! /usr/bin/env python
+'''
+Transports the packets of a ksn_send go out through.
+
+    udp_transport      a UDP socket, sendto() the host and port every packet
+                       or, connected, send() with no address handling
+    unix_transport     an AF_UNIX datagram socket, for a simulator on the
+                       same machine
+    memory_transport   an in-memory queue the packets can be taken back from
+    ring_transport     a memory-mapped ring buffer file a local simulator
+                       reads with a ring_reader, one producer and one
+                       consumer, no lock and no syscall per packet
+
+The socket transports can batch (see ksnbatch), the packets then go out at
+flush().  Every transport counts its packets, bytes, errors and drops in a
+transport_stats, and with timed set the latency of every call that hands
+packets over (one send, or one batch flush) in microseconds:
+
+    transport = ksntransport.unix_transport("/tmp/ksn.sock")
+    sender = ksnsend.ksn_send("127.0.0.1", 3471, transport=transport)
+    ...
+    transport.stats.snapshot()
+
+A ring_reader keeps the same stats for the packets it reads, the latency
+being from the send to the read.  ksntransport.py ring PATH prints them for
+a running ksnsend --transport ring.
+'''
+
+from __future__ import print_function
+import os
+import sys
+import mmap
+import time
+import errno
+import socket
+import struct
+import collections
+
+import ksnsched
+import ksnbatch
+import ksnstats
+
+TRANSPORTS = ["udp", "udpconnected", "unix", "ring"]
+#errors of a unit or simulator that is not there (yet)
+IGNORED_ERRORS = (errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.ECONNREFUSED,
+                  errno.ENOENT)
+
+#ring file: header, the write and read indexes on their own cache lines,
+#then the slots, each a length and send time before the packet
+RING_MAGIC = b"KSNRING1"
+RING_HEADER = struct.Struct("<8sII")
+RING_INDEX = struct.Struct("<Q")
+RING_WRITE_OFFSET = 64
+RING_READ_OFFSET = 128
+RING_SLOTS_OFFSET = 192
+RING_SLOT_HEADER = struct.Struct("<Id")
+RING_SLOTS = 4096
+RING_SLOT_SIZE = ksnbatch.MAX_PACKET_SIZE
+
+
+class transport_stats(object):
+    '''Packets and bytes handed to a transport, the ones it dropped, its
+    errors and the latency histogram of its calls'''
+    def __init__(self, clock=ksnsched.monotonic):
+        self.clock = clock
+        self.start = clock()
+        self.packets = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency = ksnstats.latency_histogram()
+
+
+    def snapshot(self):
+        elapsed = max(self.clock() - self.start, 1e-9)
+        return {
+            "elapsed": elapsed,
+            "packets": self.packets,
+            "bytes": self.bytes,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "packets_per_second": self.packets / elapsed,
+            "bytes_per_second": self.bytes / elapsed,
+            "latency_us": self.latency.summary(),
+        }
+
+
+    def summary(self):
+        snapshot = self.snapshot()
+        latency = snapshot["latency_us"]
+        return ("%d packets %.1f packets/s %.1f kB/s  latency p50 %d us, p99 "
+                "%d us, max %d us  dropped %d  errors %d" %
+                (snapshot["packets"], snapshot["packets_per_second"],
+                 snapshot["bytes_per_second"] / 1000.0, latency["p50"],
+                 latency["p99"], latency["max"], snapshot["dropped"],
+                 snapshot["errors"]))
+
+
+class transport(object):
+    '''
+    Base of the transports, which implement _deliver(package) and may
+    override flush() and close().  send() is the counted, and with timed
+    also timed, _deliver().  name says where the packets go.
+    '''
+    name = None
+
+    def __init__(self, timed=True, clock=ksnsched.monotonic):
+        self.clock = clock
+        self.timed = timed
+        self.stats = transport_stats(clock)
+        self.send = self._timed_send if timed else self._counted_send
+
+
+    def _counted_send(self, package):
+        stats = self.stats
+        try:
+            self._deliver(package)
+        except socket.error:
+            stats.errors += 1
+            raise
+        stats.packets += 1
+        stats.bytes += len(package)
+
+
+    def _timed_send(self, package):
+        stats = self.stats
+        clock = self.clock
+        start = clock()
+        try:
+            self._deliver(package)
+        except socket.error:
+            stats.errors += 1
+            raise
+        stats.latency.record(int((clock() - start) * 1e6))
+        stats.packets += 1
+        stats.bytes += len(package)
+
+
+    def _deliver(self, package):
+        raise NotImplementedError
+
+
+    def flush(self):
+        '''Sends what send() queued, raises the socket.error that stopped
+        it'''
+        pass
+
+
+    def close(self):
+        pass
+
+
+class socket_transport(transport):
+    '''
+    A datagram socket, or any object with its sendto() and close() (see
+    ksnasync).  Connected (or batching, which needs it), the packets go out
+    with send().
+    '''
+    def __init__(self, sock, address, connect=False, batch=False, timed=True,
+                 clock=ksnsched.monotonic):
+        transport.__init__(self, timed, clock)
+        self.sock = sock
+        self.address = address
+        self.connected = False
+        self.batch = None
+        if connect or batch:
+            sock.connect(address)
+            self.connected = True
+        if batch:
+            self.batch = ksnbatch.send_batch(sock)
+            self._deliver = self._append
+        elif self.connected:
+            self._deliver = sock.send
+        else:
+            self._deliver = self._sendto
+
+
+    def _sendto(self, package):
+        self.sock.sendto(package, self.address)
+
+
+    def _append(self, package):
+        dropped = self.batch.dropped
+        error = self.batch.append(package)
+        self.stats.dropped += self.batch.dropped - dropped
+        if error is not None and error.args[0] not in ksnbatch.WOULD_BLOCK:
+            raise error
+
+
+    def flush(self):
+        batch = self.batch
+        if batch is None or not len(batch):
+            return
+        stats = self.stats
+        dropped = batch.dropped
+        if self.timed:
+            start = self.clock()
+            error = batch.flush()
+            stats.latency.record(int((self.clock() - start) * 1e6))
+        else:
+            error = batch.flush()
+        stats.dropped += batch.dropped - dropped
+        #a full non-blocking socket drops what it could not take
+        if error is not None and error.args[0] not in ksnbatch.WOULD_BLOCK:
+            stats.errors += 1
+            raise error
+
+
+    def close(self):
+        self.sock.close()
+
+
+class udp_transport(socket_transport):
+    '''UDP to host:port, on a new socket unless sock is given'''
+    def __init__(self, host, port, connect=False, batch=False, sock=None,
+                 timed=True, clock=ksnsched.monotonic):
+        if sock is None:
+            sock = socket.socket(type=socket.SOCK_DGRAM)
+        socket_transport.__init__(self, sock, (host, port), connect, batch,
+                                  timed, clock)
+        self.name = "udp:%s:%d" % (host, port)
+
+
+class unix_transport(socket_transport):
+    '''
+    An AF_UNIX datagram socket sending to the socket bound at path.  Not
+    connected, the simulator may start after the sender and be restarted
+    (the packets sent meanwhile fail with ENOENT or ECONNREFUSED).  A full
+    receive queue would block the sender, the socket is non-blocking and the
+    packets that do not fit are dropped instead, like UDP does.
+    '''
+    def __init__(self, path, connect=False, batch=False, timed=True,
+                 clock=ksnsched.monotonic):
+        if not hasattr(socket, "AF_UNIX"):
+            raise ValueError("AF_UNIX sockets are not available here")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            socket_transport.__init__(self, sock, path, connect, batch, timed,
+                                      clock)
+        except socket.error:
+            sock.close()
+            raise
+        if self.batch is None:
+            self._socket_deliver = self._deliver
+            self._deliver = self._nonblocking_deliver
+        self.name = "unix:%s" % path
+
+
+    def _nonblocking_deliver(self, package):
+        try:
+            self._socket_deliver(package)
+        except socket.error as error:
+            if error.args[0] not in ksnbatch.WOULD_BLOCK:
+                raise
+            self.stats.dropped += 1
+
+
+class memory_transport(transport):
+    '''
+    Keeps a copy of every packet for receive(), for tests.  With maxlen, the
+    packets sent while that many are waiting are dropped.
+    '''
+    name = "memory"
+
+    def __init__(self, maxlen=None, timed=True, clock=ksnsched.monotonic):
+        transport.__init__(self, timed, clock)
+        self.maxlen = maxlen
+        self.queue = collections.deque()
+
+
+    def _deliver(self, package):
+        if self.maxlen is not None and len(self.queue) >= self.maxlen:
+            self.stats.dropped += 1
+            return
+        self.queue.append(bytes(package))
+
+
+    def receive(self):
+        '''The oldest packet waiting, None if there is none'''
+        if self.queue:
+            return self.queue.popleft()
+        return None
+
+
+    def drain(self):
+        '''Every packet waiting, oldest first'''
+        packets = list(self.queue)
+        self.queue.clear()
+        return packets
+
+
+def _slot_stride(slot_size):
+    #slots on 16 byte boundaries
+    return (RING_SLOT_HEADER.size + slot_size + 15) & ~15
+
+
+class ring_transport(transport):
+    '''
+    Writes the packets to slots of the ring file at path (created, or reset,
+    with room for slots packets of up to slot_size bytes) and publishes them
+    by advancing the write index.  The reader owns the read index.  A packet
+    sent while the ring is full is dropped, the sender never waits.
+
+    There is no lock: a slot is written before the index that makes it
+    visible, and x86 keeps stores in order.  A weakly ordered CPU would need
+    a barrier between the two.
+    '''
+    def __init__(self, path, slots=RING_SLOTS, slot_size=RING_SLOT_SIZE,
+                 timed=True, clock=ksnsched.monotonic):
+        transport.__init__(self, timed, clock)
+        if slots < 1 or slot_size < 1:
+            raise ValueError("the ring needs slots and slot_size > 0")
+        self.name = "ring:%s" % path
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.stride = _slot_stride(slot_size)
+        size = RING_SLOTS_OFFSET + slots * self.stride
+        with open(path, "w+b") as ring_file:
+            ring_file.truncate(size)
+            self.map = mmap.mmap(ring_file.fileno(), size)
+        RING_HEADER.pack_into(self.map, 0, RING_MAGIC, slots, slot_size)
+        self.view = memoryview(self.map) if sys.version_info[0] >= 3 \
+            else self.map
+        self.write_index = 0
+
+
+    def _deliver(self, package):
+        size = len(package)
+        if size > self.slot_size:
+            raise ValueError("packet of %d bytes does not fit a %d byte slot" %
+                             (size, self.slot_size))
+        index = self.write_index
+        if index - RING_INDEX.unpack_from(self.map, RING_READ_OFFSET)[0] >= \
+                self.slots:
+            self.stats.dropped += 1
+            return
+        offset = RING_SLOTS_OFFSET + (index % self.slots) * self.stride
+        RING_SLOT_HEADER.pack_into(self.map, offset, size, self.clock())
+        start = offset + RING_SLOT_HEADER.size
+        if self.view is self.map:
+            #python 2 maps only take strings
+            package = bytes(package)
+        self.view[start:start+size] = package
+        self.write_index = index + 1
+        RING_INDEX.pack_into(self.map, RING_WRITE_OFFSET, index + 1)
+
+
+    def close(self):
+        if self.map is not None:
+            self.view = None
+            self.map.close()
+            self.map = None
+
+
+class ring_reader(object):
+    '''
+    Reads the ring file of a ring_transport.  receive() returns the packets
+    published since the previous call as views into the ring, valid until
+    the next receive(), whose start frees their slots.  stats has the send
+    to read latency of every packet.
+    '''
+    def __init__(self, path, clock=ksnsched.monotonic):
+        self.clock = clock
+        self._file = open(path, "r+b")
+        self.map = mmap.mmap(self._file.fileno(), 0)
+        magic, self.slots, self.slot_size = RING_HEADER.unpack_from(self.map)
+        if magic != RING_MAGIC:
+            self.close()
+            raise ValueError("%s is not a ksnsend ring" % path)
+        self.stride = _slot_stride(self.slot_size)
+        self.view = memoryview(self.map) if sys.version_info[0] >= 3 \
+            else self.map
+        self.read_index = RING_INDEX.unpack_from(self.map,
+                                                 RING_READ_OFFSET)[0]
+        self.stats = transport_stats(clock)
+
+
+    def receive(self, max_packets=None):
+        RING_INDEX.pack_into(self.map, RING_READ_OFFSET, self.read_index)
+        write_index = RING_INDEX.unpack_from(self.map, RING_WRITE_OFFSET)[0]
+        if write_index < self.read_index:
+            #the sender started over
+            self.read_index = 0
+            RING_INDEX.pack_into(self.map, RING_READ_OFFSET, 0)
+        count = write_index - self.read_index
+        if max_packets is not None:
+            count = min(count, max_packets)
+        if count <= 0:
+            return []
+        now = self.clock()
+        stats = self.stats
+        record = stats.latency.record
+        unpack_from = RING_SLOT_HEADER.unpack_from
+        packets = []
+        for index in range(self.read_index, self.read_index + count):
+            offset = RING_SLOTS_OFFSET + (index % self.slots) * self.stride
+            size, sent = unpack_from(self.map, offset)
+            start = offset + RING_SLOT_HEADER.size
+            packets.append(self.view[start:start+size])
+            record(int((now - sent) * 1e6))
+            stats.bytes += size
+        stats.packets += count
+        self.read_index += count
+        return packets
+
+
+    def close(self):
+        self.view = None
+        try:
+            self.map.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+
+def from_options(options, timed=False, clock=ksnsched.monotonic):
+    '''The transport of the ksnsend --transport options'''
+    if options.transport == "unix":
+        return unix_transport(options.transport_path, batch=options.batch,
+                              timed=timed, clock=clock)
+    if options.transport == "ring":
+        return ring_transport(options.transport_path, options.ring_slots,
+                              timed=timed, clock=clock)
+    return udp_transport(options.host, options.port,
+                         connect=options.transport == "udpconnected",
+                         batch=options.batch, timed=timed, clock=clock)
+
+
+def read_ring(path, interval=5.0):
+    '''Reads the ring at path and prints its stats every interval seconds'''
+    reader = ring_reader(path)
+    print("Reading %s, terminate with Ctrl-C" % path)
+    last = time.time()
+    try:
+        while True:
+            if not reader.receive():
+                time.sleep(0.001)
+            if time.time() - last >= interval:
+                last = time.time()
+                print(reader.stats.summary())
+    except KeyboardInterrupt:
+        print("")
+    finally:
+        reader.close()
+    print(reader.stats.summary())
+
+
+def benchmark(packets=100000, size=24):
+    '''name: transport_stats snapshot of packets sent through every local
+    transport, timed'''
+    results = {}
+    package = bytearray(size)
+    sink = socket.socket(type=socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    host, port = sink.getsockname()
+    directory = os.environ.get("TMPDIR", "/tmp")
+    unix_path = os.path.join(directory, "ksntransport.%d.sock" % os.getpid())
+    ring_path = os.path.join(directory, "ksntransport.%d.ring" % os.getpid())
+    unix_sink = None
+    if hasattr(socket, "AF_UNIX"):
+        unix_sink = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        unix_sink.bind(unix_path)
+    cases = [("udp", lambda: udp_transport(host, port)),
+             ("udpconnected", lambda: udp_transport(host, port, True)),
+             ("memory", lambda: memory_transport(maxlen=1)),
+             ("ring", lambda: ring_transport(ring_path))]
+    if unix_sink is not None:
+        cases.insert(2, ("unix", lambda: unix_transport(unix_path)))
+    try:
+        for name, factory in cases:
+            sender = factory()
+            reader = ring_reader(ring_path) if name == "ring" else None
+            #the sinks are drained every 32 packets so they never fill
+            for i in range(packets):
+                sender.send(package)
+                if i & 31 == 31:
+                    _drain(sink, unix_sink, reader, sender)
+            _drain(sink, unix_sink, reader, sender)
+            results[name] = sender.stats.snapshot()
+            if reader is not None:
+                results["ring.reader"] = reader.stats.snapshot()
+                reader.close()
+            sender.close()
+    finally:
+        sink.close()
+        if unix_sink is not None:
+            unix_sink.close()
+            os.remove(unix_path)
+        if os.path.exists(ring_path):
+            os.remove(ring_path)
+    return results
+
+
+def _drain(sink, unix_sink, reader, sender):
+    for sock in (sink, unix_sink):
+        if sock is None:
+            continue
+        sock.setblocking(False)
+        try:
+            while True:
+                sock.recv(2048)
+        except socket.error:
+            pass
+    if reader is not None:
+        reader.receive()
+    if isinstance(sender, memory_transport):
+        sender.drain()
+
+
+def main():
+    '''ring PATH reads a ring, no argument benchmarks the transports'''
+    if len(sys.argv) == 3 and sys.argv[1] == "ring":
+        read_ring(sys.argv[2])
+        return
+    if len(sys.argv) != 1:
+        print("usage: %s [ring PATH]" % sys.argv[0])
+        sys.exit(2)
+    for name, snapshot in sorted(benchmark().items()):
+        latency = snapshot["latency_us"]
+        print("%-14s %9.0f packets/s  latency p50 %d us, p99 %d us, mean "
+              "%.2f us" % (name, snapshot["packets_per_second"],
+                           latency["p50"], latency["p99"], latency["mean"]))
+
+
+if __name__ == "__main__":
+    main()
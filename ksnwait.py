@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+'''
+Condition waits for the KSN770 scripts, in place of fixed test.wait()
+sleeps.
+
+wait_until() returns once a predicate on the ACSim or FMS state is true,
+or False after timeout seconds.  How soon depends on how the waiter is
+built:
+
+  - with sleep (test.wait in the scripts, which keeps the engine pumping
+    its stream) it is bounded polling: the predicate is evaluated every
+    interval seconds, so a wait ends at most interval after the condition
+    came true.  This is how the scripts use it, the engine has no change
+    callback to hook up.
+  - without sleep the predicate is evaluated again on every notify(), e.g.
+    from a ksndecode.ksn_sink hooked up with watch(), and at the latest
+    every interval seconds (only on notify() if interval is None).
+
+    waiter = ksnwait.event_waiter(test.wait)
+    waiter.wait_until(lambda: test.ACSim.FASSelect.fas_select == 1, 6,
+                      "FAS data block sent")
+    ...
+    for line in waiter.report():
+        test.log(line)
+
+Every wait records how long the condition took and the fixed sleep it
+replaces (the timeout unless replaces is given), report() gives the
+latencies and the time saved.
+'''
+
+import threading
+
+import ksnsched
+
+#seconds between evaluations when nothing notifies
+DEFAULT_INTERVAL = 0.1
+
+
+class wait_record(object):
+    '''One wait_until(): what, how long, the sleep it replaces and whether
+    the condition came true'''
+    __slots__ = ("description", "latency", "replaces", "ok")
+
+    def __init__(self, description, latency, replaces, ok):
+        self.description = description
+        self.latency = latency
+        self.replaces = replaces
+        self.ok = ok
+
+
+class event_waiter(object):
+    '''
+    Waits for predicates on the state the label stream updates.  sleep,
+    when given, is called with the slice to sleep between evaluations (a
+    notification only skips the sleep if it came before it); without it
+    the waiter waits on the notifications.  interval bounds the slices,
+    None waits for the notifications (and the timeout) only.
+    '''
+    def __init__(self, sleep=None, interval=DEFAULT_INTERVAL,
+                 clock=ksnsched.monotonic):
+        self.sleep = sleep
+        self.interval = interval
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.notifications = 0
+        self.waits = []
+
+
+    def notify(self, *args):
+        '''The state changed; takes and ignores the arguments of any change
+        callback, e.g. the label and record of ksn_sink'''
+        with self.condition:
+            self.notifications += 1
+            self.condition.notify_all()
+
+
+    def watch(self, sink):
+        '''Be notified of every label sink (a ksndecode.ksn_sink) decodes'''
+        sink.listeners.append(self.notify)
+
+
+    def _pause(self, seen, seconds):
+        '''Sleep until a notification after seen or for seconds; with sleep
+        only a notification before it shortens the pause'''
+        if self.sleep is not None:
+            if self.notifications == seen:
+                self.sleep(seconds)
+            return
+        with self.condition:
+            if self.notifications == seen:
+                self.condition.wait(seconds)
+
+
+    def wait_until(self, predicate, timeout, description=None,
+                   replaces=None):
+        '''
+        Wait until predicate() is true, at most timeout seconds.  Returns
+        True if it is, False on timeout (the scripts verifyBool() the state
+        afterwards as they did after the fixed sleeps).
+        '''
+        start = self.clock()
+        end_time = start + timeout
+        while True:
+            seen = self.notifications
+            if predicate():
+                ok = True
+                break
+            remaining = end_time - self.clock()
+            if remaining <= 0:
+                ok = bool(predicate())
+                break
+            if self.interval is not None:
+                remaining = min(remaining, self.interval)
+            self._pause(seen, remaining)
+        self.waits.append(wait_record(
+            description or "wait %d" % (len(self.waits) + 1),
+            self.clock() - start, timeout if replaces is None else replaces,
+            ok))
+        return ok
+
+
+    def saved(self):
+        '''Seconds saved against the fixed sleeps replaced'''
+        return sum(max(record.replaces - record.latency, 0)
+                   for record in self.waits)
+
+
+    def report(self):
+        '''One line per wait and a total'''
+        lines = ["%s: %.2fs of %gs%s" %
+                 (record.description, record.latency, record.replaces,
+                  "" if record.ok else " TIMED OUT")
+                 for record in self.waits]
+        lines.append("%d waits, %.2fs waited, %.1fs saved" %
+                     (len(self.waits),
+                      sum(record.latency for record in self.waits),
+                      self.saved()))
+        return lines
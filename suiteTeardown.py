@@ -0,0 +1,11 @@
+from KSN770ScriptEngine import *
+import ksnsuite
+
+test = script( __doc__ )
+
+# Restore the preferences the suite changed, with a cold start if any did.
+unit = ksnsuite.unit_state.load()
+unit.restore( test )
+test.log( unit.summary() )
+
+test.endScript()